@@ -0,0 +1,227 @@
+# Copyright (C) 2023 pom@vro.life
+# SPDX-License-Identifier: MIT OR LGPL-3.0-only OR GPL-2.0-only OR GPL-3.0-only
+import os
+import sys
+import time
+import itertools
+import argparse
+import tracemalloc
+import subprocess
+from playlang import Parser, Token, Rule, Scanner, Start, Lazy, Tokenizer
+from playlang.classes import Terminal, _free_threaded
+from test_py import ParserCalc, ParserDelimited, ParserStatements, ParserUnitRules
+
+
+def _timeit(fun, repeat):
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fun()
+        elapsed = time.perf_counter() - begin
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_parallel(args):
+    expr = '+'.join([f'({i}*{i}-{i})' for i in range(50)])
+    inputs = [f'x={expr}'] * args.inputs
+
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print(f'python {sys.version.split()[0]}, GIL {"enabled" if gil else "disabled"}, '
+          f'{args.inputs} inputs')
+
+    baseline = None
+    threads = 1
+    while threads <= args.threads:
+        elapsed = _timeit(lambda: ParserCalc.parse_parallel(
+            inputs, ParserCalc.scanner, ParserCalc, max_workers=threads), args.repeat)
+        if baseline is None:
+            baseline = elapsed
+        print(f'{threads:4} threads: {elapsed:8.3f} s  speedup x{baseline / elapsed:.2f}')
+        threads *= 2
+
+
+def bench_list(args):
+    # items of one document, see ParallelList
+    text = ';'.join([' + '.join(str(j) for j in range(i % 20 + 1)) for i in range(args.size)])
+    tokens = list(ParserStatements.scanner(text, eof_stop=True))
+
+    def stream():
+        # the end of file token is read again after it is shifted
+        return itertools.chain(tokens, itertools.repeat(tokens[-1]))
+
+    elapsed = _timeit(lambda: ParserStatements.parse(stream(), None), args.repeat)
+    print(f'{len(tokens)} tokens, sequential: {elapsed:.3f} s')
+    baseline = elapsed
+    if not _free_threaded():
+        # parse_list_parallel is parse with the GIL
+        elapsed = _timeit(lambda: ParserStatements.parse_list_parallel(stream(), None), args.repeat)
+        print(f'GIL enabled, sequential: {elapsed:8.3f} s  speedup x{baseline / elapsed:.2f}')
+        return
+    threads = 1
+    while threads <= args.threads:
+        elapsed = _timeit(lambda: ParserStatements.parse_list_parallel(
+            stream(), None, max_workers=threads), args.repeat)
+        print(f'{threads:4} threads: {elapsed:8.3f} s  speedup x{baseline / elapsed:.2f}')
+        threads *= 2
+
+
+def bench_tree(args):
+    # parse tree of a token array compared to the values of the rule actions
+    text = ' + '.join([f'{i} * ({i} + x) - {i}' for i in range(args.size)])
+    tokens = ParserCalc.scanner.tokenize_array(text)
+    tracemalloc.start()
+    tree = ParserCalc.parse_tree(tokens)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    elapsed = _timeit(lambda: ParserCalc.parse_tree(tokens), args.repeat)
+    print(f'{len(text)} bytes, {len(tokens)} tokens, {len(tree)} nodes: {elapsed:.3f} s, '
+          f'{tree.nbytes} bytes of arrays, {peak} bytes peak')
+
+
+def bench_unit(args):
+    # unit rules of the precedence levels, see PassThrough
+    text = ' + '.join([f'{i} + -{i}' for i in range(args.size)])
+    tokens = ParserUnitRules.scanner.tokenize_array(text)
+    tree = ParserUnitRules.parse_tree(tokens)
+    elapsed = _timeit(lambda: ParserUnitRules.parse(
+        ParserUnitRules.scanner(text), []), args.repeat)
+    print(f'{len(tokens)} tokens, {len(tree)} reductions, {tree.skipped} skipped, '
+          f'{tree.skipped / len(tokens):.2f} per token: {elapsed:.3f} s')
+
+
+def bench_tokenize(args):
+    text = ' '.join([f'x{i} = {i} * ({i} + "s{i}") - {i}' for i in range(args.size)])
+    count = sum(1 for _ in ParserCalc.scanner(text, eof_stop=True))
+    elapsed = _timeit(lambda: sum(1 for _ in ParserCalc.scanner(text, eof_stop=True)), args.repeat)
+    print(f'{count} tokens: {elapsed:.3f} s, {count / elapsed:.0f} tokens/s')
+
+    array = ParserCalc.scanner.tokenize_array(text)
+    elapsed = _timeit(lambda: ParserCalc.scanner.tokenize_array(text), args.repeat)
+    print(f'{len(array)} tokens (array): {elapsed:.3f} s, {len(array) / elapsed:.0f} tokens/s')
+
+    # threads on free-threaded builds, worker processes with the GIL
+    backend = 'threads' if _free_threaded() else 'processes'
+    chunk_size = len(text) // (os.cpu_count() or 1) + 1
+    elapsed = _timeit(lambda: ParserCalc.scanner.tokenize_parallel(
+        text, boundary=' ', chunk_size=chunk_size), args.repeat)
+    print(f'{len(array)} tokens (parallel, {backend}): {elapsed:.3f} s, '
+          f'{len(array) / elapsed:.0f} tokens/s')
+
+
+def bench_strings(args):
+    # string literals scanned by a start condition, one token per character,
+    # and by a Delimited token
+    literal = '"' + 'lorem ipsum \\"dolor\\" sit amet ' * 4 + '"'
+    text = ' '.join([literal] * args.size)
+    for name, scanner in (('condition', ParserCalc.scanner), ('delimited', ParserDelimited.scanner)):
+        elapsed = _timeit(lambda: sum(1 for _ in scanner(text, eof_stop=True)), args.repeat)
+        print(f'{name:>10}: {elapsed:.3f} s, {len(text) / elapsed / 1e6:8.2f} MB/s')
+
+
+def bench_keywords(args):
+    # many tokens in one condition, see the first character dispatch of Tokenizer
+    tokens = []
+    for i in range(280):
+        tokens.append((f'KW{i}', rf'kw{i}x\b'))
+    tokens.extend([('NAME', r'[a-zA-Z_]\w*'), ('NUMBER', r'[0-9]+'), ('WHITE', r'\s+'),
+                   ('LPAR', r'\('), ('RPAR', r'\)'), ('COMMA', ',')])
+    terminals = []
+    for name, pattern in tokens:
+        terminal = Terminal(name, name, precedence=None)
+        terminal.data['pattern'] = pattern
+        terminals.append(terminal)
+    eof = Terminal('EOF', 'EOF', precedence=None)
+    eof.data['is_eof'] = True
+    tokenizer = Tokenizer({'__default__': Scanner(*terminals, eof)}, None)
+
+    text = ' '.join([f'f(kw{i % 280}x, {i}, name{i})' for i in range(args.size)])
+    count = sum(1 for _ in tokenizer(text, eof_stop=True))
+    elapsed = _timeit(lambda: sum(1 for _ in tokenizer(text, eof_stop=True)), args.repeat)
+    print(f'{len(terminals)} token kinds, {count} tokens: {elapsed:.3f} s, '
+          f'{count / elapsed:.0f} tokens/s')
+
+
+def _define_grammar(size):
+    # same as a class body with `size` tokens and symbols, each symbol refers
+    # to a few of the previous ones
+    dic = Parser.__prepare__('ParserBench', ())
+    dic['_'] = Lazy()
+    tokens = []
+    for i in range(size):
+        dic[f'T{i}'] = Token(f't{i}')
+        tokens.append(dic[f'T{i}'])
+    dic['_'] = Scanner(*tokens)
+    for i in range(size):
+        token = dic[f'T{i}']
+        dic[f'S{i}'] = Rule(token)(lambda ctx, *args: args)
+        for j in range(max(0, i - 4), i):
+            dic[f'S{i}'] = Rule(dic[f'S{j}'], token)(lambda ctx, *args: args)
+    dic['_'] = Start(dic[f'S{size - 1}'])
+    return Parser('ParserBench', (), dic)
+
+
+def bench_define(args):
+    size = max(args.size // 64, 16)
+    while size <= args.size // 4:
+        elapsed = _timeit(lambda: _define_grammar(size), args.repeat)
+        print(f'{size:6} symbols: {elapsed * 1000:8.3f} ms  {elapsed / size * 1e6:6.2f} us/symbol')
+        size *= 2
+
+    # a fresh interpreter, the benchmarks import more than playlang needs
+    code = 'import sys, time; begin = time.perf_counter(); import playlang; ' \
+           'print(f"import playlang: {(time.perf_counter() - begin) * 1000:.3f} ms, ' \
+           'deferred: {[m for m in (\'inspect\', \'logging\') if m not in sys.modules]}")'
+    subprocess.run([sys.executable, '-c', code], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def _define_dialect(base, name, extend):
+    # a dialect of _define_grammar, a new discarded token or one more rule of the symbol extend.
+    # the first reuses the tables of the base, the others the states of the symbols that do not
+    # refer to extend, none for S0, see _reuse
+    dic = Parser.__prepare__(name, (base,))
+    dic['COMMENT'] = Token('#', discard=True)
+    tokens = base.__scanners__['__default__'].tokens
+    dic['_'] = Scanner(*tokens[:-1], dic['COMMENT'])
+    if extend:
+        dic[extend] = Rule(dic[extend], dic['T0'])(lambda ctx, *args: args)
+    return Parser(name, (base,), dic)
+
+
+def bench_dialects(args):
+    size = max(args.size // 64, 16)
+    base = _define_grammar(size).warmup()
+    elapsed = _timeit(lambda: _define_grammar(size).warmup(), args.repeat)
+    print(f'base grammar, {size} symbols: {elapsed * 1000:8.3f} ms')
+    for extend, label in ((None, 'tokens only, same tables'),
+                          ('S0', 'one more rule of S0, nothing reused'),
+                          (f'S{size - 1}', 'one more rule of the start symbol, states reused')):
+        elapsed = _timeit(lambda: [_define_dialect(base, f'Dialect{i}', extend).warmup()
+                                   for i in range(12)], args.repeat)
+        print(f'12 dialects, {label}: {elapsed * 1000:8.3f} ms')
+
+
+BENCHMARKS = {
+    'parallel': bench_parallel,
+    'list': bench_list,
+    'tree': bench_tree,
+    'unit': bench_unit,
+    'tokenize': bench_tokenize,
+    'strings': bench_strings,
+    'keywords': bench_keywords,
+    'define': bench_define,
+    'dialects': bench_dialects,
+}
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser()
+    argp.add_argument('benchmark', choices=BENCHMARKS.keys())
+    argp.add_argument('--repeat', type=int, default=3)
+    argp.add_argument('--inputs', type=int, default=2000, help='parallel: number of inputs')
+    argp.add_argument('--threads', type=int, default=os.cpu_count(), help='parallel, list: max threads')
+    argp.add_argument('--size', type=int, default=20000, help='tokenize, list, tree, unit: number of statements, strings: number of literals, define, dialects: max symbols * 4')
+    args = argp.parse_args()
+    BENCHMARKS[args.benchmark](args)
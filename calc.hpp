@@ -12,7 +12,7 @@ using namespace playlang;
 
 #define CALC_VOID_TOKEN(n) \
 struct n : public Token<void> { \
-    n(const std::string& s) { } \
+    n(StringView) { } \
 };
 
 CALC_VOID_TOKEN(EQUALS);
@@ -44,7 +44,7 @@ struct STRING_CHAR : public Token<void, true> {
 };
 
 struct STRING_ESCAPE : public Token<char> {
-    STRING_ESCAPE(const std::string& s) 
+    STRING_ESCAPE(StringView s) 
     :Token<char>(s.at(0)) 
     { }
 };
@@ -59,10 +59,12 @@ struct STRING_QUOTE : public Token<void, true> {
 };
 
 struct NUMBER : public Token<int> {
-    NUMBER(const std::string& s) 
-    :Token<int>(std::stoi(s)) 
+    NUMBER(StringView s) 
+    :Token<int>(0) 
     { 
-        
+        for (char c : s) {
+            value(value() * 10 + (c - '0'));
+        }
     }
 };
 
@@ -85,28 +87,28 @@ struct STRING_MISMATCH : public Token<void> {
 };
 
 struct PLUS : public Token<void> {
-    PLUS(const std::string& s) { }
+    PLUS(StringView) { }
     int operator ()(int l, int r) {
         return l + r;
     }
 };
 
 struct MINUS : public Token<void> {
-    MINUS(const std::string& s) { }
+    MINUS(StringView) { }
     int operator ()(int l, int r) {
         return l + r;
     }
 };
 
 struct TIMES : public Token<void> {
-    TIMES(const std::string& s) { }
+    TIMES(StringView) { }
     int operator ()(int l, int r) {
         return l * r;
     }
 };
 
 struct DIVIDE : public Token<void> {
-    DIVIDE(const std::string& s) { }
+    DIVIDE(StringView) { }
     int operator ()(int l, int r) {
         return l * r;
     }
@@ -128,9 +128,80 @@ export class Context {
     }
 }
 
+// The region ends with `close` and not at the end of input
+function closed(text, head, close, escape) {
+    const end = text.length - close.length
+    if (end < head || !text.endsWith(close)) {
+        return false
+    }
+    var count = 0
+    while (escape !== undefined && end - count > head && text.charAt(end - count - 1) === escape) {
+        count += 1
+    }
+    return count % 2 == 0
+}
+
+// Value of a Delimited token, the text between the delimiters without escapes.
+// `close` is passed if the end of input also closes the region
+export function delimited(text, head, tail, escape, close) {
+    if (close !== undefined && !closed(text, head, close, escape)) {
+        tail = 0
+    }
+    const body = text.slice(head, text.length - tail)
+    if (escape === undefined) {
+        return body
+    }
+    var idx = body.indexOf(escape)
+    if (idx < 0) {
+        return body
+    }
+    var value = ''
+    var pos = 0
+    while (idx >= 0) {
+        value += body.slice(pos, idx) + body.charAt(idx + 1)
+        pos = idx + 2
+        idx = body.indexOf(escape, pos)
+    }
+    return value + body.slice(pos)
+}
+
 export class TrailingJunk extends Error {}
 export class SyntaxError extends Error {}
 
+// The message is formatted when it is read for the first time
+export class UnexpectedTokenError extends SyntaxError {
+    constructor(lookahead, expected, show_name) {
+        super()
+        const [token, value, location] = lookahead
+        this.token = token
+        this.value = value
+        this.location = location
+        this.expected = expected
+        this._show_name = show_name
+        this._message = undefined
+    }
+
+    get message() {
+        if (this._message === undefined) {
+            const names = this.expected.map(tid => this._show_name[tid])
+            var location = ""
+            var message = ""
+            if (this.location !== undefined) {
+                location = `${this.location.filename}${this.location.line}:${this.location.column} => `
+            }
+            if (names.length == 1) {
+                message = `, expecting ${names[0]}`
+            } else if (names.length == 2) {
+                message = `, expecting ${names[0]} or ${names[1]}`
+            } else {
+                message = `, expecting one of [${names.join(" ")}]`
+            }
+            this._message = `${location}unexpected token ${this._show_name[this.token]}(${this.value})${message}`
+        }
+        return this._message
+    }
+}
+
 export function create_scanner(actions, regexps, capture) {
     return function* (content, filename) {
         if (filename === undefined) {
@@ -1,24 +1,39 @@
 # Copyright (C) 2023 pom@vro.life
 # SPDX-License-Identifier: LGPL-3.0-only OR GPL-2.0-only OR GPL-3.0-only
 from playlang.errors import *
-from playlang.classes import Location, Rule, Precedence, Scanner, Start, Action, Token, ShowName
-from playlang.parser import Parser
+from playlang.classes import Location, Rule, Precedence, Scanner, Start, Action, Token, Delimited, ShowName, Emit, \
+    Memoize, Pure, PassThrough, Lazy, ParallelList, Many, Many1, SepBy, SepBy1, Optional
+from playlang.parser import Parser, PushParser
 from playlang.tokenizer import Tokenizer, StaticTokenizer
 
 __all__ = [
     'ConflictError',
     'ConflictShiftReduceError',
     'ConflictReduceReduceError',
+    'UnexpectedTokenError',
 
     'Location',
     'Token',
+    'Delimited',
     'Scanner',
     'Action',
     'Tokenizer',
     'StaticTokenizer',
     'Rule',
     'Parser',
+    'PushParser',
     'Precedence',
     'Start',
-    'ShowName'
+    'ShowName',
+    'Emit',
+    'Memoize',
+    'Pure',
+    'PassThrough',
+    'Lazy',
+    'ParallelList',
+    'Many',
+    'Many1',
+    'SepBy',
+    'SepBy1',
+    'Optional'
 ]
@@ -0,0 +1,95 @@
+# Copyright (C) 2023 pom@vro.life
+# SPDX-License-Identifier: LGPL-3.0-only OR GPL-2.0-only OR GPL-3.0-only
+import sys
+import hashlib
+import threading
+import collections
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'size', 'bytes', 'maxsize', 'maxbytes'])
+
+
+def digest(text: str, *fingerprints: bytes):
+    h = hashlib.blake2b(digest_size=16)
+    for fingerprint in fingerprints:
+        h.update(fingerprint)
+    h.update(text.encode('utf-8', 'surrogatepass'))
+    return h.digest()
+
+
+def sizeof(value):
+    """Approximate memory used by `value` and the containers it references"""
+    seen = set()
+    total = 0
+    todo = [value]
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            todo.extend(obj.keys())
+            todo.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            todo.extend(obj)
+    return total
+
+
+class ParseCache:
+    """LRU cache of parse results keyed by input digest
+
+    Entries are evicted when there are more than `maxsize` of them or their
+    estimated size exceeds `maxbytes`. None means unbounded.
+    """
+
+    def __init__(self, maxsize=1024, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = sizeof(value)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while (self.maxsize is not None and len(self._entries) > self.maxsize) or \
+                    (self.maxbytes is not None and self._bytes > self.maxbytes):
+                _, (_, size) = self._entries.popitem(last=False)
+                self._bytes -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, len(self._entries),
+                         self._bytes, self.maxsize, self.maxbytes)
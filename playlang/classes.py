@@ -1,13 +1,27 @@
 # Copyright (C) 2023 pom@vro.life
 # SPDX-License-Identifier: LGPL-3.0-only OR GPL-2.0-only OR GPL-3.0-only
 import os
-import io
-import inspect
-import logging
+import re
+import sys
+import types
 import collections
 from typing import Union
 
 
+def _debug(msg, *args):
+    # logging is not imported by playlang, it is only used if the
+    # application imported it
+    logging = sys.modules.get('logging')
+    if logging is not None and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(msg, *args)
+
+
+def _free_threaded():
+    # threads only run Python code in parallel without the GIL
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
 class TerminalPrecedence:
     ASSOC_SHIFT = 0
     ASSOC_LEFT = 1
@@ -78,6 +92,14 @@ class Terminal(collections.UserDict):
     def is_eof(self):
         return self.data.get('is_eof', False)
 
+    @property
+    def is_error(self):
+        return self.data.get('is_error', False)
+
+    def freeze(self):
+        if not isinstance(self.data, types.MappingProxyType):
+            self.data = types.MappingProxyType(self.data)
+
     def __repr__(self):
         return self.name
 
@@ -90,7 +112,7 @@ class RuleInfo:
 
 class SymbolInfo(collections.UserDict):
     def __init__(self):
-        super().__init__(self)
+        super().__init__()
         self.rules = []
         self.action = None
 
@@ -144,6 +166,11 @@ class Symbol(collections.UserDict):
     def rules(self):
         return self._rules
 
+    def freeze(self):
+        if not isinstance(self.data, types.MappingProxyType):
+            self.data = types.MappingProxyType(self.data)
+            self._rules = tuple(self._rules)
+
 
 class SymbolRule:
     def __init__(self,
@@ -156,15 +183,17 @@ class SymbolRule:
             print(components)
             raise TypeError('expect tuple or list')
 
+        # the expansions of a Rule are built in lists, a rule keeps a tuple
+        components = tuple(components)
+
         if isinstance(precedence, Terminal):
             precedence = precedence.precedence
         elif precedence is None:
             precedence = TerminalPrecedence(0)
             for c in components:
                 if isinstance(c, Terminal):
-                    if precedence > c.precedence and logging.getLogger().isEnabledFor(logging.DEBUG):
-                        logging.debug(
-                            'rule bind to lower precedence. %s', {components})
+                    if precedence > c.precedence:
+                        _debug('rule bind to lower precedence. %s', components)
                     precedence = c.precedence
 
         assert isinstance(precedence, TerminalPrecedence)
@@ -180,6 +209,8 @@ class SymbolRule:
         else:
             self.extra_info = extra_info
 
+        self.emit = self.extra_info.get('emit', False)
+
     @property
     def action(self):
         return self._action
@@ -190,10 +221,11 @@ class SymbolRule:
     def __repr__(self):
         detail = ''
         if self._action is not None:
+            import inspect  # pylint: disable=import-outside-toplevel
             line_number = inspect.getsourcelines(self._action)[1]
             file = os.path.basename(inspect.getsourcefile(self._action))
             detail = f'{file}:{line_number}'
-        return f'{{ {self.symbol} -> {self._components} <{detail}> }}'
+        return f'{{ {self.symbol} -> {list(self._components)} <{detail}> }}'
 
     def __iter__(self):
         return self._components.__iter__()
@@ -216,6 +248,11 @@ class State:
         self._tokens = []
         self._immediate_tokens = None
 
+        # bitset of immediate_tokens, see Parser.__token_ids__
+        self.expected = 0
+
+        self._frozen = False
+
     def __repr__(self):
         return self._tokens.__repr__()
 
@@ -238,9 +275,26 @@ class State:
         self._immediate_tokens = tuple(self._tokens)
 
     def set_branch(self, token, state):
+        if self._frozen:
+            raise TypeError('state is frozen')
         self._tokens.append(token)
         self._branchs[token] = state
 
+    def redirect(self, token, state):
+        """Change the target of an existing branch"""
+        if self._frozen:
+            raise TypeError('state is frozen')
+        self._branchs[token] = state
+
+    @property
+    def frozen(self):
+        return self._frozen
+
+    def freeze(self):
+        """Parse tables are read only once the parser is built"""
+        self._frozen = True
+        self._tokens = tuple(self._tokens)
+
     def get_branch(self, token):
         return self._branchs.get(token)
 
@@ -302,6 +356,7 @@ class TokenValue:
         self.location = location
 
     def __repr__(self):
+        import io  # pylint: disable=import-outside-toplevel
         buf = io.StringIO()
         buf.write(self.token.__repr__())
 
@@ -330,6 +385,7 @@ def Token(pattern=None,
           discard=False,
           ignorable=False,
           is_eof=False,
+          is_error=False,
           trailing=None,
           **kwargs) -> TokenInfo:
     """Define a token
@@ -340,6 +396,8 @@ def Token(pattern=None,
         ignorable (bool, optional): ignore this token if it cause a syntax error. Defaults to False.
         eof (bool, optional): this token is a End-Of-File token.
                               arguemnt `pattern will be ignore`. Defaults to False.
+        is_error (bool, optional): this token stands for a syntax error in rules.
+                                   used by error recovery. Defaults to False.
         action (callable, optional) scanner action. Defaults to None.
         show_name (callable, optional) human readable name. Defaults to None.
     Returns:
@@ -351,11 +409,72 @@ def Token(pattern=None,
     ti.data['discard'] = discard
     ti.data['ignorable'] = ignorable
     ti.data['is_eof'] = is_eof
+    ti.data['is_error'] = is_error
     ti.data['trailing'] = trailing
     ti.data.update(kwargs)
     return ti
 
 
+def _escape(text):
+    # valid in python and javascript regexps, also inside a /.../ literal
+    escaped = re.escape(text).replace('/', r'\/')
+    return escaped.replace('\\\n', r'\n').replace('\\\r', r'\r').replace('\\\t', r'\t')
+
+
+def Delimited(open,  # pylint: disable=redefined-builtin
+              close,
+              escape=None,
+              discard=False,
+              ignorable=False,
+              close_at_eof=None,
+              **kwargs) -> TokenInfo:
+    """Define a token for a delimited region, e.g. a string literal or a comment
+
+    The region is matched at once instead of character by character. The
+    value is the text between `open` and `close`, an `escape` character is
+    dropped and the character after it is kept.
+
+    Args:
+        open (str): opening delimiter.
+        close (str): closing delimiter.
+        escape (str, optional): escape character. Defaults to None.
+        close_at_eof (bool, optional): the end of input also closes the region.
+                                       Defaults to True if `close` is a newline.
+        discard (bool, optional): read and discard by scanner. Defaults to False.
+        ignorable (bool, optional): see Token. Defaults to False.
+        action (type, optional) called with the value. Defaults to None.
+    Returns:
+        TokenInfo: this value will be replace by meta class Parser
+    """
+    if not open or not close:
+        raise TypeError('delimiters must not be empty')
+    if escape is not None and (len(escape) != 1 or escape == close[0]):
+        raise TypeError(f'invalid escape character: {escape!r}')
+
+    # unrolled loop, the text is consumed by character classes and only
+    # escapes and partial closing delimiters are matched one by one
+    stop = close[0] if escape is None else close[0] + escape
+    body = f'[^{_escape(stop)}]*'
+    special = []
+    if escape is not None:
+        special.append(_escape(escape) + r'[\s\S]')
+    if len(close) > 1:
+        special.append(f'{_escape(close[0])}(?!{_escape(close[1:])})')
+    if special:
+        body = f'{body}(?:(?:{"|".join(special)}){body})*'
+
+    if close_at_eof is None:
+        close_at_eof = close == '\n'
+    end = _escape(close)
+    if close_at_eof:
+        end = rf'(?:{end}|(?![\s\S]))'
+
+    ti = Token(f'{_escape(open)}{body}{end}', discard=discard,
+               ignorable=ignorable, **kwargs)
+    ti.data['delimited'] = (open, close, escape, close_at_eof)
+    return ti
+
+
 class Precedence:
     class Left:
         pass
@@ -380,11 +499,97 @@ class Scanner:
         for tok in tokens:
             if tok.is_eof:
                 self.eof_token = tok
+        # the token of the scanner itself, the token is not modified since
+        # it may be shared with other scanners or a base parser
+        self.capture = capture
         if capture is not None:
-            capture.data['capture'] = True
             self.tokens = list(tokens)
             self.tokens.append(capture)
 
+    def captures(self, token):
+        """True if `token` is the value of this scanner when it leaves"""
+        return token is self.capture or token.capture
+
+
+class Memoize:
+    """Cache parse results of Parser.parse_cached
+
+    All rule actions must be declared `Pure`. See ParseCache for the
+    eviction of `maxsize` and `maxbytes`.
+    """
+
+    def __init__(self, maxsize=1024, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+
+
+class Lazy:
+    """Generate the tables and static fields on first use or Parser.warmup()
+
+    Grammar errors are raised by the first use instead of the class
+    definition.
+    """
+
+
+class ParallelList:
+    """Parse the items of the start symbol `symbol` on a thread pool, see
+    Parser.parse_list_parallel
+
+    `symbol` is defined by the rules `symbol -> ITEM` and
+    `symbol -> symbol separator ITEM`, and `separator` is not used by
+    other rules.
+    """
+
+    def __init__(self, symbol: Symbol, separator: Terminal):
+        self.symbol = symbol
+        self.separator = separator
+
+
+class Combinator:
+    """Component of a Rule for a repetition or an optional item, see Many,
+    Many1, SepBy, SepBy1 and Optional
+
+    Replaced by a symbol with left recursive rules when the class is
+    created, lists are built in place and the parser stack does not grow
+    with their length.
+    """
+
+    def __init__(self, kind, item, separator=None):
+        if not isinstance(item, (Terminal, Symbol, Combinator)):
+            raise TypeError(f'expected a token or a symbol, but got {item}')
+        if separator is not None and not isinstance(separator, Terminal):
+            raise TypeError(f'expected a token as separator, but got {separator}')
+        self.kind = kind
+        self.item = item
+        self.separator = separator
+
+
+def Many(item) -> Combinator:
+    """Zero or more `item`, the value is a list"""
+    return Combinator('Many', item)
+
+
+def Many1(item) -> Combinator:
+    """One or more `item`, the value is a list"""
+    return Combinator('Many1', item)
+
+
+def SepBy(item, separator: Terminal) -> Combinator:
+    """Zero or more `item` separated by `separator`, the value is a list
+    of the items"""
+    return Combinator('SepBy', item, separator)
+
+
+def SepBy1(item, separator: Terminal) -> Combinator:
+    """One or more `item` separated by `separator`, the value is a list
+    of the items"""
+    return Combinator('SepBy1', item, separator)
+
+
+def Optional(item) -> Combinator:
+    """Zero or one `item`, the value is the value of `item` or None"""
+    return Combinator('Optional', item)
+
 
 class StaticField:
     def create(self, parser):
@@ -403,3 +608,50 @@ class ShowName:
             si.data['show_name'] = self._name
             return si
         raise TypeError(f'unsupported target: {si}')
+
+
+class Emit:
+    """Yield the value of these rules from Parser.iterparse
+
+    The value on the parser stack is replaced by None.
+    """
+
+    def __call__(self, si):
+        if isinstance(si, SymbolInfo):
+            si.data['emit'] = True
+            return si
+        raise TypeError(f'unsupported target: {si}')
+
+
+class Pure:
+    """The result of these rules only depends on their arguments
+
+    Required by `Memoize`. The values are shared between cached results
+    and must not be modified.
+    """
+
+    def __call__(self, si):
+        if isinstance(si, SymbolInfo):
+            si.data['pure'] = True
+            return si
+        raise TypeError(f'unsupported target: {si}')
+
+
+class PassThrough:
+    """These unit rules return the value of their component, their
+    reductions are skipped by the parse tables
+
+    The rules have no action, e.g. `EXPR = PassThrough()(Rule(TERM))`, a
+    JavaScript action can only be 'return $1'. The JavaScript parser also
+    skips the unit rules whose action is 'return $1'. The C++ parser does
+    not skip reductions, the symbols have different types and the symbol
+    is constructed from its component.
+    """
+
+    def __call__(self, si):
+        if isinstance(si, Rule):
+            si = si(None)
+        if isinstance(si, SymbolInfo):
+            si.data['pass_through'] = True
+            return si
+        raise TypeError(f'unsupported target: {si}')
@@ -6,11 +6,23 @@
 import re
 import sys
 import io
+import json
 import argparse
 from playlang.classes import SymbolInfo, TokenInfo, Symbol
 from playlang.printer import Printer
 
 
+def _type_name(c):
+    # the structs of the combinator symbols are templates of playlang.hpp
+    info = c.data.get('combinator') if isinstance(c, Symbol) else None
+    if info is None:
+        return c.name
+    kind, item, separator = info
+    if separator is None:
+        return f'playlang::{kind}<{_type_name(item)}>'
+    return f'playlang::{kind}<{_type_name(item)}, {separator.name}>'
+
+
 def _generate_tokenizer(cls, args):
     scan_info = cls.__scanners__  # type: dict
     p = Printer(args.tokenizer)
@@ -60,11 +72,60 @@ public:
 
     operator std::string() const {{ return {{ text(), text_length() }}; }}
 
+    // valid until the next token is read
+    playlang::StringView view() const {{ return {{ text(), text_length() }}; }}
+
     char at(size_t idx) const {{
         assert(idx < text_length());
         return text()[idx];
     }}
 
+    // reads a Delimited token after the opening delimiter up to and
+    // including `close`. the text is appended to `value` without the escape
+    // characters. returns false at the end of input, unless `eof_closes` is
+    // set and the input does not end with an escape character
+    bool delimited(std::string* value, playlang::StringView close, int escape,
+        bool eof_closes, playlang::Location& location)
+    {{
+        std::string buffer {{}};
+        std::string& text = value != nullptr ? *value : buffer;
+        size_t start = text.size();
+        // escaped characters are not part of the closing delimiter
+        size_t guard = start;
+        while (true) {{
+            int c = this->yyinput();
+            if (c == EOF || c == 0) {{
+                return eof_closes;
+            }}
+            if (c == '\\n') {{
+                location.lines(1);
+            }} else {{
+                location.step(1);
+            }}
+            if (c == escape) {{
+                c = this->yyinput();
+                if (c == EOF || c == 0) {{
+                    return false;
+                }}
+                location.step(1);
+                text.push_back(static_cast<char>(c));
+                guard = text.size();
+                continue;
+            }}
+            text.push_back(static_cast<char>(c));
+            if (text.size() - guard >= close.size()
+                && text.compare(text.size() - close.size(), close.size(), close.data(), close.size()) == 0) {{
+                text.resize(text.size() - close.size());
+                return true;
+            }}
+            if (value == nullptr && text.size() > close.size()) {{
+                // only the tail is needed to find the closing delimiter
+                text.erase(0, text.size() - close.size());
+                guard = 0;
+            }}
+        }}
+    }}
+
 private:
     const char* text() const {{ return YYText(); }}
     size_t text_length() const {{ return YYLeng(); }}
@@ -93,7 +154,7 @@ private:
             discard, fullname = map(
                 token.data.get, ('discard', 'fullname'))
             all_tokens.add(token)
-            if token.capture:
+            if scanner.captures(token):
                 captures.append(f'        if ({condition} == ctx) {{ return {{ {str(discard).lower()}, TokenValue{{ this->location(), std::move(val), TID_{fullname} }} }}; }}')
 
     all_tokens = list(all_tokens)
@@ -110,17 +171,29 @@ private:
 
     for symbol in cls.__symbols__:
         p + f'#define TID_{symbol.fullname} {next_tid}'
-        show_name[tid] = symbol.show_name
+        show_name[next_tid] = symbol.show_name
         next_tid += 1
 
     types = []
     for token in all_tokens:
         types.append(token.name)
     for symbol in cls.__symbols__:
-        types.append(symbol.name)
+        types.append(_type_name(symbol))
 
     type_lines = [f'\n/* {i} */ \t{n}' for i,n in enumerate(types)]
 
+    # wrappers of the other start symbols, same as __START__
+    entry_structs = []
+    for symbol, (_, wrapper) in cls.__entries__.items():
+        entry_structs.append(f"""
+struct {wrapper.name} : public playlang::Symbol<typename {symbol.name}::ValueType> {{
+    typedef typename {symbol.name}::ValueType ResultType;
+    {wrapper.name}({symbol.name}& s, {eof_token.name}& _)
+    : playlang::Symbol<typename {symbol.name}::ValueType>(std::move(s.value()))
+    {{ }}
+}};
+""")
+
     if '__EOF__' == eof_token.name:
         p + f"""
 struct __EOF__ : public playlang::Token<void> {{
@@ -137,6 +210,7 @@ struct __START__ : public playlang::Symbol<typename {cls.__start_symbol__.name}:
     {{ }}
 }};
 
+{"".join(entry_structs)}
 typedef playlang::Variant<{", ".join(type_lines)}
 > VariantValueType;
 typedef playlang::TokenValue<VariantValueType> TokenValue;
@@ -172,10 +246,10 @@ public:
     template<typename... Args>
     Tokenizer(Args&&... args) : TokenizerBase(std::forward<Args>(args)...)
     {{
-        _tok_stack.emplace(0, ValueType {{}});
+        _tok_stack.emplace_back(0, ValueType {{}});
     }}
 
-    ValueType& value() {{ return _tok_stack.top().second; }}
+    ValueType& value() {{ return _tok_stack.back().second; }}
 
     TokenValue read()
     {{
@@ -183,10 +257,10 @@ public:
             if (_tok_leave_flag) {{
                 _tok_leave_flag = false;
 
-                auto& val = _tok_stack.top();
+                auto& val = _tok_stack.back();
                 auto tv = capture(val.first, val.second);
 
-                _tok_stack.pop();
+                _tok_stack.pop_back();
                 assert(_tok_stack.size() > 0);
 
                 if (not tv.first) {{ // not discard
@@ -215,18 +289,18 @@ public:
 
     void enter(int ctx_id, ValueType&& value)
     {{
-        _tok_stack.emplace(ctx_id, std::move(value));
+        _tok_stack.emplace_back(ctx_id, std::move(value));
         this->yy_push_state(ctx_id);
     }}
 
     void enter(int ctx_id)
     {{
-        _tok_stack.emplace(ctx_id, ValueType {{}});
+        _tok_stack.emplace_back(ctx_id, ValueType {{}});
         this->yy_push_state(ctx_id);
     }}
 
 protected:
-    std::stack<std::pair<int, ValueType>> _tok_stack {{}};
+    std::vector<std::pair<int, ValueType>> _tok_stack {{}};
     bool _tok_leave_flag {{ false }};
     Location _tok_location;
 
@@ -274,15 +348,20 @@ int {args.namespace}FlexLexer::yylex() {{ abort(); }}
         for token in scanner.tokens:
             pattern, discard, fullname = map(
                 token.data.get, ('pattern', 'discard', 'fullname'))
+            if scanner.captures(token):
+                continue
             if fullname in patterns:
                 continue
             patterns.append(fullname)
-            if token.capture:
-                continue
             if token.is_eof:
                 continue
             if pattern is None:
                 raise TypeError(f'token missing action: {token}')
+            region = token.data.get('delimited')
+            if region is not None:
+                # flex matches the opening delimiter, see TokenizerFlex::delimited
+                p + f'{fullname} {json.dumps(region[0], ensure_ascii=False)}'
+                continue
             pattern = pattern.replace(r'"', r'\"')
             p + f'{fullname} {pattern}'
         p + ''
@@ -298,11 +377,22 @@ int {args.namespace}FlexLexer::yylex() {{ abort(); }}
         if condition != '__default__':
             group = f'<CONDITION_{condition}>'
         for token in scanner.tokens:
-            if token.capture:
+            if scanner.captures(token):
                 continue
             pattern, discard, fullname, trailing = map(
                 token.data.get, ('pattern', 'discard', 'fullname', 'trailing'))
-            code = f'return {{ {str(bool(discard)).lower()}, {args.namespace}::TokenValue{{this->location(), VariantValueType{{{token.name}{{*this}}}}, TID_{fullname}}} }};'
+            code = f'return {{ {str(bool(discard)).lower()}, {args.namespace}::TokenValue{{this->location(), VariantValueType{{playlang::make_token<{token.name}>(*this)}}, TID_{fullname}}} }};'
+            region = token.data.get('delimited')
+            if region is not None:
+                _, close, escape, close_at_eof = region
+                escape = -1 if escape is None else ord(escape)
+                close_at_eof = str(bool(close_at_eof)).lower()
+                close = f'playlang::StringView{{{json.dumps(close, ensure_ascii=False)}, {len(close.encode())}}}'
+                unterminated = f'throw playlang::MismatchError("unterminated {token.show_name}");'
+                if discard:
+                    code = f'if (not this->delimited(nullptr, {close}, {escape}, {close_at_eof}, this->location())) {{ {unterminated} }} return {{ true, {args.namespace}::TokenValue{{}} }};'
+                else:
+                    code = f'std::string value; if (not this->delimited(&value, {close}, {escape}, {close_at_eof}, this->location())) {{ {unterminated} }} return {{ false, {args.namespace}::TokenValue{{this->location(), VariantValueType{{{token.name}{{std::move(value)}}}}, TID_{fullname}}} }};'
             if token.is_eof:
                 if condition == '__default__':
                     pattern_name = '<INITIAL><<EOF>>'
@@ -337,22 +427,57 @@ def _generate_parser(cls, args):
     for idx, state in enumerate(state_list):
         states_ids[state] = idx
 
+    # expected tokens of error states as one zero terminated table,
+    # states with the same set share the same offset
+    expected = {}
+    expected_size = 0
+    for state in state_list:
+        if state.reduce_rule is None:
+            tids = tuple(f'TID_{t.fullname}' for t in state.immediate_tokens)
+            if tids not in expected:
+                expected[tids] = expected_size
+                expected_size += len(tids) + 1
+
+    p < 'static const int _expected_table[] = {'
+    for tids in expected:
+        p + f'{", ".join([*tids, "0"])},'
+    p > '};'
+
     p < """
 template<typename Context>
 class Parser {
-public:
-"""
-    p < f'typename __START__::ResultType parse(Context& ctx, Tokenizer& tokenizer) {{'
+    // the stacks keep their capacity between parses
+    std::vector<int> _state_stack{};
+    std::vector<Tokenizer::TokenValueType> _value_stack{};
+
+public:"""
+    p < f'explicit Parser(size_t reserve = {args.stack_reserve}) {{'
+    p + '_state_stack.reserve(reserve);'
+    p + '_value_stack.reserve(reserve);'
+    p > '}'
+    p + ''
+    p < 'typename __START__::ResultType parse(Context& ctx, Tokenizer& tokenizer) {'
+    p + f'return std::move(run(ctx, tokenizer, {states_ids[cls.__state_tree__]}, TID___START__).value().template as<__START__>().value());'  # nopep8
+    p > '}'
+    for symbol, (state, wrapper) in cls.__entries__.items():
+        p + ''
+        p < f'typename {wrapper.name}::ResultType parse(Context& ctx, Tokenizer& tokenizer, playlang::StartSymbol<{symbol.name}>) {{'  # nopep8
+        p + f'return std::move(run(ctx, tokenizer, {states_ids[state]}, TID_{wrapper.fullname}).value().template as<{wrapper.name}>().value());'  # nopep8
+        p > '}'
+    p > ''
+    p < 'private:'
+    p < 'Tokenizer::TokenValueType run(Context& ctx, Tokenizer& tokenizer, int initial, int start) {'
     p + 'typedef Tokenizer::ValueType ValueType;'
     p + 'typedef Tokenizer::TokenValueType TokenValueType;'
-    p + f'std::stack<int> state_stack{{}};'
-    p + f'state_stack.push({states_ids[cls.__state_tree__]});'
-    p + f'playlang::TokenReader<Tokenizer> token_reader{{tokenizer}};'  # nopep8
+    p + 'std::vector<int>& state_stack = _state_stack;'
+    p + 'state_stack.clear();'
+    p + 'state_stack.push_back(initial);'
+    p + f'playlang::TokenReader<Tokenizer> token_reader{{tokenizer, _value_stack, start}};'  # nopep8
     p + 'TokenValueType* lookahead = token_reader.peek();'
 
     p < 'while(!token_reader.done()) {'
 
-    p < 'switch(state_stack.top()) {'
+    p < 'switch(state_stack.back()) {'
     for state in state_list:
         p < f'case {states_ids[state]}:'
 
@@ -360,8 +485,11 @@ public:
 
         if len(state.branchs) > 0:
             for ts, st in state.branchs.items():
+                # the symbols of the unit rules skipped by the tables have
+                # other types, see PassThrough
+                st = cls.__shortcuts__.get((state, ts), (st,))[0]
                 p + f'case TID_{ts.fullname}:'
-                p << f'state_stack.push({states_ids[st]});'
+                p << f'state_stack.push_back({states_ids[st]});'
                 p + 'if (lookahead->token() < 20000) { token_reader.read(); }'
                 p + 'lookahead = token_reader.peek();'
                 p >> 'break;'
@@ -371,12 +499,12 @@ public:
         if state.reduce_rule is not None:
             fullname = state.reduce_rule.symbol.fullname
             targs = [
-                state.reduce_rule.symbol.name,
+                _type_name(state.reduce_rule.symbol),
                 'Context'
             ]
-            targs.extend([x.name for x in state.reduce_rule])
+            targs.extend([_type_name(x) for x in state.reduce_rule])
             p + f'token_reader.produce<{", ".join(targs)}>(ctx, TID_{fullname});';
-            p + f'for(int i = 0 ; i < {len(state.reduce_rule)}; ++i) {{ state_stack.pop(); }}'
+            p + f'state_stack.resize(state_stack.size() - {len(state.reduce_rule)});'
             p + 'lookahead = &token_reader.top();'
         else:
             p + 'if (lookahead->token() < 20000 && lookahead->token() > 10000)'
@@ -387,20 +515,8 @@ public:
             p + 'break;'
             p > '}'
 
-            count = len(state.immediate_tokens)
-            message = ""
-
-            if count == 1:
-                message = f', expecting {state.immediate_tokens[0].show_name}'
-            elif count == 2:
-                message = f', expecting {state.immediate_tokens[0].show_name} or {state.immediate_tokens[1].show_name}'
-            else:
-                message = f', expecting one of [{" ".join([t.show_name for t in state.immediate_tokens])}]'
-
-            p + 'std::ostringstream oss;'
-            # p + 'if (lookahead->_location.valid()) { oss << lookahead->location().to_string() << " => "; }'  # nopep8
-            p + f'oss << "unexpected token " << get_token_name(lookahead->token()) << "{message}";'
-            p + 'throw playlang::SyntaxError(oss.str());'
+            tids = tuple(f'TID_{t.fullname}' for t in state.immediate_tokens)
+            p + f'throw playlang::UnexpectedTokenError(lookahead->token(), lookahead->location(), &_expected_table[{expected[tids]}], get_token_name);'  # nopep8
 
         p >> 'break;'
         p > '}'
@@ -409,7 +525,7 @@ public:
 
     p > '}'
     p > '}'  # while
-    p + 'return std::move(token_reader.pop().value().as<__START__>().value());'
+    p + 'return token_reader.pop();'
     p > '}'  # function
 
     p > '};'
@@ -430,6 +546,7 @@ def generate(cls, argv=None):
     argp.add_argument('--flex', required=False, help='output file name of flex file. see https://github.com/westes/flex.git')
     argp.add_argument('--tokenizer', required=True, help='output file name of tokenizer')
     argp.add_argument('--statefull-tokenizer', type=str, default='', help='state class name. generated tokenizer will inherit this class')
+    argp.add_argument('--stack-reserve', type=int, default=64, help='initial capacity of the parser stacks')
     argp.add_argument('--custom-tokenizer', type=bool, default=False, help='use custom lexer. we use flex lexer by default')
     args = argp.parse_args(argv)
     
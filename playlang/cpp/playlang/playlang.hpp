@@ -3,12 +3,21 @@
 #ifndef __playlang_playlang_hpp__
 #define __playlang_playlang_hpp__
 
-#include <array>
+#include <cstddef>
+#include <cstdint>
+#include <cstdlib>
+#include <new>
 #include <sstream>
 #include <stack>
+#include <stdexcept>
 #include <string>
 #include <tuple>
 #include <utility>
+#include <vector>
+
+#if __cplusplus >= 201703L
+#include <string_view>
+#endif
 
 #include "playlang/variant.hpp"
 
@@ -25,31 +34,90 @@ struct _make_index_sequence : _make_index_sequence<N-1, N-1, I...> { };
 template<size_t... I>
 struct _make_index_sequence<0, I...> : _index_sequence<I...> { };
 
-template<typename T, typename Context, typename Tuple, typename Array, size_t... Index>
+// the arguments are read where they are on the value stack
+template<typename T, typename Context, typename Tuple, typename TokenValue, size_t... Index>
 typename std::enable_if<not T::Contextful, T>::
-type build_with_args(Context& ctx, Array&& a, _index_sequence<Index...>)
+type build_with_args(Context& ctx, TokenValue* args, _index_sequence<Index...>)
 {
-    return T{a[Index].template as<typename std::tuple_element<Index,Tuple>::type>()...};
+    return T{args[Index].value().template as<typename std::tuple_element<Index,Tuple>::type>()...};
 }
 
-template<typename T, typename Context, typename Tuple, typename Array, size_t... Index>
+template<typename T, typename Context, typename Tuple, typename TokenValue, size_t... Index>
 typename std::enable_if<T::Contextful, T>::
-type build_with_args(Context& ctx, Array&& a, _index_sequence<Index...>)
+type build_with_args(Context& ctx, TokenValue* args, _index_sequence<Index...>)
 {
-    return T{ctx, a[Index].template as<typename std::tuple_element<Index,Tuple>::type>()...};
+    return T{ctx, args[Index].value().template as<typename std::tuple_element<Index,Tuple>::type>()...};
 }
 
-template<typename T, typename Context, typename Tuple, typename Array>
-T build(Context& ctx, Array&& a) {
-   constexpr static size_t N = std::tuple_size<typename std::decay<Array>::type>::value;
-   return build_with_args<T, Context, Tuple>(
-       ctx,
-       std::forward<Array>(a), 
-       _make_index_sequence<N>{});
+template<typename T, typename Context, typename Tuple, typename TokenValue>
+T build(Context& ctx, TokenValue* args) {
+   constexpr static size_t N = std::tuple_size<Tuple>::value;
+   return build_with_args<T, Context, Tuple>(ctx, args, _make_index_sequence<N>{});
 }
 
 } // namespace detail
 
+#if __cplusplus >= 201703L
+typedef std::string_view StringView;
+#else
+// text of a token in the input buffer of the tokenizer, same as
+// std::string_view in C++17
+class StringView {
+    const char* _data { nullptr };
+    size_t _size { 0 };
+
+public:
+    constexpr StringView() = default;
+    constexpr StringView(const char* data, size_t size)
+        : _data(data)
+        , _size(size)
+    {
+    }
+
+    constexpr const char* data() const { return _data; }
+    constexpr size_t size() const { return _size; }
+    constexpr size_t length() const { return _size; }
+    constexpr bool empty() const { return _size == 0; }
+    constexpr const char* begin() const { return _data; }
+    constexpr const char* end() const { return _data + _size; }
+    constexpr char operator[](size_t idx) const { return _data[idx]; }
+
+    char at(size_t idx) const
+    {
+        if (idx >= _size) {
+            throw std::out_of_range("playlang::StringView::at");
+        }
+        return _data[idx];
+    }
+
+    explicit operator std::string() const { return { _data, _size }; }
+
+    bool operator==(const StringView& other) const
+    {
+        return _size == other._size and std::char_traits<char>::compare(_data, other._data, _size) == 0;
+    }
+
+    bool operator!=(const StringView& other) const { return not(*this == other); }
+};
+#endif
+
+// Token structs constructible from a StringView get the text without a
+// copy, it is valid until the tokenizer reads the next token. Other tokens
+// are constructed from the tokenizer, e.g. its std::string conversion.
+template <typename T, typename Tokenizer>
+typename std::enable_if<std::is_constructible<T, StringView>::value, T>::
+type make_token(Tokenizer& tokenizer)
+{
+    return T{tokenizer.view()};
+}
+
+template <typename T, typename Tokenizer>
+typename std::enable_if<not std::is_constructible<T, StringView>::value, T>::
+type make_token(Tokenizer& tokenizer)
+{
+    return T{tokenizer};
+}
+
 struct Location {
     int _line_number;
     int _column;
@@ -123,6 +191,163 @@ public:
 template <typename T, bool Context = false>
 using Symbol = Token<T, Context>;
 
+// symbols of Many/Many1 and SepBy/SepBy1, the items are appended to one
+// vector, e.g. a constructor of a symbol for Rule(Many1(ITEM)) takes a Many1<ITEM>&
+template <typename T>
+struct Many1 : public Symbol<std::vector<typename T::ValueType>> {
+    typedef std::vector<typename T::ValueType> ValueType;
+
+    explicit Many1(T& item)
+        : Symbol<ValueType>(ValueType {})
+    {
+        this->value().push_back(std::move(item.value()));
+    }
+
+    Many1(Many1& items, T& item)
+        : Symbol<ValueType>(std::move(items.value()))
+    {
+        this->value().push_back(std::move(item.value()));
+    }
+};
+
+template <typename T, typename S>
+struct SepBy1 : public Symbol<std::vector<typename T::ValueType>> {
+    typedef std::vector<typename T::ValueType> ValueType;
+
+    explicit SepBy1(T& item)
+        : Symbol<ValueType>(ValueType {})
+    {
+        this->value().push_back(std::move(item.value()));
+    }
+
+    SepBy1(SepBy1& items, S&, T& item)
+        : Symbol<ValueType>(std::move(items.value()))
+    {
+        this->value().push_back(std::move(item.value()));
+    }
+};
+
+// selects the start symbol of Parser::parse, e.g. parse(ctx, tokenizer, StartSymbol<EXPR>{})
+template <typename T>
+struct StartSymbol { };
+
+// Bump allocator for semantic values, memory is released by reset() or
+// the destructor. Destructors of the allocated objects are not called.
+class Arena {
+    struct Block {
+        Block* next;
+        size_t size;
+    };
+
+    Block* _blocks { nullptr };
+    char* _ptr { nullptr };
+    char* _end { nullptr };
+    size_t _block_size;
+
+    void grow(size_t size)
+    {
+        size_t block_size = _block_size;
+        if (size + sizeof(Block) > block_size) {
+            block_size = size + sizeof(Block);
+        }
+        auto* block = static_cast<Block*>(std::malloc(block_size));
+        if (block == nullptr) {
+            throw std::bad_alloc();
+        }
+        block->next = _blocks;
+        block->size = block_size;
+        _blocks = block;
+        _ptr = reinterpret_cast<char*>(block + 1);
+        _end = reinterpret_cast<char*>(block) + block_size;
+    }
+
+public:
+    explicit Arena(size_t block_size = 64 * 1024)
+        : _block_size(block_size)
+    {
+    }
+
+    ~Arena() { release(); }
+
+    Arena(const Arena&) = delete;
+    Arena& operator=(const Arena&) = delete;
+
+    void* allocate(size_t size, size_t align = alignof(std::max_align_t))
+    {
+        auto p = (reinterpret_cast<uintptr_t>(_ptr) + align - 1) & ~(uintptr_t)(align - 1);
+        if (_ptr == nullptr or p + size > reinterpret_cast<uintptr_t>(_end)) {
+            grow(size + align);
+            p = (reinterpret_cast<uintptr_t>(_ptr) + align - 1) & ~(uintptr_t)(align - 1);
+        }
+        _ptr = reinterpret_cast<char*>(p + size);
+        return reinterpret_cast<void*>(p);
+    }
+
+    template <typename T, typename... Args>
+    T* create(Args&&... args)
+    {
+        return new (allocate(sizeof(T), alignof(T))) T(std::forward<Args>(args)...);
+    }
+
+    // keep the newest block for the next parse
+    void reset()
+    {
+        if (_blocks == nullptr) {
+            return;
+        }
+        Block* keep = _blocks;
+        _blocks = keep->next;
+        release();
+        keep->next = nullptr;
+        _blocks = keep;
+        _ptr = reinterpret_cast<char*>(keep + 1);
+        _end = reinterpret_cast<char*>(keep) + keep->size;
+    }
+
+    void release()
+    {
+        while (_blocks) {
+            Block* next = _blocks->next;
+            std::free(_blocks);
+            _blocks = next;
+        }
+        _ptr = _end = nullptr;
+    }
+};
+
+// std allocator backed by an Arena, e.g. for std::vector<T, ArenaAllocator<T>>
+template <typename T>
+class ArenaAllocator {
+    template <typename U>
+    friend class ArenaAllocator;
+
+    Arena* _arena;
+
+public:
+    typedef T value_type;
+
+    explicit ArenaAllocator(Arena& arena) noexcept
+        : _arena(&arena)
+    {
+    }
+
+    template <typename U>
+    ArenaAllocator(const ArenaAllocator<U>& other) noexcept
+        : _arena(other._arena)
+    {
+    }
+
+    T* allocate(size_t n) { return static_cast<T*>(_arena->allocate(n * sizeof(T), alignof(T))); }
+
+    void deallocate(T*, size_t) noexcept { }
+
+    template <typename U>
+    bool operator==(const ArenaAllocator<U>& other) const noexcept { return _arena == other._arena; }
+
+    template <typename U>
+    bool operator!=(const ArenaAllocator<U>& other) const noexcept { return _arena != other._arena; }
+};
+
 template <typename Tokenizer>
 class TokenReader {
     typedef typename Tokenizer::TokenValueType TokenValueType;
@@ -130,23 +355,38 @@ class TokenReader {
 
     Tokenizer& _tokenizer;
 
-    std::stack<TokenValueType> _stack {};
+    // contiguous value stack, may be owned by the caller to be reused
+    std::vector<TokenValueType> _own_stack {};
+    std::vector<TokenValueType>& _stack;
     TokenValueType _next_token {};
+    // token id of the start symbol wrapper, see done()
+    int _start { Tokenizer::TokenID_START };
 
     TokenValueType _read() { return _tokenizer.read(); }
 
 public:
-    explicit TokenReader(Tokenizer& tokenizer)
+    explicit TokenReader(Tokenizer& tokenizer, size_t reserve = 64)
         : _tokenizer(tokenizer)
+        , _stack(_own_stack)
     {
+        _stack.reserve(reserve);
+    }
+
+    TokenReader(Tokenizer& tokenizer, std::vector<TokenValueType>& stack,
+        int start = Tokenizer::TokenID_START)
+        : _tokenizer(tokenizer)
+        , _stack(stack)
+        , _start(start)
+    {
+        _stack.clear();
     }
 
     bool done()
     {
-        return _stack.size() == 1 and _stack.top().token() == Tokenizer::TokenID_START;
+        return _stack.size() == 1 and _stack.back().token() == _start;
     }
 
-    TokenValueType& top() { return _stack.top(); }
+    TokenValueType& top() { return _stack.back(); }
 
     TokenValueType* peek()
     {
@@ -160,47 +400,47 @@ public:
 
     void read()
     {
-        auto t = std::move(_next_token);
-        if (t.empty()) {
-            t = _read();
+        if (_next_token.empty()) {
+            _stack.emplace_back(_read());
+        } else {
+            _stack.emplace_back(std::move(_next_token));
+            _next_token = {};
         }
-        _stack.emplace(std::move(t));
     }
 
     template <typename V>
     void consume(size_t n, V& output)
     {
-        if (n == 0) {
-            return;
-        }
         while (n) {
-            output.emplace_back(std::move(_stack.top()));
-            _stack.pop();
+            output.emplace_back(std::move(_stack.back()));
+            _stack.pop_back();
+            --n;
         }
     }
 
-    void commit(TokenValueType&& tv) { _stack.emplace(std::move(tv)); }
+    void commit(TokenValueType&& tv) { _stack.emplace_back(std::move(tv)); }
 
     TokenValueType pop()
     {
-        auto tv = std::move(_stack.top());
-        _stack.pop();
-        return std::move(tv);
+        auto tv = std::move(_stack.back());
+        _stack.pop_back();
+        return tv;
     }
 
-    void push(TokenValueType&& tv) { _stack.emplace(std::move(tv)); }
+    void push(TokenValueType&& tv) { _stack.emplace_back(std::move(tv)); }
 
+    // The symbol is built from the values on the stack, then moved once into
+    // the slot of the first argument
     template <typename T, typename Context, typename... C>
     void produce(Context& ctx, int token)
     {
         constexpr static size_t N = sizeof...(C);
-        std::array<ValueType, N> args {};
-        for (size_t i = 0; i < N; ++i) {
-            args[N - i - 1] = std::move(pop().value());
-        }
         typedef std::tuple<C...> Tuple;
-        push({ _tokenizer.location(),
-            ValueType { detail::build<T, Context, Tuple>(ctx, args) }, token });
+        assert(_stack.size() >= N);
+        T result = detail::build<T, Context, Tuple>(ctx, _stack.data() + (_stack.size() - N));
+        _stack.erase(_stack.end() - N, _stack.end());
+        _stack.emplace_back(_tokenizer.location(), token);
+        _stack.back().value().template emplace<T>(std::move(result));
     }
 };
 
@@ -224,6 +464,13 @@ public:
     {
     }
 
+    // empty value, see TokenReader::produce
+    TokenValue(const Location& loc, int token)
+        : _location(loc)
+        , _token(token)
+    {
+    }
+
     TokenValue(const TokenValue&) = default;
     TokenValue(TokenValue&&) noexcept = default;
     TokenValue& operator=(const TokenValue&) = default;
@@ -253,6 +500,61 @@ public:
     using PlaylangError::PlaylangError;
 };
 
+// The message is formatted when what() is called for the first time
+class UnexpectedTokenError : public SyntaxError {
+    int _token;
+    Location _location;
+    const int* _expected; // zero terminated
+    const char* (*_token_name)(int);
+    mutable std::string _message {};
+
+public:
+    UnexpectedTokenError(int token, const Location& location,
+        const int* expected, const char* (*token_name)(int))
+        : SyntaxError("unexpected token")
+        , _token(token)
+        , _location(location)
+        , _expected(expected)
+        , _token_name(token_name)
+    {
+    }
+
+    int token() const { return _token; }
+    const Location& location() const { return _location; }
+    const int* expected() const { return _expected; }
+
+    const char* what() const noexcept override
+    {
+        if (_message.empty()) {
+            try {
+                size_t count = 0;
+                while (_expected[count] != 0) {
+                    ++count;
+                }
+
+                std::ostringstream oss;
+                oss << "unexpected token " << _token_name(_token);
+                if (count == 1) {
+                    oss << ", expecting " << _token_name(_expected[0]);
+                } else if (count == 2) {
+                    oss << ", expecting " << _token_name(_expected[0])
+                        << " or " << _token_name(_expected[1]);
+                } else {
+                    oss << ", expecting one of [";
+                    for (size_t i = 0; i < count; ++i) {
+                        oss << (i ? " " : "") << _token_name(_expected[i]);
+                    }
+                    oss << "]";
+                }
+                _message = oss.str();
+            } catch (...) {
+                return SyntaxError::what();
+            }
+        }
+        return _message.c_str();
+    }
+};
+
 } // namespace playlang
 
 #endif
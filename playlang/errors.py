@@ -11,3 +11,92 @@ class ConflictShiftReduceError(ConflictError):
 
 class ConflictReduceReduceError(ConflictError):
     pass
+
+
+class UnexpectedTokenError(SyntaxError):
+    """Syntax error with the offending token and the expected token set.
+
+    The message is formatted when it is read for the first time.
+    """
+
+    def __init__(self, lookahead, state):
+        location = lookahead.location
+        if location is None:
+            super().__init__(None)
+        else:
+            # the details of SyntaxError, the message stays unformatted
+            super().__init__(None, (location.filename, location.line, location.column, None))
+        self.token = lookahead.token
+        self.value = lookahead.value
+        self.location = lookahead.location
+        self._state = state
+        self._msg = None
+
+    @property
+    def expected(self):
+        return self._state.immediate_tokens
+
+    @property
+    def expected_ids(self):
+        """bit indexes of `Parser.__token_ids__`"""
+        mask = self._state.expected
+        return tuple(i for i in range(mask.bit_length()) if mask >> i & 1)
+
+    @property
+    def msg(self):
+        # pylint: disable=line-too-long
+        if self._msg is None:
+            expected = self._state.immediate_tokens
+            count = len(expected)
+            location = ""
+            message = ""
+
+            if self.location is not None:
+                loc = self.location
+                location = f'{loc.filename}{loc.line}:{loc.column} => '
+
+            if count == 1:
+                message = f', expecting {expected[0].show_name}'
+            elif count == 2:
+                message = f', expecting {expected[0].show_name} or {expected[1].show_name}'
+            else:
+                message = f', expecting one of [{" ".join([t.show_name for t in expected])}]'
+
+            self._msg = f'{location}unexpected token {self.token.show_name}({self.value}){message}'
+        return self._msg
+
+    def __str__(self):
+        return self.msg
+
+    def __reduce__(self):
+        # the tables are not pickled, the tokens are replaced by copies
+        # without actions and rules
+        expected = _Expected(tuple(_portable(t) for t in self._state.immediate_tokens),
+                             self._state.expected)
+        return _restore, (type(self), _portable(self.token), self.value, self.location,
+                          expected, self._msg)
+
+
+class _Expected:
+    # what UnexpectedTokenError reads from a State
+    def __init__(self, immediate_tokens, expected):
+        self.immediate_tokens = immediate_tokens
+        self.expected = expected
+
+
+def _portable(token):
+    from playlang.classes import Terminal, Symbol  # pylint: disable=import-outside-toplevel
+    data = {k: v for k, v in token.data.items() if v is None or isinstance(v, (str, int))}
+    if isinstance(token, Terminal):
+        copy = Terminal(token.name, token.fullname, token.precedence)
+    else:
+        copy = Symbol(token.name, token.fullname)
+    copy.data.update(data)
+    return copy
+
+
+def _restore(cls, token, value, location, expected, msg):
+    from playlang.classes import TokenValue  # pylint: disable=import-outside-toplevel
+    error = cls(TokenValue(token, value, location), expected)
+    error._msg = msg
+    return error
@@ -4,19 +4,26 @@
 # pylint: disable=pointless-statement,expression-not-assigned,line-too-long
 
 import re
+import json
 from playlang.classes import SymbolInfo, TokenInfo
 from playlang.printer import Printer
 
 
+def _pass_through(rule):
+    return rule.extra_info.get('pass_through') or \
+        rule.extra_info.get('javascript', '').strip() == 'return $1'
+
+
 def _generate(parser, file, prefix):
     scan_info = parser.__scanners__  # type: dict
     p = Printer(file)
     p + '''// Copyright (C) 2023 pom@vro.life
 // SPDX-License-Identifier: MIT OR LGPL-3.0-only OR GPL-2.0-only OR GPL-3.0-only'''
     p + '// generated code'
-    p + 'import { TokenReader, SyntaxError, create_scanner } from "./playlang.js"'
+    p + 'import { TokenReader, UnexpectedTokenError, create_scanner, delimited } from "./playlang.js"'
 
     show_name = {}
+    ids = {}
 
     # generate ids
 
@@ -34,6 +41,7 @@ def _generate(parser, file, prefix):
         tid = next_tid + (10000 if token.ignorable else 0)
         p + f'const {token.fullname} = {tid}'  # nopep8
         show_name[tid] = token.show_name
+        ids[token] = tid
         next_tid += 1
 
     assert next_tid < 20000
@@ -41,7 +49,8 @@ def _generate(parser, file, prefix):
 
     for symbol in parser.__symbols__:
         p + f'const {symbol.fullname} = {next_tid}'
-        show_name[tid] = symbol.show_name
+        show_name[next_tid] = symbol.show_name
+        ids[symbol] = next_tid
         next_tid += 1
 
     # generate show name
@@ -56,15 +65,13 @@ def _generate(parser, file, prefix):
     p < 'const capture = {'
     for condition, scanner in scan_info.items():
         for token in scanner.tokens:
-            if token.capture:
+            if scanner.captures(token):
                 pattern, discard, fullname = map(
                     token.data.get, ('pattern', 'discard', 'fullname'))
                 action = token.data.get('javascript', 'return ctx.text')
                 p + f'"{condition}": [{fullname}, {bool(discard).numerator}, (ctx) => {{ {action} }}],'  # nopep8
     p > '}'
 
-    r = re.compile(r'(?:[^\\]|^)\(')
-
     regexps = {}
     p + ''
     p < 'const actions = {'
@@ -75,10 +82,18 @@ def _generate(parser, file, prefix):
         p < f'"{condition}": {{'
         for token in scanner.tokens:
             action = token.data.get('javascript', 'return ctx.text')
-            pattern, discard, fullname = map(
-                token.data.get, ('pattern', 'discard', 'fullname'))
+            pattern, discard, fullname, region = map(
+                token.data.get, ('pattern', 'discard', 'fullname', 'delimited'))
+
+            if region is not None and 'javascript' not in token.data:
+                open_, close, escape, close_at_eof = region
+                escape = 'undefined' if escape is None else json.dumps(escape)
+                if close_at_eof:
+                    action = f'return delimited(ctx.text, {len(open_)}, {len(close)}, {escape}, {json.dumps(close)})'
+                else:
+                    action = f'return delimited(ctx.text, {len(open_)}, {len(close)}, {escape})'
 
-            if token.capture:
+            if scanner.captures(token):
                 continue
 
             if token.is_eof:
@@ -89,7 +104,7 @@ def _generate(parser, file, prefix):
 
             p + f'{group}:[{fullname}, {bool(discard).numerator}, (ctx) => {{ {action} }}],'  # nopep8
             buf.append(f'({pattern})')
-            group += len(r.findall(pattern)) + 1
+            group += re.compile(pattern).groups + 1
         p > '},'
 
         regexps[condition] = '|'.join(buf)
@@ -109,10 +124,36 @@ def _generate(parser, file, prefix):
     for idx, state in enumerate(state_list):
         states_ids[state] = idx
 
+    # expected tokens of error states, shared by all states with the same set
+    expected = {}
+    for state in state_list:
+        if state.reduce_rule is None:
+            expected.setdefault(tuple(ids[t] for t in state.immediate_tokens), len(expected))
+
+    p + ''
+    p < 'const expected = ['
+    for tids in expected:
+        p + f'[{", ".join([str(tid) for tid in tids])}],'
+    p > ']'
+
+    # initial state and wrapper symbol of the other start symbols
+    wrappers = {parser.__start_wrapper__}
     p + ''
-    p < f'export function {prefix}parse(tokenizer, context) {{'
-    p + f'const state_stack = [{states_ids[parser.__state_tree__]}]'
-    p + f'const token_reader = new TokenReader(tokenizer, {parser.__start_wrapper__.name}, __EOF__)'  # nopep8
+    p < 'const entries = {'
+    for symbol, (state, wrapper) in parser.__entries__.items():
+        wrappers.add(wrapper)
+        p + f'"{symbol.name}": [{states_ids[state]}, {wrapper.fullname}],'
+    p > '}'
+
+    p + ''
+    p < f'export function {prefix}parse(tokenizer, context, start) {{'
+    p + f'var entry = [{states_ids[parser.__state_tree__]}, {parser.__start_wrapper__.fullname}]'
+    p < 'if (start !== undefined && start !== "' + parser.__start_symbol__.name + '") {'
+    p + 'entry = entries[start]'
+    p + 'if (entry === undefined) throw new Error(`${start} is not a start symbol`)'
+    p > '}'
+    p + 'const state_stack = [entry[0]]'
+    p + f'const token_reader = new TokenReader(tokenizer, entry[1], {parser.__scanners__["__default__"].eof_token.fullname})'  # nopep8
     p + 'var lookahead = token_reader.peek()'
 
     p < 'while(!token_reader.done()) {'
@@ -125,6 +166,10 @@ def _generate(parser, file, prefix):
 
         if len(state.branchs) > 0:
             for ts, st in state.branchs.items():
+                # unit rules skipped by the tables, see PassThrough
+                shortcut = parser.__shortcuts__.get((state, ts))
+                if shortcut is not None and not all(_pass_through(rule) for rule in shortcut[1]):
+                    st = shortcut[0]
                 p + f'case {ts.fullname}:'
                 p << f'state_stack.push({states_ids[st]})'
                 p + 'if (lookahead[0] < 20000) token_reader.read()'
@@ -141,11 +186,18 @@ def _generate(parser, file, prefix):
                 p + f'token_reader.commit([{fullname}, undefined])'  # nopep8
             else:
                 p + f'const args = token_reader.consume({len(state.reduce_rule)}).map(tv => tv[1])'   # nopep8
-                if state.reduce_rule.symbol.name != '__START__':
-                    code, func = map(state.reduce_rule.extra_info.get,
-                                     ('javascript', 'javascript_function'))
+                if state.reduce_rule.symbol not in wrappers:
+                    code, func, defaults = map(state.reduce_rule.extra_info.get,
+                                               ('javascript', 'javascript_function', 'defaults'))
+                    if state.reduce_rule.extra_info.get('pass_through'):
+                        # see PassThrough
+                        code, func, defaults = 'return $1', None, None
+                    # optional components left out of the rule, see Many and Optional
+                    for idx, kind in defaults or ():
+                        p + f'args.splice({idx}, 0, {"undefined" if kind == "Optional" else "[]"})'
+                    count = len(state.reduce_rule) + len(defaults or ())
                     if code is not None:
-                        p < f'function action({", ".join([f"${x+1}" for x in range(len(state.reduce_rule))])}) {{'
+                        p < f'function action({", ".join([f"${x+1}" for x in range(count)])}) {{'
                         p + code
                         p > '}'
                     elif func is not None:
@@ -168,20 +220,8 @@ def _generate(parser, file, prefix):
             p + 'break'
             p > '}'
 
-            count = len(state.immediate_tokens)
-            message = ""
-
-            if count == 1:
-                message = f', expecting {state.immediate_tokens[0].show_name}'
-            elif count == 2:
-                message = f', expecting {state.immediate_tokens[0].show_name} or {state.immediate_tokens[1].show_name}'
-            else:
-                message = f', expecting one of [{" ".join([t.show_name for t in state.immediate_tokens])}]'
-
-            p + 'const [token, value, loc] = lookahead'
-            p + 'var location = ""'
-            p + 'if (loc !== undefined) { location = `${loc.filename}${loc.line}:${loc.column} => ` }'  # nopep8
-            p + f'throw new SyntaxError(`${{location}}unexpected token ${{show_name[token]}}(${{value}}){message}`)'  # nopep8
+            tids = tuple(ids[t] for t in state.immediate_tokens)
+            p + f'throw new UnexpectedTokenError(lookahead, expected[{expected[tids]}], show_name)'  # nopep8
 
         p >> 'break'
         p > '}'
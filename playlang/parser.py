@@ -1,10 +1,19 @@
 # Copyright (C) 2023 pom@vro.life
 # SPDX-License-Identifier: LGPL-3.0-only OR GPL-2.0-only OR GPL-3.0-only
+import sys
+import copy
+import time
+import operator
+import functools
+import itertools
 from typing import List, Dict
 from playlang.classes import TokenValue, Symbol, \
     Terminal, SymbolInfo, Precedence, SymbolRule, \
-    StaticField, Scanner, Start, State, TokenInfo
-from playlang.syntex import Syntax
+    StaticField, Scanner, Start, State, TokenInfo, Memoize, Lazy, ParallelList, Combinator, \
+    _free_threaded
+from playlang.syntex import Syntax, _reduce_start_symbol
+from playlang.errors import UnexpectedTokenError
+from playlang.printer import Printer
 
 
 class TokenReader:
@@ -58,6 +67,21 @@ class TokenReader:
     def push(self, tv):
         self._stack.append(tv)
 
+    def copy(self):
+        reader = type(self)(self._scanner, self._start)
+        reader._stack = self._stack[:]
+        reader._next_token = self._next_token
+        return reader
+
+
+class PushTokenReader(TokenReader):
+    def _read(self):
+        # no input available, _parse will return and wait for feed()
+        return None
+
+    def feed(self, tv):
+        self._next_token = tv
+
 
 class StateStack:
     def __init__(self, initial):
@@ -76,12 +100,86 @@ class StateStack:
     def push(self, state):
         self._stack.append(state)
 
+    def __len__(self):
+        return len(self._stack)
+
+    def copy(self):
+        stack = StateStack(None)
+        stack._stack = self._stack[:]
+        return stack
+
+
+class StateTables:
+    """Parse tables of State objects
+
+    The interface of the tables read by _parse, FlatTables implements it
+    for a flat buffer with integer states.
+    """
+    # (state, token) -> next state or None
+    goto = staticmethod(State.get_branch)
+    # state -> rule or None
+    reduce_rule = staticmethod(operator.attrgetter('reduce_rule'))
+
+    @staticmethod
+    def expected(state):
+        """What UnexpectedTokenError reads from a state"""
+        return state
+
+
+class ErrorRecovery:
+    """yacc style error recovery
+
+    On a syntax error the diagnostic is recorded, states are popped until one
+    can shift the error token (`Token(is_error=True)`), and input tokens are
+    discarded until the parser can continue. Errors raised before any token
+    has been consumed since the last recovery are not recorded again.
+    """
+
+    def __init__(self, error_token, errors, max_errors, tables=StateTables):
+        self._error_token = error_token
+        self._errors = errors
+        self._max_errors = max_errors
+        self._goto = tables.goto
+        self._error_state = None
+        self._lookahead = None
+
+    def recover(self, token_reader, state_stack, lookahead, error):
+        if lookahead is self._lookahead or state_stack.top() == self._error_state:
+            # no progress since the last recovery, skip the token
+            if lookahead.token.is_eof:
+                raise error
+            token_reader.discard()
+            self._lookahead = token_reader.peek()
+            return self._lookahead
+
+        self._errors.append(error)
+        if len(self._errors) >= self._max_errors:
+            raise error
+
+        while self._goto(state_stack.top(), self._error_token) is None:
+            if len(state_stack) == 1:
+                raise error
+            state_stack.pop()
+            token_reader.pop()
+
+        self._error_state = self._goto(state_stack.top(), self._error_token)
+        token_reader.push(TokenValue(self._error_token, error, lookahead.location))
+        state_stack.push(self._error_state)
+        self._lookahead = lookahead
+        return lookahead
+
 
-def _parse(token_reader, state_stack, context):
+def _parse(token_reader, state_stack, context, recovery=None, emitted=None, tables=StateTables,
+           build=None):
+    # build(rule, token values) replaces the rule actions, see parse_tree
+    goto = tables.goto
+    reduce_rule = tables.reduce_rule
     lookahead = token_reader.peek()
+    if lookahead is None:
+        return False
     while not token_reader.done():
         current_state = state_stack.top()
-        branch = current_state.get_branch(lookahead.token)
+        branch = goto(current_state, lookahead.token)
 
         if branch is not None:
             # shift
@@ -89,11 +187,15 @@ def _parse(token_reader, state_stack, context):
                 token_reader.read()
             state_stack.push(branch)
             lookahead = token_reader.peek()
+            if lookahead is None:
+                return False
         else:
-            if current_state.reduce_rule is not None:
+            rule = reduce_rule(current_state)
+            if rule is not None:
                 # reduce
-                rule = current_state.reduce_rule
-                if rule.action is not None:
+                if build is not None:
+                    value = build(rule, token_reader.consume(len(rule)))
+                elif rule.action is not None:
                     args = [context]
                     for tv in token_reader.consume(len(rule)):
                         args.append(tv.value)
@@ -101,69 +203,600 @@ def _parse(token_reader, state_stack, context):
                 else:
                     token_reader.consume(len(rule))
                     value = None
+                if emitted is not None and rule.emit:
+                    emitted.append(value)
+                    value = None
                 token_reader.commit(TokenValue(rule.symbol, value))
                 state_stack.pop(len(rule))
                 lookahead = token_reader.top()
             else:
-                # pylint: disable=line-too-long
                 if isinstance(lookahead.token, Terminal) and lookahead.token.ignorable:
                     token_reader.discard()
                     lookahead = token_reader.peek()
+                    if lookahead is None:
+                        return False
                     continue
 
-                count = len(current_state.immediate_tokens)
-                location = ""
-                message = ""
+                error = UnexpectedTokenError(lookahead, tables.expected(current_state))
+                if recovery is None:
+                    raise error
+                lookahead = recovery.recover(token_reader, state_stack, lookahead, error)
+                if lookahead is None:
+                    return False
+    return True
 
-                if lookahead.location is not None:
-                    loc = lookahead.location
-                    location = f'{loc.filename}{loc.line}:{loc.column} => '
 
-                if count == 1:
-                    message = f', expecting {current_state.immediate_tokens[0].show_name}'
-                elif count == 2:
-                    message = f', expecting {current_state.immediate_tokens[0].show_name} or {current_state.immediate_tokens[1].show_name}'
-                else:
-                    message = f', expecting one of [{" ".join([t.show_name for t in current_state.immediate_tokens])}]'
+def _iterparse(scanner, state, wrapper, context, recovery, tables=StateTables):
+    emitted = []
+    token_reader = PushTokenReader(None, wrapper)
+    state_stack = StateStack(state)
+    for tv in scanner:
+        token_reader.feed(tv)
+        done = _parse(token_reader, state_stack, context, recovery, emitted, tables)
+        yield from emitted
+        emitted.clear()
+        if done:
+            return token_reader.pop().value
+    return None
+
+
+class PushParser:
+    """Parser driven by the caller, one token at a time.
+
+    All parsing state lives in this object, so any number of sessions
+    can be interleaved without a thread or a generator per session.
+    """
+
+    def __init__(self, parser, context, tokenizer=None, errors=None, max_errors=100, start=None):
+        state, wrapper = parser._entry(start)
+        self._parser = parser
+        self._context = context
+        self._tokenizer = tokenizer
+        self._recovery = parser._recovery(errors, max_errors)
+        self._token_reader = PushTokenReader(None, wrapper)
+        self._state_stack = StateStack(state)
+        self._done = False
+
+    @property
+    def done(self):
+        return self._done
+
+    def feed(self, tv: TokenValue):
+        """Feed one token. Return True once the start symbol is reduced"""
+        if self._done:
+            raise RuntimeError('parser already finished')
+        self._token_reader.feed(tv)
+        self._done = _parse(self._token_reader, self._state_stack,
+                            self._context, self._recovery)
+        return self._done
+
+    def feed_text(self, text, filename='<memory>'):
+        """Scan `text` with the tokenizer and feed the tokens.
+
+        Every chunk is scanned on its own, so it must end at a token boundary
+        in the `__default__` condition. The end of file token is sent by `finish`.
+        """
+        if self._tokenizer is None:
+            raise TypeError('feed_text requires a tokenizer')
+        for tv in self._tokenizer(text, filename, eof_stop=True):
+            if tv.token.is_eof:
+                break
+            self.feed(tv)
+
+    def finish(self):
+        eof_token = self._parser.__scanners__['__default__'].eof_token
+        while not self._done:
+            self.feed(TokenValue(eof_token, '__EOF__'))
+        return self._token_reader.top().value
+
+    def copy(self):
+        """Snapshot, the semantic values are shared with the copy but the
+        lists on the stack, the combinator rules append to them in place
+        """
+        parser = PushParser.__new__(PushParser)
+        parser._parser = self._parser
+        parser._context = self._context
+        parser._tokenizer = self._tokenizer
+        parser._recovery = copy.copy(self._recovery)
+        parser._token_reader = self._token_reader.copy()
+        parser._token_reader._stack = [
+            TokenValue(tv.token, copy.copy(tv.value), tv.location)
+            if isinstance(tv.value, list) else tv
+            for tv in parser._token_reader._stack]
+        parser._state_stack = self._state_stack.copy()
+        parser._done = self._done
+        return parser
+
+
+def _fingerprint(parser):
+    # the declared grammar, the rules of the start wrappers are added when
+    # the tables are built, see Syntax.generate
+    import hashlib  # pylint: disable=import-outside-toplevel
+    syntax = parser.__syntax__
+    h = hashlib.blake2b(digest_size=16)
+    for token in tuple(syntax.tokens.values()):
+        h.update(f'{token.fullname}\0{token.pattern}\0{token.precedence}\0'.encode())
+    for symbol in tuple(syntax.symbols.values()):
+        for rule in tuple(symbol.rules):
+            if rule.action is _reduce_start_symbol:
+                continue
+            components = ' '.join(c.fullname for c in rule)
+            h.update(f'{symbol.fullname}\0{components}\0{rule.precedence}\0'.encode())
+    for symbol in (parser.__start_symbol__, *parser.__start_symbols__):
+        h.update(f'start\0{symbol.fullname}\0'.encode())
+    return h.digest()
+
+
+def _expected_table(state_list, token_ids, reused=frozenset()):
+    index = {t: i for i, t in enumerate(token_ids)}
+    table = {}
+    for state in state_list:
+        mask = 0
+        for token in state.immediate_tokens:
+            mask |= 1 << index[token]
+        # share one int object per distinct set
+        mask = table.setdefault(mask, mask)
+        if state not in reused:
+            state.expected = mask
+    return tuple(table)
+
+
+_MISSING = object()
+
+
+def _parallel_list(syntax: Syntax, start_symbol, parallel: ParallelList):
+    symbol = parallel.symbol
+    separator = parallel.separator
+    if symbol is not start_symbol:
+        raise TypeError(f'ParallelList symbol {symbol} is not the start symbol')
+
+    first = step = None
+    for rule in symbol.rules:
+        components = tuple(rule)
+        if len(components) == 1 and first is None:
+            first = rule
+        elif len(components) == 3 and step is None and \
+                components[0] is symbol and components[1] is separator:
+            step = rule
+        else:
+            first = step = None
+            break
+    if first is None or step is None or tuple(first)[0] is not tuple(step)[2] or \
+            not isinstance(tuple(first)[0], Symbol):
+        raise TypeError(f'ParallelList requires the rules {symbol} -> ITEM and '
+                        f'{symbol} -> {symbol} {separator} ITEM')
+
+    for other in syntax.symbols.values():
+        for rule in other.rules:
+            if rule is not step and any(c is separator for c in rule):
+                raise TypeError(f'ParallelList separator {separator} is used by {rule}')
+    return first, step, separator
+
+
+def _inherit(dic, syntax: Syntax, base):
+    syntax.rewire()
+    symbols = syntax.symbols
+
+    def current(symbol):
+        return symbols.get(symbol.fullname, symbol)
+
+    for k, v in list(dic.items()):
+        if isinstance(v, Symbol) and current(v) is not v:
+            dict.__setitem__(dic, k, current(v))
+
+    # the start symbols are inherited unless the parser declares its own
+    start_symbols = dic.get('__start_symbols__', base.__start_symbols__)
+    start_symbols = [current(symbol) for symbol in start_symbols]
+    dict.__setitem__(dic, '__start_symbols__', start_symbols)
+    dict.__setitem__(dic, '__start_symbol__', start_symbols[0])
+
+    parallel = dic.get('__parallel_list__')
+    if parallel is not None and current(parallel.symbol) is not parallel.symbol:
+        dict.__setitem__(dic, '__parallel_list__',
+                         ParallelList(current(parallel.symbol), parallel.separator))
+
+
+def _same_grammar(syntax: Syntax, base, start_symbol, eof_token, parallel, start_symbols):
+    # True if the tables of the base parser are the tables of the parser
+    base_symbols = base.__syntax__.symbols
+    if any(symbol is not base_symbols.get(fullname)
+           for fullname, symbol in syntax.symbols.items() if symbol is not syntax.__START__):
+        return False
+    base_parallel = base.__dict__.get('__parallel_list__')
+    if (parallel is None) != (base_parallel is None) or parallel is not None and \
+            (parallel.symbol, parallel.separator) != (base_parallel.symbol, base_parallel.separator):
+        return False
+    return start_symbol is base.__start_symbol__ and \
+        eof_token is base.__scanners__['__default__'].eof_token and \
+        list(start_symbols) == list(base.__start_symbols__)
+
+
+# tables shared by a parser and a base parser with the same grammar
+_SHARED_TABLES = ('__state_tree__', '__state_list__', '__token_ids__', '__expected_table__',
+                  '__symbols__', '__start_wrapper__', '__error_token__', '__entries__',
+                  '__parallel__', '__shortcuts__')
+
+
+def _identity(ctx, value):
+    return value
+
+
+def _pass_through(rule):
+    # a unit rule whose value is the value of its component, see PassThrough
+    return len(rule) == 1 and not rule.emit and rule.extra_info.get('pass_through', False)
+
+
+def _minimize(state_list):
+    # states with the same reduce rule and tokens whose branches go to
+    # equivalent states are merged, as in the minimisation of a DFA. The
+    # branches are redirected to the first state of every set. A frozen
+    # state reused from a base parser is a set of its own.
+    # Returns state -> the state it is merged into
+    blocks = {}
+    signatures = {}
+    for state in state_list:
+        key = (state.reduce_rule, frozenset(state.branchs), state.immediate_tokens)
+        blocks[state] = signatures.setdefault(key, len(signatures))
+
+    count = len(signatures)
+    while True:
+        signatures = {}
+        refined = {}
+        for state in state_list:
+            key = (blocks[state],
+                   frozenset((token, blocks.get(target, target))
+                             for token, target in state.branchs.items()))
+            refined[state] = signatures.setdefault(key, len(signatures))
+        blocks = refined
+        if len(signatures) == count:
+            break
+        count = len(signatures)
+
+    first = {}
+    for state in state_list:
+        first.setdefault(blocks[state], state)
+    merged = {state: first[blocks[state]] for state in state_list}
+    for state in first.values():
+        for token, target in list(state.branchs.items()):
+            if merged.get(target, target) is not target:
+                state.redirect(token, merged[target])
+    return merged
+
+
+def _short_circuit(state_list):
+    # a goto to a state that can only reduce a pass-through unit rule
+    # A -> B is replaced by the goto of A, repeated along chains of unit
+    # rules. Returns (state, token) -> (original target, skipped rules)
+    shortcuts = {}
+    for state in state_list:
+        for token, target in list(state.branchs.items()):
+            original = target
+            rules = []
+            while not target.branchs and target.reduce_rule is not None and \
+                    _pass_through(target.reduce_rule) and \
+                    state.get_branch(target.reduce_rule.symbol) is not None:
+                rules.append(target.reduce_rule)
+                target = state.get_branch(target.reduce_rule.symbol)
+            if rules:
+                state.redirect(token, target)
+                shortcuts[(state, token)] = (original, tuple(rules))
+    return shortcuts
+
+
+def _build_tables(syntax: Syntax, start_symbol, eof_token, memoize, parallel=None,
+                  start_symbols=(), base=None):
+    # the tables of a base parser are shared when the grammar is unchanged,
+    # e.g. a dialect that only adds tokens or scanners. Otherwise the base
+    # states that only refer to unchanged symbols are reused, see _reuse.
+    if base is not None:
+        base = base.warmup()
+    if base is not None and \
+            _same_grammar(syntax, base, start_symbol, eof_token, parallel, start_symbols):
+        begin = time.perf_counter()
+        tables = {k: getattr(base, k) for k in _SHARED_TABLES}
+        syntax.conflicts.update(base.__syntax__.conflicts)
+        syntax.statistics.update(base.__syntax__.statistics)
+        # the tries of the shared states, for the dialects of this parser
+        syntax._generated_states = base.__syntax__._generated_states
+        syntax._minimized = base.__syntax__._minimized
+        syntax.timings['reuse'] = time.perf_counter() - begin
+    else:
+        tables = _generate_tables(syntax, start_symbol, eof_token, parallel, start_symbols, base)
+
+    tables['__cache__'] = None
+    if memoize is not None:
+        impure = [str(rule) for symbol in tables['__symbols__']
+                  for rule in symbol.rules
+                  if rule.action is not None and not rule.extra_info.get('pure')]
+        if impure:
+            raise TypeError(f'Memoize requires Pure rule actions: {", ".join(impure)}')
+        from playlang.cache import ParseCache  # pylint: disable=import-outside-toplevel
+        tables['__cache__'] = ParseCache(memoize.maxsize, memoize.maxbytes)
+    return tables
+
+
+def _reuse(syntax: Syntax, base):
+    # the frozen states of base whose tokens, rules and successors are all
+    # in syntax are linked in its tries. The others refer to a symbol the
+    # dialect changed, directly or through a successor, and are generated
+    # again. Returns the shortcuts of base
+    symbols = syntax.symbols
+    tokens = syntax.tokens
+
+    def valid(token):
+        return (symbols if isinstance(token, Symbol) else tokens).get(token.fullname) is token
+
+    shortcuts = base.__shortcuts__
+    predecessors = {}
+    invalid = []
+    for state in base.__state_list__:
+        rule = state.reduce_rule
+        if rule is not None and not valid(rule.symbol) or not all(map(valid, state.tokens)):
+            invalid.append(state)
+        for token, target in state.branchs.items():
+            predecessors.setdefault(target, []).append(state)
+            shortcut = shortcuts.get((state, token))
+            if shortcut is not None:
+                predecessors.setdefault(shortcut[0], []).append(state)
+
+    reused = set(base.__state_list__)
+    while invalid:
+        state = invalid.pop()
+        if state in reused:
+            reused.remove(state)
+            invalid.extend(predecessors.get(state, ()))
+
+    minimized = base.__syntax__._minimized
+
+    def branch(state, token):
+        target = shortcuts.get((state, token))
+        target = state.get_branch(token) if target is None else target[0]
+        return minimized.get(target, target)
 
-                raise SyntaxError(
-                    f'{location}unexpected token {lookahead.token.show_name}({lookahead.value}){message}')
+    syntax.reuse(base.__syntax__, frozenset(reused), branch)
+    return shortcuts
+
+
+def _reached(state_list, shortcuts):
+    # the frozen base states reached from state_list
+    reached = set()
+    todo = [target for state in state_list for target in state.branchs.values() if target.frozen]
+    while todo:
+        state = todo.pop()
+        if state not in reached:
+            reached.add(state)
+            for token, target in state.branchs.items():
+                todo.append(target)
+                shortcut = shortcuts.get((state, token))
+                if shortcut is not None:
+                    todo.append(shortcut[0])
+    return reached
+
+
+def _token_ids(token_ids, base_ids):
+    # the base ids first, the expected bitsets of the reused states are valid
+    names = {token.fullname: token for token in token_ids}
+    # a start wrapper of the base only keeps its id
+    ids = [names.pop(token.fullname, token) for token in base_ids]
+    return (*ids, *names.values())
+
+
+def _generate_tables(syntax: Syntax, start_symbol, eof_token, parallel, start_symbols, base=None):
+    tables = {}
+    shortcuts = {}
+    if base is not None:
+        begin = time.perf_counter()
+        shortcuts = _reuse(syntax, base)
+        syntax.timings['reuse'] = time.perf_counter() - begin
+
+    state_tree, start_wrapper = syntax.generate(start_symbol, eof_token)
+
+    # other start symbols, (initial state, wrapper) by symbol
+    entries = {}
+    for symbol in start_symbols:
+        if symbol is not start_symbol and symbol not in entries:
+            entries[symbol] = syntax.entry(symbol, eof_token)
+
+    tables['__parallel__'] = None
+    if parallel is not None:
+        first, step, separator = _parallel_list(syntax, start_symbol, parallel)
+        item = tuple(first)[0]
+        if item not in entries:
+            entries[item] = syntax.entry(item, eof_token)
+        tables['__parallel__'] = (*entries[item], first, step, separator)
+    tables['__entries__'] = entries
+
+    begin = time.perf_counter()
+    state_list = list(syntax._merged_states)
+    state_list.sort(key=lambda s: ''.join([str(t) for t in s.tokens]))
+    reused = ()
+    if base is not None:
+        # in the order of the base
+        reached = _reached(state_list, shortcuts)
+        reused = [state for state in base.__state_list__ if state in reached]
+    syntax.timings['sort'] = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    merged = _minimize(state_list)
+    syntax.statistics['states before merging identical states'] = len(state_list) + len(reused)
+    if base is not None:
+        syntax.statistics['reused states'] = len(reused)
+    syntax._minimized = {state: target for state, target in merged.items() if state is not target}
+    state_list = [state for state in state_list if merged[state] is state]
+    state_tree = merged[state_tree]
+    for symbol, (state, wrapper) in entries.items():
+        entries[symbol] = (merged[state], wrapper)
+    if tables['__parallel__'] is not None:
+        state, *rest = tables['__parallel__']
+        tables['__parallel__'] = (merged[state], *rest)
+    syntax.timings['minimize'] = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    tables['__shortcuts__'] = _short_circuit(state_list)
+    if reused:
+        reused_shortcuts = {k: v for k, v in shortcuts.items() if k[0] in reached}
+        tables['__shortcuts__'] = {**reused_shortcuts, **tables['__shortcuts__']}
+    syntax.timings['short circuit'] = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    token_ids = (*syntax.tokens.values(), *syntax.symbols.values())
+    if base is not None:
+        token_ids = _token_ids(token_ids, base.__token_ids__)
+
+    for state in state_list:
+        state.freeze()
+    for token in token_ids:
+        token.freeze()
+    state_list = [*reused, *state_list]
+
+    tables['__state_tree__'] = state_tree
+    tables['__state_list__'] = tuple(state_list)
+    tables['__token_ids__'] = token_ids
+    tables['__expected_table__'] = _expected_table(state_list, token_ids, frozenset(reused))
+    syntax.timings['expected'] = time.perf_counter() - begin
+    tables['__symbols__'] = tuple(syntax.symbols.values())
+    tables['__start_wrapper__'] = start_wrapper
+    tables['__error_token__'] = None
+    for token in syntax.tokens.values():
+        if token.is_error:
+            tables['__error_token__'] = token
+    return tables
+
+
+def _create_static_fields(clazz, fields):
+    syntax = clazz.__syntax__
+    for k, v in fields.items():
+        if isinstance(v, StaticField):
+            begin = time.perf_counter()
+            setattr(clazz, k, v.create(clazz))
+            syntax.timings[f'static field {k}'] = time.perf_counter() - begin
+
+
+class _Deferred:
+    """Attribute of a Lazy parser, builds the parser on first access"""
+
+    def __init__(self, name, field=None):
+        self.name = name
+        self.field = field
+
+    def __get__(self, obj, owner):
+        parser = obj if isinstance(obj, Parser) else owner
+        if self.field is None and '__build_lock__' not in parser.__dict__:
+            # table attribute of a class that is not a parser
+            raise AttributeError(self.name)
+        parser.warmup()
+        if isinstance(parser.__dict__.get(self.name), _Deferred):
+            # read by a static field of the parser while it is created
+            raise RuntimeError(f'{self.name} of {parser.__name__} is read before it is built')
+        return getattr(parser, self.name)
+
+
+def _expand(syntax: Syntax, components):
+    # rules for the components of a Rule, an optional combinator is left out
+    # of some of them, its position and kind are the defaults of the rule
+    variants = [([], ())]
+    for idx, c in enumerate(components):
+        if not isinstance(c, Combinator):
+            for variant, _ in variants:
+                variant.append(c)
+            continue
+        component, optional = syntax.combinator(c)
+        expanded = []
+        for variant, defaults in variants:
+            expanded.append(([*variant, component], defaults))
+            if optional:
+                expanded.append((variant, (*defaults, (idx, c.kind))))
+        variants = expanded
+    return variants
+
+
+def _with_defaults(action, defaults):
+    if action is None:
+        return None
+
+    @functools.wraps(action)
+    def insert_defaults(ctx, *args):
+        args = list(args)
+        for idx, kind in defaults:
+            args.insert(idx, None if kind == 'Optional' else [])
+        return action(ctx, *args)
+    return insert_defaults
+
+
+def _built(parser):
+    state_tree = parser.__dict__.get('__state_tree__')
+    return state_tree is not None and not isinstance(state_tree, _Deferred)
 
 
 class ParserDict(dict):
-    def __init__(self, name):
+    def __init__(self, name, bases=()):
         super().__init__()
-        self['__syntax__'] = Syntax(name)
+        syntax = Syntax(name)
+        self['__syntax__'] = syntax
         self['__scanners__'] = {}
 
+        # the tokens, symbols, scanners and declarations of base parsers
+        for base in reversed(bases):
+            if not isinstance(base, Parser):
+                continue
+            syntax.inherit(base.__syntax__)
+            self['__scanners__'].update(base.__scanners__)
+            for clazz in reversed(base.__mro__):
+                for k, v in clazz.__dict__.items():
+                    if isinstance(v, (Terminal, Symbol)):
+                        dict.__setitem__(self, k, v)
+            for k in ('__lazy__', '__memoize__', '__parallel_list__'):
+                if k in base.__dict__:
+                    dict.__setitem__(self, k, base.__dict__[k])
+
+    @staticmethod
+    def _register(syntax: Syntax, components):
+        # add the tokens and symbols reachable from components, each one is
+        # visited once, so defining a grammar is linear in its size
+        tokens = syntax.tokens
+        symbols = syntax.symbols
+        todo = [components]
+        while todo:
+            for c in todo.pop():
+                if c.fullname in tokens or c.fullname in symbols:
+                    continue
+                if isinstance(c, Terminal):
+                    tokens[c.fullname] = c
+                elif isinstance(c, Symbol):
+                    symbols[c.fullname] = c
+                    todo.extend(c.rules)
+
     def __setitem__(self, key, value): # pylint: disable=too-many-branches
         if isinstance(value, SymbolInfo):
             syntax = self['__syntax__']  # type: Syntax
 
-            def add_all(symbol: Symbol):
-                for rule in symbol.rules:
-                    for c in rule:
-                        if isinstance(c, Terminal) and c.fullname not in syntax.tokens:
-                            syntax.tokens[c.fullname] = c
-                        if isinstance(c, Symbol) and c.fullname not in syntax.symbols:
-                            syntax.symbols[c.fullname] = c
-                            add_all(c)
-
-            symbol = syntax.symbol(key)  # type: Symbol
+            if syntax.inherited(self.get(key)):
+                symbol = syntax.override(self[key])
+            else:
+                symbol = syntax.symbol(key)  # type: Symbol
             for ruleinfo in value.rules:
-                for c in ruleinfo.components:
-                    if isinstance(c, Terminal) and c.fullname not in syntax.tokens:
-                        syntax.tokens[c.fullname] = c
-                    if isinstance(c, Symbol) and c.fullname not in syntax.symbols:
-                        syntax.symbols[c.fullname] = c
-                        add_all(c)
-
-                rule = SymbolRule(symbol,
-                                  ruleinfo.components,
-                                  value.action,
-                                  ruleinfo.precedence,
-                                  value.data)
-                symbol.rules.append(rule)
+                for components, defaults in _expand(syntax, ruleinfo.components):
+                    self._register(syntax, components)
+
+                    action = value.action
+                    extra_info = value.data
+                    if value.data.get('pass_through'):
+                        # the value is the component in every backend
+                        if action is not None or \
+                                value.data.get('javascript', 'return $1').strip() != 'return $1':
+                            raise TypeError(f'PassThrough rules have no action: {key}')
+                        action = _identity
+                    elif defaults:
+                        action = _with_defaults(action, defaults)
+                        extra_info = {**value.data, 'defaults': defaults}
+                    rule = SymbolRule(symbol,
+                                      components,
+                                      action,
+                                      ruleinfo.precedence,
+                                      extra_info)
+                    if action is _identity and len(rule) != 1:
+                        raise TypeError(f'PassThrough requires a unit rule: {rule}')
+                    symbol.rules.append(rule)
 
             symbol.data.update(value.data)
 
@@ -172,6 +805,8 @@ class ParserDict(dict):
 
         elif isinstance(value, TokenInfo):
             syntax = self['__syntax__']  # type: Syntax
+            if syntax.inherited(self.get(key)):
+                raise TypeError(f'token {key} is defined by a base parser')
             token = syntax.terminal(key)
             token.data.update(value)
 
@@ -192,15 +827,31 @@ class ParserDict(dict):
             if not isinstance(symbol, Symbol):
                 raise TypeError(
                     f'expected a non-terminal symbol as start symbol. but got {symbol}')
-            self['__start_symbol__'] = symbol
+            # the first one is the default of Parser.parse
+            if '__start_symbol__' not in self:
+                dict.__setitem__(self, '__start_symbol__', symbol)
+            self.setdefault('__start_symbols__', []).append(symbol)
+
+        elif isinstance(value, Lazy):
+            dict.__setitem__(self, '__lazy__', True)
+
+        elif isinstance(value, Memoize):
+            dict.__setitem__(self, '__memoize__', value)
+
+        elif isinstance(value, ParallelList):
+            dict.__setitem__(self, '__parallel_list__', value)
 
         elif isinstance(value, Scanner):
             syntax = self['__syntax__']  # type: Syntax
 
+            inherited = self['__scanners__'].get(value.name)
             self['__scanners__'][value.name] = value
             if value.eof_token is None:
-                token = syntax.terminal('__EOF__')
-                token.update({"is_eof": True})
+                if inherited is not None and syntax.inherited(inherited.eof_token):
+                    token = inherited.eof_token
+                else:
+                    token = syntax.terminal('__EOF__')
+                    token.update({"is_eof": True})
                 value.eof_token = token
                 value.tokens = (*value.tokens, value.eof_token)
 
@@ -216,7 +867,15 @@ class Parser(type):
 
     def __new__(cls, name, bases, dic: ParserDict):
         syntax = dic['__syntax__']
-        
+        base = next((b for b in bases if isinstance(b, Parser)), None)
+        if base is not None:
+            _inherit(dic, syntax, base)
+
+        # static fields are created again for every parser
+        fields = {} if base is None else dict(base.__static_fields__)
+        fields.update((k, v) for k, v in dic.items() if isinstance(v, StaticField))
+        dict.__setitem__(dic, '__static_fields__', fields)
+
         scan_info: Dict[str, Scanner] = dic.get('__scanners__')
         if scan_info is None:
             raise TypeError('missing scan information')
@@ -232,30 +891,268 @@ class Parser(type):
             raise TypeError(
                 f'invalid type of start symbol "{start_symbol}"')
 
-        state_tree, start_wrapper = syntax.generate(start_symbol, eof_token)
+        if dic.get('__lazy__'):
+            import threading  # pylint: disable=import-outside-toplevel
+            clazz = type.__new__(cls, name, bases, dic)
+            clazz.__build_lock__ = threading.RLock()
+            if base is not None:
+                # the built tables of the base parser would be found first
+                for k in (*_SHARED_TABLES, '__cache__'):
+                    setattr(clazz, k, _Deferred(k))
+            for k, v in fields.items():
+                setattr(clazz, k, _Deferred(k, v))
+            return clazz
 
-        state_list = list(syntax._merged_states)
-        state_list.sort(key=lambda s: ''.join([str(t) for t in s.tokens]))
+        dic.update(_build_tables(syntax, start_symbol, eof_token, dic.get('__memoize__'),
+                                 dic.get('__parallel_list__'), dic['__start_symbols__'], base))
+        clazz = type.__new__(cls, name, bases, dic)
+        _create_static_fields(clazz, fields)
+        return clazz
 
-        dic['__state_tree__'] = state_tree
-        dic['__state_list__'] = state_list
-        dic['__symbols__'] = syntax.symbols.values()
-        dic['__start_wrapper__'] = start_wrapper
+    # attributes of a Lazy parser until warmup(), see _Deferred
+    __state_tree__ = _Deferred('__state_tree__')
+    __state_list__ = _Deferred('__state_list__')
+    __token_ids__ = _Deferred('__token_ids__')
+    __expected_table__ = _Deferred('__expected_table__')
+    __symbols__ = _Deferred('__symbols__')
+    __start_wrapper__ = _Deferred('__start_wrapper__')
+    __error_token__ = _Deferred('__error_token__')
+    __cache__ = _Deferred('__cache__')
+    __parallel__ = _Deferred('__parallel__')
+    __entries__ = _Deferred('__entries__')
+    __shortcuts__ = _Deferred('__shortcuts__')
 
-        clazz = type.__new__(cls, name, bases, dic)
+    @property
+    def __fingerprint__(cls):
+        """Digest of the grammar, computed on first use without building
+        the tables of a Lazy parser"""
+        if '__digest__' not in cls.__dict__:
+            cls.__digest__ = _fingerprint(cls)
+        return cls.__digest__
 
-        for k, v in dic.items():
-            if isinstance(v, StaticField):
-                setattr(clazz, k, v.create(clazz))
+    def warmup(cls):
+        """Build the tables and static fields of a Lazy parser now
 
-        return clazz
+        Safe to call from many threads, the parser is built once.
+        """
+        if _built(cls):
+            return cls
+        with cls.__build_lock__:
+            if not _built(cls):
+                syntax = cls.__syntax__
+                base = next((b for b in cls.__bases__ if isinstance(b, Parser)), None)
+                tables = _build_tables(syntax, cls.__start_symbol__,
+                                       cls.__scanners__['__default__'].eof_token,
+                                       cls.__dict__.get('__memoize__'),
+                                       cls.__dict__.get('__parallel_list__'),
+                                       cls.__start_symbols__, base)
+                # __state_tree__ after the static fields, it marks the
+                # parser as built for the other threads
+                state_tree = tables.pop('__state_tree__')
+                for k, v in tables.items():
+                    setattr(cls, k, v)
+                _create_static_fields(cls, {k: v.field for k, v in cls.__dict__.items()
+                                            if isinstance(v, _Deferred) and v.field is not None})
+                cls.__state_tree__ = state_tree
+        return cls
+
+    def __report__(cls, file=None):
+        """Print table sizes, build timings and resolved conflicts"""
+        syntax = cls.__syntax__
+        states = cls.__state_list__
+        branchs = sum(len(state.branchs) for state in states)
+        memory = sum(sys.getsizeof(state) + sys.getsizeof(state.branchs) +
+                     sys.getsizeof(state.tokens) + sys.getsizeof(state.immediate_tokens)
+                     for state in states)
 
-    def parse(cls, scanner, context):
-        token_reader = TokenReader(scanner, cls.__start_wrapper__)
-        state_stack = StateStack(cls.__state_tree__)
-        _parse(token_reader, state_stack, context)
+        p = Printer(sys.stdout if file is None else file)
+        p < f'{cls.__name__}:'
+        p + f'states: {len(states)}'
+        for name, value in syntax.statistics.items():
+            p + f'{name}: {value}'
+        p + f'branchs: {branchs}'
+        p + f'expected token sets: {len(cls.__expected_table__)}'
+        p + f'table memory: {memory} bytes (estimated)'
+        p + f'short-circuited unit rules: {len(cls.__shortcuts__)} gotos'
+        if cls.__entries__:
+            p + f'entries: {", ".join(symbol.name for symbol in cls.__entries__)}'
+        if cls.__cache__ is not None:
+            info = cls.__cache__.info()
+            p + f'cache: {info.size} entries, {info.bytes} bytes, ' \
+                f'{info.hits} hits, {info.misses} misses, {info.evictions} evictions'
+        p < 'build phases:'
+        for phase, seconds in sorted(syntax.timings.items(), key=lambda i: -i[1]):
+            p + f'{phase}: {seconds * 1000:.3f} ms'
+        p > f'resolved conflicts: {len(syntax.conflicts)}'
+        for (kind, rule1, rule2), resolution in syntax.conflicts.items():
+            p + f'    {kind} => {resolution}'
+            p + f'        {rule1} {rule1.precedence}'
+            p + f'        {rule2} {rule2.precedence}'
+
+    def parse(cls, scanner, context, errors=None, max_errors=100, start=None):
+        """Parse tokens from `scanner`
+
+        If `errors` is a list, syntax errors are appended to it and parsing
+        continues with the grammar's error token. A SyntaxError is raised
+        when recovery fails or `max_errors` errors have been collected.
+        `start` is one of the `Start` symbols, the first one by default.
+        """
+        state, wrapper = cls._entry(start)
+        token_reader = TokenReader(scanner, wrapper)
+        state_stack = StateStack(state)
+        _parse(token_reader, state_stack, context, cls._recovery(errors, max_errors))
         return token_reader.pop().value
 
+    def parse_cached(cls, text, tokenizer, context=None):
+        """Parse `text` with `tokenizer`, reuse the result of an earlier
+        call with the same text
+
+        Requires a `Memoize` declaration. Cached results are shared and
+        must not be modified.
+        """
+        from playlang.cache import digest  # pylint: disable=import-outside-toplevel
+        cache = cls.__cache__
+        if cache is None:
+            raise TypeError(f'{cls.__name__} has no Memoize declaration')
+        key = digest(text, cls.__fingerprint__, tokenizer.fingerprint)
+        result = cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = cls.parse(tokenizer(text), context)
+            cache.put(key, result)
+        return result
+
+    def parse_parallel(cls, inputs, tokenizer, context=None, max_workers=None):
+        """Parse every string of `inputs` on a thread pool
+
+        `context` is called once per input to create its parse context.
+        The tables are read only, so parses scale with the number of threads
+        on free-threaded Python builds.
+
+        Returns:
+            list: results in the order of `inputs`
+        """
+        from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+
+        def parse(text):
+            return cls.parse(tokenizer(text), None if context is None else context())
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(parse, inputs))
+
+    def parse_list_parallel(cls, scanner, context, max_workers=None, batch_size=256):
+        """Same as parse, the items of the `ParallelList` are parsed on a
+        thread pool on free-threaded Python builds
+
+        The tokens are cut at the separators, `batch_size` items are parsed
+        per task and the results are combined by the list rules in order.
+        The rule actions of the items run concurrently. A syntax error of
+        an item is raised before the later items are combined, its end is
+        reported as the end of file. With the GIL the threads can not run
+        in parallel, this is parse.
+        """
+        parallel = cls.__parallel__
+        if parallel is None:
+            raise TypeError(f'{cls.__name__} has no ParallelList declaration')
+        if not _free_threaded():
+            return cls.parse(scanner, context)
+        state, wrapper, first, step, separator = parallel
+        eof_token = cls.__scanners__['__default__'].eof_token
+
+        items = []
+        separators = []
+        tokens = []
+        eof = None
+        for tv in scanner:
+            if tv.token is separator:
+                items.append(tokens)
+                separators.append(tv)
+                tokens = []
+            elif isinstance(tv.token, Terminal) and tv.token.is_eof:
+                eof = tv
+                break
+            else:
+                tokens.append(tv)
+        items.append(tokens)
+        separators.append(eof)
+
+        def parse(begin):
+            values = []
+            for idx in range(begin, min(begin + batch_size, len(items))):
+                end = separators[idx]
+                end = TokenValue(eof_token, '__EOF__', None if end is None else end.location)
+                # the end of file is read again after it is shifted
+                token_reader = TokenReader(itertools.chain(items[idx], itertools.repeat(end)),
+                                           wrapper)
+                _parse(token_reader, StateStack(state), context)
+                values.append(token_reader.pop().value)
+            return values
+
+        from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+        with ThreadPoolExecutor(max_workers) as executor:
+            batches = executor.map(parse, range(0, len(items), batch_size))
+
+            values = iter(value for batch in batches for value in batch)
+            result = next(values)
+            result = None if first.action is None else first.action(context, result)
+            for tv, value in zip(separators, values):
+                result = None if step.action is None else step.action(context, result, tv.value, value)
+        return result
+
+    def iterparse(cls, scanner, context, errors=None, max_errors=100, start=None):
+        """Parse tokens from `scanner`, yield the values of `Emit` rules
+        as soon as they are reduced.
+
+        The values are not kept on the parser stack. The generator returns
+        the value of the start symbol, `start` is the same as for parse.
+        """
+        state, wrapper = cls._entry(start)
+        return _iterparse(scanner, state, wrapper, context, cls._recovery(errors, max_errors))
+
+    def parse_tree(cls, tokens, start=None):
+        """Concrete syntax tree of a TokenArray, see Tokenizer.tokenize_array
+
+        The rule actions are not called, every reduction is recorded as a
+        node of a ParseTree. `start` is one of the `Start` symbols.
+        """
+        from playlang.tree import parse_tree  # pylint: disable=import-outside-toplevel
+        return parse_tree(cls, tokens, start)
+
+    def export_tables(cls):
+        """Serialize the parse tables into bytes for load_tables
+
+        A Lazy parser must be built first, see warmup.
+        """
+        from playlang.tables import export_tables  # pylint: disable=import-outside-toplevel
+        return export_tables(cls)
+
+    def load_tables(cls, buffer):
+        """Parse tables backed by `buffer`, see FlatTables
+
+        `buffer` is the result of export_tables or any object supporting
+        the buffer protocol with the same content, e.g. the buf of a
+        multiprocessing.shared_memory.SharedMemory or an mmap. The tables
+        refer to the tokens and rules of the parser, a Lazy parser must be
+        built first, see warmup.
+        """
+        from playlang.tables import FlatTables  # pylint: disable=import-outside-toplevel
+        return FlatTables(cls, buffer)
+
+    def push(cls, context, tokenizer=None, errors=None, max_errors=100, start=None):
+        return PushParser(cls, context, tokenizer, errors, max_errors, start)
+
+    def _entry(cls, start):
+        if start is None or start is cls.__start_symbol__:
+            return cls.__state_tree__, cls.__start_wrapper__
+        entry = cls.__entries__.get(start)
+        if entry is None:
+            raise TypeError(f'{start} is not a start symbol of {cls.__name__}')
+        return entry
+
+    def _recovery(cls, errors, max_errors, tables=StateTables):
+        if errors is None:
+            return None
+        return ErrorRecovery(cls.__error_token__, errors, max_errors, tables)
+
     @classmethod
     def __prepare__(cls, name, bases):
-        return ParserDict(name)
+        return ParserDict(name, bases)
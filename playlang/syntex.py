@@ -1,7 +1,27 @@
 # Copyright (C) 2023 pom@vro.life
 # SPDX-License-Identifier: LGPL-3.0-only OR GPL-2.0-only OR GPL-3.0-only
+import time
 from playlang.errors import ConflictReduceReduceError, ConflictShiftReduceError
-from playlang.classes import TerminalPrecedence, Symbol, SymbolRule, Terminal, State
+from playlang.classes import TerminalPrecedence, Symbol, SymbolRule, Terminal, State, Combinator
+
+
+def _reduce_start_symbol(ctx, v, _):
+    return v
+
+
+# rule actions of the combinator symbols
+def _new_list(ctx, item):
+    return [item]
+
+
+def _append(ctx, items, item):
+    items.append(item)
+    return items
+
+
+def _append_separated(ctx, items, _, item):
+    items.append(item)
+    return items
 
 
 class Syntax:
@@ -13,7 +33,27 @@ class Syntax:
         self._generated_states = {}
         self._pending_rules = {}
         self._merged_states = set()
+        # state -> the equivalent state it is merged into, see _minimize
+        self._minimized = {}
+        # see reuse
+        self._reused = frozenset()
+        self._base_states = {}
+        self._base_branch = None
+        self._counterparts = {}
+        self._copies = {}
+        self._contained = set()
+        self._merged_frozen = set()
         self._current_precedence = TerminalPrecedence(0)
+        # fullnames of the symbols and tokens shared with the base parser
+        self._inherited = set()
+        self._inherited_tokens = set()
+
+        # (kind, rule, rule) -> how the conflict was resolved
+        self.conflicts = {}
+        # build phase -> seconds
+        self.timings = {}
+        # table statistics of Parser.__report__
+        self.statistics = {}
 
         self.__START__ = self.symbol('__START__', '__START__')
 
@@ -55,6 +95,98 @@ class Syntax:
 
         return symbol
 
+    def inherit(self, base):
+        """Share the tokens and symbols of the syntax of a base parser"""
+        self._defined_tokens.update(base.tokens)
+        self._inherited_tokens.update(base.tokens)
+        for fullname, symbol in base.symbols.items():
+            if not symbol.name.startswith('__START'):
+                self._defined_symbols[fullname] = symbol
+                self._inherited.add(fullname)
+        if base._current_precedence.precedence > self._current_precedence.precedence:
+            self._current_precedence = base._current_precedence
+
+    def inherited(self, value):
+        if isinstance(value, Terminal):
+            return value.fullname in self._inherited_tokens
+        return isinstance(value, Symbol) and value.fullname in self._inherited and \
+            self._defined_symbols[value.fullname] is value
+
+    def override(self, symbol):
+        """Copy of an inherited symbol, the rules can be extended"""
+        copy = Symbol(symbol.name, symbol.fullname)
+        copy.data.update(symbol.data)
+        copy.rules.extend(symbol.rules)
+        self._defined_symbols[symbol.fullname] = copy
+        self._inherited.discard(symbol.fullname)
+        return copy
+
+    def rewire(self):
+        """Copy the inherited symbols whose rules refer to overridden ones,
+        the rules of the copies and of the new symbols refer to the copies.
+
+        The symbols of the base parser are not modified.
+        """
+        symbols = self._defined_symbols
+        changed = True
+        while changed:
+            changed = False
+            for fullname in list(self._inherited):
+                symbol = symbols[fullname]
+                if any(isinstance(c, Symbol) and symbols[c.fullname] is not c
+                       for rule in symbol.rules for c in rule):
+                    self.override(symbol)
+                    changed = True
+
+        for symbol in symbols.values():
+            if symbol.fullname in self._inherited:
+                continue
+            rules = symbol.rules
+            for idx, rule in enumerate(rules):
+                components = [symbols[c.fullname] if isinstance(c, Symbol) else c for c in rule]
+                if rule.symbol is not symbol or any(a is not b for a, b in zip(components, rule)):
+                    rules[idx] = SymbolRule(symbol, components, rule.action,
+                                            rule.precedence, rule.extra_info)
+
+    def combinator(self, combinator: Combinator):
+        """Component of a rule for a Combinator and whether it is optional.
+
+        Many and SepBy are an optional Many1 and SepBy1, their symbols have
+        left recursive rules and no empty rule. A rule with an optional
+        component is added with and without it.
+        """
+        kind = combinator.kind
+        item = combinator.item
+        separator = combinator.separator
+        if isinstance(item, Combinator):
+            item, optional = self.combinator(item)
+            if optional:
+                raise TypeError(f'{kind} of an optional item')
+        if kind == 'Optional':
+            return item, True
+        if kind in ('Many', 'SepBy'):
+            kind += '1'
+        elif kind not in ('Many1', 'SepBy1'):
+            raise TypeError(f'unknown combinator {kind}')
+
+        suffix = kind.upper() if separator is None else f'{kind.upper()}_{separator.name}'
+        symbol = self.symbol(f'{item.name}_{suffix}', f'{item.fullname}_{suffix}')
+        if not symbol.rules:
+            symbol.data['combinator'] = (kind, item, separator)
+            if separator is None:
+                symbol.data['show_name'] = f'{kind}({item.show_name})'
+                step = [symbol, item]
+                symbol.rules.append(SymbolRule(symbol, step, _append, extra_info={
+                    'javascript': '$1.push($2); return $1'}))
+            else:
+                symbol.data['show_name'] = f'{kind}({item.show_name}, {separator.show_name})'
+                step = [symbol, separator, item]
+                symbol.rules.append(SymbolRule(symbol, step, _append_separated, extra_info={
+                    'javascript': '$1.push($3); return $1'}))
+            symbol.rules.insert(0, SymbolRule(symbol, [item], _new_list, extra_info={
+                'pure': True, 'javascript': 'return [$1]'}))
+        return symbol, combinator.kind != kind
+
     def terminal(self, name, fullname=None):
         if name is None:
             raise TypeError('token name must be not none')
@@ -71,27 +203,68 @@ class Syntax:
         return token
 
     def generate(self, start_symbol, eof_token):
-        def reduce_start_symbol(ctx, v, _):
-            return v
-
         self.__START__.rules.append(SymbolRule(
-            self.__START__, [start_symbol, eof_token], reduce_start_symbol))
+            self.__START__, [start_symbol, eof_token], _reduce_start_symbol, extra_info={'pure': True}))
 
+        begin = time.perf_counter()
         root_state = self._generate_state_tree(self.__START__)
+        self.timings['generate'] = time.perf_counter() - begin
 
+        begin = time.perf_counter()
         self._merge_state_tree(root_state)
+        self._merge_copies()
+        self._merged_states = frozenset(self._merged_states)
+        self.timings['merge'] = time.perf_counter() - begin
 
         return root_state, self.__START__
 
+    def reuse(self, base, states, branch):
+        """Link the frozen states of a built base parser in the tries of
+        the inherited symbols, they are not merged again.
+
+        `states` are the base states whose tokens, rules and successors are
+        all in this syntax. `branch(state, token)` is the target a base state
+        was generated with, before the gotos were minimized or short-circuited.
+        A base state is copied when a state of this syntax adds to it.
+        """
+        self._reused = states
+        # a copy of an overridden symbol is equal to the inherited one
+        self._base_states = {symbol: state for symbol, state in base._generated_states.items()
+                             if self._defined_symbols.get(symbol.fullname) is symbol}
+        self._base_branch = branch
+
+    def entry(self, symbol, eof_token):
+        """Initial state of another start symbol, called after generate.
+
+        The states of generate are reused, the new ones are added to the
+        same table.
+        """
+        wrapper = self.symbol(f'__START_{symbol.name}__', f'__START_{symbol.fullname}__')
+        wrapper.rules.append(SymbolRule(
+            wrapper, [symbol, eof_token], _reduce_start_symbol, extra_info={'pure': True}))
+
+        begin = time.perf_counter()
+        state = self._generate_state_tree(wrapper)
+        self._merged_states = set(self._merged_states)
+        self._merge_state_tree(state)
+        self._merge_copies()
+        self._merged_states = frozenset(self._merged_states)
+        self.timings[f'entry {symbol.name}'] = time.perf_counter() - begin
+
+        return state, wrapper
+
     def _generate_state_tree(self, symbol):
         state = self._generated_states.get(symbol)
         if state is None:
             state = State()
             self._generated_states[symbol] = state
+            base_state = self._base_states.get(symbol)
+            if base_state is not None:
+                self._counterparts[state] = base_state
 
         rules = self._pending_rules.get(symbol)
         if rules is None:
-            rules = symbol.rules[:]
+            rules = list(symbol.rules)
             self._pending_rules[symbol] = rules
 
         while len(rules) > 0:
@@ -106,12 +279,23 @@ class Syntax:
             index, component = rule_iter.__next__()
 
             if component not in state:
+                base_state = self._counterparts.get(state)
+                if base_state is not None:
+                    base_state = self._base_branch(base_state, component)
+                if base_state in self._reused:
+                    # the rest of the rule is in the base state
+                    state.set_branch(component, base_state)
+                    return
                 branch = State()
                 branch.bind_rule = rule
                 branch.bind_index = index
                 state.set_branch(component, branch)
+                if base_state is not None:
+                    self._counterparts[branch] = base_state
             else:
                 branch = state.get_branch(component)
+                if branch.frozen:
+                    return
 
                 # rebind
                 if rule.precedence > branch.bind_rule.precedence:
@@ -125,35 +309,50 @@ class Syntax:
         except StopIteration:
             state.reduce_rule = rule
 
-    def _should_reduce(self, reduce, shift):
-        if reduce.precedence > shift.precedence:
+    def _should_reduce(self, reduce_rule, shift_rule):
+        reduce = reduce_rule.precedence
+        shift = shift_rule.precedence
+        key = ('shift/reduce', reduce_rule, shift_rule)
+        if reduce > shift:
+            self.conflicts[key] = 'reduce, higher precedence'
             return True
-        if reduce.precedence < shift.precedence:
+        if reduce < shift:
+            self.conflicts[key] = 'shift, higher precedence'
             return False
         else:  # ==
             if reduce.associative != shift.associative:
-                raise ConflictShiftReduceError('shift/reduce conflict. reduce: %s. shift: %s' % (reduce, shift))
+                raise ConflictShiftReduceError('shift/reduce conflict. reduce: %s. shift: %s' % (reduce_rule, shift_rule))
 
             if reduce.associative == TerminalPrecedence.ASSOC_LEFT:
+                self.conflicts[key] = 'reduce, left associative'
                 return True
 
             if not self._auto_shift:
-                raise ConflictShiftReduceError('shift/reduce conflict. reduce: %s. shift: %s' % (reduce, shift))
+                raise ConflictShiftReduceError('shift/reduce conflict. reduce: %s. shift: %s' % (reduce_rule, shift_rule))
 
             # shift default
+            self.conflicts[key] = 'shift, default'
             return False
 
     def _should_override(self, dest_rule, source_rule):
+        key = ('reduce/reduce', dest_rule, source_rule)
         if dest_rule.precedence > source_rule.precedence:
+            self.conflicts[key] = 'second rule, by precedence'
             return True
         if dest_rule.precedence < source_rule.precedence:
+            self.conflicts[key] = 'first rule, by precedence'
             return False
         else:  # ==
             raise ConflictReduceReduceError('reduce/reduce conflict. %s and %s' % (dest_rule, source_rule))
 
     def _merge_state(self, dest_state, source_state):
-        if dest_state is source_state:
+        if dest_state is source_state or self._copies.get(source_state) is dest_state:
             return
+        if source_state.frozen:
+            # the gotos of the base states have cycles
+            if (dest_state, source_state) in self._merged_frozen:
+                return
+            self._merged_frozen.add((dest_state, source_state))
 
         if source_state.reduce_rule is not None:
             if dest_state.reduce_rule is None:
@@ -170,28 +369,89 @@ class Syntax:
 
                 if exist_state.reduce_rule is not None:
                     # see self._generate_for_symbol: #rebind
-                    if self._should_reduce(exist_state.bind_rule.precedence,
-                                           branch.bind_rule.precedence):
+                    if self._should_reduce(exist_state.bind_rule,
+                                           branch.bind_rule):
                         # discard, we don't merge a low precedence state to high precedence state
                         continue
 
+                if exist_state.frozen and exist_state is not branch:
+                    visited = set()
+                    if self._contains(exist_state, branch, visited):
+                        self._contained.update(visited)
+                        continue
+                    exist_state = self._copy(dest_state, component, exist_state)
                 self._merge_state(exist_state, branch)
 
             else:
                 if dest_state.reduce_rule is not None:
-                    if self._should_reduce(dest_state.reduce_rule.precedence,
-                                           branch.bind_rule.precedence):
+                    if self._should_reduce(dest_state.reduce_rule,
+                                           branch.bind_rule):
                         # percent extend state chain with low precedence state
                         continue
                 dest_state.set_branch(component, branch)
 
+    def _contains(self, base_state, source_state, visited):
+        # merging source_state would not change the frozen base state.
+        # Cycles are assumed to be contained, visited is contained if the
+        # result is True
+        key = (base_state, source_state)
+        if base_state is source_state or key in visited or key in self._contained:
+            return True
+        visited.add(key)
+
+        reduce_rule = source_state.reduce_rule
+        if reduce_rule is not None and reduce_rule is not base_state.reduce_rule:
+            if base_state.reduce_rule is None or \
+                    self._should_override(base_state.reduce_rule, reduce_rule):
+                return False
+
+        for component, branch in source_state:
+            if component not in base_state:
+                if base_state.reduce_rule is None or \
+                        not self._should_reduce(base_state.reduce_rule, branch.bind_rule):
+                    return False
+                continue
+            exist_state = self._base_branch(base_state, component)
+            if exist_state.reduce_rule is not None and \
+                    self._should_reduce(exist_state.bind_rule, branch.bind_rule):
+                continue
+            if not self._contains(exist_state, branch, visited):
+                return False
+        return True
+
+    def _copy(self, state, token, base_state):
+        # the goto of state to a copy of a frozen base state, one copy is
+        # shared by all the states of this syntax
+        copy = self._copies.get(base_state)
+        if copy is None:
+            copy = State()
+            copy.bind_rule = base_state.bind_rule
+            copy.bind_index = base_state.bind_index
+            copy.reduce_rule = base_state.reduce_rule
+            for t in base_state.tokens:
+                copy.set_branch(t, self._base_branch(base_state, t))
+            self._copies[base_state] = copy
+        state.redirect(token, copy)
+        return copy
+
     def _merge_state_tree(self, state):
         state._copy_tokens()
         for component, _ in state:
             if isinstance(component, Symbol):
-                self._merge_state(state, self._generated_states[component])
+                # the tries below reused base states are generated on demand
+                self._merge_state(state, self._generate_state_tree(component))
 
         self._merged_states.add(state)
         for component, branch in state:
-            if branch not in self._merged_states:
+            if branch not in self._merged_states and not branch.frozen:
                 self._merge_state_tree(branch)
+
+    def _merge_copies(self):
+        # copies added to states that were already merged
+        while True:
+            pending = [c for c in self._copies.values() if c not in self._merged_states]
+            if not pending:
+                return
+            for copy in pending:
+                if copy not in self._merged_states:
+                    self._merge_state_tree(copy)
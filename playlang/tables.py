@@ -0,0 +1,168 @@
+# Copyright (C) 2023 pom@vro.life
+# SPDX-License-Identifier: LGPL-3.0-only OR GPL-2.0-only OR GPL-3.0-only
+from array import array
+from playlang.errors import _Expected
+from playlang.parser import TokenReader, StateStack, _parse, _iterparse, _built
+
+# buffer layout, all items are native int32:
+#   header   MAGIC VERSION fingerprint[4] nstates nids nrules nentries
+#   entries  [nentries * 3]     start symbol id, initial state, wrapper id,
+#                               the default start symbol first
+#   reduce   [nstates]          rule index or -1
+#   expect   [nstates]          offset of the expected ids in `ids`
+#   goto     [nstates * nids]   next state or -1
+#   rules    [nrules * 2]       symbol id, length
+#   ids      expected token ids, every list ends with -1
+MAGIC = 0x706c7462
+VERSION = 2
+_HEADER = 10
+
+
+def _rules(parser):
+    rules = []
+    for symbol in parser.__symbols__:
+        rules.extend(symbol.rules)
+    return rules
+
+
+def _check_built(parser):
+    # a Lazy parser is not built behind the back of the caller
+    if not _built(parser):
+        raise RuntimeError(f'{parser.__name__} is not built, see Parser.warmup')
+
+
+def export_tables(parser):
+    _check_built(parser)
+    states = parser.__state_list__
+    token_ids = {token: idx for idx, token in enumerate(parser.__token_ids__)}
+    state_ids = {state: idx for idx, state in enumerate(states)}
+    rules = _rules(parser)
+    rule_ids = {rule: idx for idx, rule in enumerate(rules)}
+    nids = len(token_ids)
+
+    fingerprint = array('i')
+    fingerprint.frombytes(parser.__fingerprint__)
+    entries = [(parser.__start_symbol__, (parser.__state_tree__, parser.__start_wrapper__)),
+               *parser.__entries__.items()]
+    buffer = array('i', [MAGIC, VERSION, *fingerprint, len(states), nids, len(rules),
+                         len(entries)])
+    for symbol, (state, wrapper) in entries:
+        buffer.extend((token_ids[symbol], state_ids[state], token_ids[wrapper]))
+
+    expected = array('i')
+    offsets = {}
+    expect = array('i')
+    goto = array('i', [-1]) * (len(states) * nids)
+    reduce = array('i')
+    for idx, state in enumerate(states):
+        reduce.append(-1 if state.reduce_rule is None else rule_ids[state.reduce_rule])
+
+        immediate = tuple(token_ids[token] for token in state.immediate_tokens)
+        offset = offsets.get(immediate)
+        if offset is None:
+            offset = offsets[immediate] = len(expected)
+            expected.extend(immediate)
+            expected.append(-1)
+        expect.append(offset)
+
+        for token, target in state.branchs.items():
+            goto[idx * nids + token_ids[token]] = state_ids[target]
+
+    buffer.extend(reduce)
+    buffer.extend(expect)
+    buffer.extend(goto)
+    for rule in rules:
+        buffer.extend((token_ids[rule.symbol], len(rule)))
+    buffer.extend(expected)
+    return buffer.tobytes()
+
+
+class FlatTables:
+    """Parse tables read from a flat buffer of Parser.export_tables
+
+    The buffer is only read through a memoryview, so it can be shared by
+    processes, e.g. with multiprocessing.shared_memory or mmap, without a
+    State object per worker. The states are indexes, the parse loop of
+    Parser.parse reads them through goto, reduce_rule and expected, see
+    StateTables.
+    """
+
+    def __init__(self, parser, buffer):
+        _check_built(parser)
+        view = memoryview(buffer).cast('B').cast('i')
+        if len(view) < _HEADER or view[0] != MAGIC or view[1] != VERSION:
+            raise RuntimeError('not a parse table buffer')
+        if bytes(view[2:6]) != parser.__fingerprint__:
+            raise RuntimeError(f'parse tables do not match {parser.__name__}')
+
+        nstates, nids, nrules, nentries = view[6:_HEADER]
+        offset = _HEADER
+        entries = view[offset:offset + nentries * 3]
+        offset += nentries * 3
+        self._reduce = view[offset:offset + nstates]
+        offset += nstates
+        self._expect = view[offset:offset + nstates]
+        offset += nstates
+        self._goto = view[offset:offset + nstates * nids]
+        offset += nstates * nids
+        offset += nrules * 2
+        self._expected = view[offset:]
+
+        self._parser = parser
+        self._nids = nids
+        self._tokens = parser.__token_ids__
+        self._ids = {token: idx for idx, token in enumerate(self._tokens)}
+        self._rules = _rules(parser)
+
+        if len(self._rules) != nrules or len(self._tokens) != nids:
+            raise RuntimeError(f'parse tables do not match {parser.__name__}')
+
+        # (initial state, wrapper) by start symbol
+        self._entries = {}
+        for idx in range(0, len(entries), 3):
+            symbol, state, wrapper = entries[idx:idx + 3]
+            self._entries[self._tokens[symbol]] = (state, self._tokens[wrapper])
+        self._default = self._entries[parser.__start_symbol__]
+
+    def goto(self, state, token):
+        tid = self._ids.get(token, -1)
+        if tid == -1:
+            return None
+        target = self._goto[state * self._nids + tid]
+        return None if target == -1 else target
+
+    def reduce_rule(self, state):
+        ridx = self._reduce[state]
+        return None if ridx == -1 else self._rules[ridx]
+
+    def expected(self, state):
+        tokens = []
+        expected = 0
+        offset = self._expect[state]
+        while self._expected[offset] != -1:
+            tokens.append(self._tokens[self._expected[offset]])
+            expected |= 1 << self._expected[offset]
+            offset += 1
+        return _Expected(tuple(tokens), expected)
+
+    def _entry(self, start):
+        if start is None:
+            return self._default
+        entry = self._entries.get(start)
+        if entry is None:
+            raise TypeError(f'{start} is not a start symbol of {self._parser.__name__}')
+        return entry
+
+    def parse(self, scanner, context, errors=None, max_errors=100, start=None):
+        """Same as Parser.parse"""
+        state, wrapper = self._entry(start)
+        token_reader = TokenReader(scanner, wrapper)
+        _parse(token_reader, StateStack(state), context,
+               self._parser._recovery(errors, max_errors, self), tables=self)
+        return token_reader.pop().value
+
+    def iterparse(self, scanner, context, errors=None, max_errors=100, start=None):
+        """Same as Parser.iterparse"""
+        state, wrapper = self._entry(start)
+        return _iterparse(scanner, state, wrapper, context,
+                          self._parser._recovery(errors, max_errors, self), self)
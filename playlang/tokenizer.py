@@ -1,8 +1,13 @@
 # Copyright (C) 2023 pom@vro.life
 # SPDX-License-Identifier: LGPL-3.0-only OR GPL-2.0-only OR GPL-3.0-only
 import re
+from array import array
+try:
+    import re._parser as _sre_parse
+except ImportError:
+    import sre_parse as _sre_parse  # pylint: disable=deprecated-module
 from typing import List, Dict
-from playlang.classes import Terminal, Location, TokenValue, StaticField, Scanner
+from playlang.classes import Terminal, Location, TokenValue, StaticField, Scanner, _free_threaded
 
 
 class TrailingJunk(Exception):
@@ -18,12 +23,27 @@ class ContextError(Exception):
 
 
 class Tokenizer:
+    """Regular expression scanner for the start conditions of a parser.
+
+    A Tokenizer is not modified after construction and every call keeps its
+    state in its own Scan, so one instance can be used from many threads
+    at the same time.
+    """
+
     def __init__(self, clazz, default_action):
+        # the parser class, see __reduce__
+        self._parser = None if isinstance(clazz, dict) else clazz
         self.regexps = {}
         self._eof_tokens = {}
         self._default_action = default_action
-        self._actions = {}
+        # condition -> ({first character: alternation}, fallback alternation),
+        # see _compile
+        self._dispatch = {}
+        self._eof_actions = {}
         self._capture = {}
+        # token id -> Terminal, see tokenize_array
+        self.tokens = []
+        self._token_ids = {}
 
         if isinstance(clazz, dict):
             scanners = clazz
@@ -32,35 +52,44 @@ class Tokenizer:
 
         scanners: Dict[str, Scanner]
 
+        # token -> specialised action, see _convert
+        converters = {}
+
         for contition, scanner in scanners.items():
             self._eof_tokens[contition] = scanner.eof_token
 
             for token in scanner.tokens:
-                if token.capture:
+                if token not in self._token_ids:
+                    self._token_ids[token] = len(self.tokens)
+                    self.tokens.append(token)
+                    converters[token] = self._convert(token)
+
+            patterns = []
+            tokens = []
+            firsts = []
+            for token in scanner.tokens:
+                if scanner.captures(token):
                     self._capture[contition] = self._convert(token)
                     continue
 
                 if token.is_eof:
-                    self._actions[token.fullname] = self._convert(token)
+                    self._eof_actions[contition] = self._convert(token)
                     continue
 
-                if token.pattern is None:
+                pattern, trailing = map(token.data.get, ('pattern', 'trailing'))
+
+                if pattern is None:
                     raise TypeError(
                         f'token "{token.fullname}" missing pattern')
 
-                if not isinstance(token.pattern, (str, re.Pattern)):
+                if not isinstance(pattern, (str, re.Pattern)):
                     raise TypeError(
                         f'pattern must be "str" or "re.Pattern": {token.fullname}')
 
-                if token.fullname in self._actions:
-                    continue
-
-                self._actions[token.fullname] = self._convert(token)
-
-        for contition, scanner in scanners.items():
-            patterns = []
-            for token in scanner.tokens:
-                pattern, trailing = map(token.data.get, ('pattern', 'trailing'))
+                if isinstance(pattern, re.Pattern):
+                    firsts.append(_first_chars(pattern.pattern, pattern.flags))
+                else:
+                    firsts.append(_first_chars(pattern))
 
                 if trailing is None:
                     trailing = ""
@@ -68,118 +97,690 @@ class Tokenizer:
                     trailing = f'(?={trailing})'
 
                 patterns.append(f'(?P<{token.fullname}>{pattern}){trailing}')
-
-            self.regexps[contition] = re.compile('|'.join(patterns))
+                tokens.append(token)
+
+            full = self._compile(tokens, patterns, converters)
+            self.regexps[contition] = full[0]
+
+            # the alternation of the tokens that may start with a character,
+            # in the same order. tokens with unknown first characters are in
+            # every alternation and in the fallback.
+            known = set()
+            for first in firsts:
+                if first is not None:
+                    known |= first
+            compiled = {tuple(range(len(tokens))): full}
+            dispatch = {}
+            for char in known:
+                subset = tuple(idx for idx, first in enumerate(firsts)
+                               if first is None or char in first)
+                entry = compiled.get(subset)
+                if entry is None:
+                    entry = compiled[subset] = self._compile(
+                        [tokens[idx] for idx in subset], [patterns[idx] for idx in subset],
+                        converters)
+                dispatch[char] = entry
+            subset = tuple(idx for idx, first in enumerate(firsts) if first is None)
+            fallback = compiled.get(subset)
+            if fallback is None:
+                fallback = self._compile([tokens[idx] for idx in subset],
+                                         [patterns[idx] for idx in subset], converters)
+            self._dispatch[contition] = (dispatch, fallback)
+        self._fingerprint = None
+
+    def _compile(self, tokens, patterns, converters):
+        """Alternation of `patterns`, with the converters and array modes
+        of `tokens` indexed by regex group number"""
+        if not patterns:
+            # never match
+            patterns = ['(?!)']
+
+        regexp = re.compile('|'.join(patterns))
+
+        # m.lastindex may be a group nested in the token pattern or in
+        # its trailing context, map all of them to the token
+        actions = [None] * (regexp.groups + 1)
+        modes = [None] * (regexp.groups + 1)
+        for idx, token in enumerate(tokens):
+            first = regexp.groupindex[token.fullname]
+            if idx + 1 < len(tokens):
+                last = regexp.groupindex[tokens[idx + 1].fullname]
+            else:
+                last = regexp.groups + 1
+            action = converters[token]
+            mode = (self._token_ids[token], self._array_mode(token))
+            for group in range(first, last):
+                actions[group] = action
+                modes[group] = mode
+        return regexp, actions, modes
 
     def _convert(self, token: Terminal):
+        """Specialise the token action once, converters return None for discarded tokens"""
         action, discard = map(token.data.get, ('action', 'discard'))
+        default_action = self._default_action
+        if default_action is None:
+            default_action = _nop
 
-        def action_wrapper(context):
-            value = None
-            loc = context.location.copy()
-
-            if isinstance(action, type):
-                value = action(context.text)
-                self._default_action(context)
-
-            elif callable(action):
-                value = action(context)
-
-            if action is None:
-                value = context.text
-                self._default_action(context)
+        if token.data.get('delimited') is not None:
+            return self._convert_delimited(token, default_action)
 
+        if isinstance(action, type):
             if discard:
-                raise DiscardError()
-
+                def convert_discard(ctx):
+                    action(ctx.text)
+                    default_action(ctx)
+                return convert_discard
+
+            def convert(ctx):
+                loc = ctx.location.copy()
+                value = action(ctx.text)
+                default_action(ctx)
+                return TokenValue(token, value, loc)
+            return convert
+
+        if callable(action):
+            if discard:
+                def custom_discard(ctx):
+                    action(ctx)
+                return custom_discard
+
+            def custom(ctx):
+                loc = ctx.location.copy()
+                return TokenValue(token, action(ctx), loc)
+            return custom
+
+        if discard:
+            def text_discard(ctx):
+                default_action(ctx)
+            return text_discard
+
+        def text(ctx):
+            loc = ctx.location.copy()
+            default_action(ctx)
+            return TokenValue(token, ctx.text, loc)
+        return text
+
+    @staticmethod
+    def _convert_delimited(token: Terminal, default_action):
+        action, discard = map(token.data.get, ('action', 'discard'))
+        open_, close, escape, close_at_eof = token.data['delimited']
+        head = len(open_)
+        tail = len(close)
+        unescape = None
+        if escape is not None:
+            unescape = re.compile(re.escape(escape) + r'([\s\S])').sub
+
+        def closed(text):
+            # the region ends with `close` and not at the end of input
+            end = len(text) - tail
+            if end < head or not text.endswith(close):
+                return False
+            count = 0
+            while escape is not None and end - count > head and text[end - count - 1] == escape:
+                count += 1
+            return count % 2 == 0
+
+        def advance(ctx):
+            # the region may span lines
+            text = ctx.text
+            newlines = text.count('\n')
+            if newlines == 0:
+                default_action(ctx)
+            else:
+                ctx.lines(newlines)
+                ctx.step(len(text) - text.rindex('\n') - 1)
+
+        if discard:
+            return advance
+
+        def delimited(ctx):
+            loc = ctx.location.copy()
+            text = ctx.text
+            if close_at_eof and not closed(text):
+                value = text[head:]
+            else:
+                value = text[head:len(text) - tail]
+            if unescape is not None and escape in value:
+                value = unescape(r'\1', value)
+            if action is not None:
+                value = action(value)
+            advance(ctx)
             return TokenValue(token, value, loc)
+        return delimited
+
+    @property
+    def fingerprint(self):
+        """Digest of the token patterns, e.g. for the keys of a ParseCache"""
+        if self._fingerprint is None:
+            import hashlib  # pylint: disable=import-outside-toplevel
+            h = hashlib.blake2b(digest_size=16)
+            for contition, regexp in self.regexps.items():
+                h.update(f'{contition}\0{regexp.pattern}\0'.encode())
+            self._fingerprint = h.digest()
+        return self._fingerprint
+
+    @staticmethod
+    def _array_mode(token: Terminal):
+        action, discard = map(token.data.get, ('action', 'discard'))
+        if token.data.get('delimited') is not None:
+            return _ARRAY_SKIP if discard else _ARRAY_ACTION
+        if callable(action) and not isinstance(action, type):
+            return _ARRAY_ACTION
+        if discard:
+            return _ARRAY_SKIP
+        return _ARRAY_LAZY
+
+    def tokenize_array(self, string, filename='<memory>', ignore_tailing=False):
+        """Scan `string` into a TokenArray
+
+        Tokens with a type converter or without action are recorded by
+        offsets only, their values are converted on demand. Custom actions
+        still run since they may switch start conditions. The default action
+        is not called and no end of file token is recorded.
+        """
+        tokens, pos, _, _ = self._scan_array(string, 0, len(string), filename)
+        if pos != len(string) and not ignore_tailing:
+            raise TrailingJunk(_offset_location(string, pos, filename))
+        return tokens
+
+    def tokenize_parallel(self, string, filename='<memory>', ignore_tailing=False,
+                          boundary='\n', chunk_size=1 << 20, max_workers=None):
+        """Same as tokenize_array, the chunks of `string` are scanned in
+        parallel
+
+        The chunks are scanned on a thread pool on free-threaded Python
+        builds. With the GIL they are scanned by worker processes if the
+        tokenizer is a static field of its parser, see __reduce__, and the
+        values of custom actions can be pickled. The workers map the text
+        encoded to a temporary file and decode their chunks with the
+        characters around them, a token must be decided by the next
+        _SEAM_WINDOW characters; they send back the arrays. Otherwise this
+        is tokenize_array.
+
+        The chunks end after a `boundary`. A chunk is scanned from the
+        default condition, the scan of the previous chunk stops at the first
+        token boundary in the default condition after the seam. The chunk is
+        used from that offset if its own scan passed it in the default
+        condition, otherwise it is scanned again from there. Custom actions
+        must not depend on the tokens of other chunks.
+        """
+        cuts = [0]
+        while len(string) - cuts[-1] > chunk_size:
+            cut = string.find(boundary, cuts[-1] + chunk_size)
+            if cut == -1:
+                break
+            cuts.append(cut + len(boundary))
+        cuts.append(len(string))
+        chunks = [(cuts[idx], cuts[idx + 1]) for idx in range(len(cuts) - 1)
+                  if cuts[idx] < cuts[idx + 1]]
+
+        if len(chunks) <= 1:
+            return self.tokenize_array(string, filename, ignore_tailing)
+
+        typecode = 'I' if len(string) < 1 << 32 else 'Q'
+        # pylint: disable=import-outside-toplevel
+        if _free_threaded():
+            from concurrent.futures import ThreadPoolExecutor
+
+            def scan(chunk):
+                return self._scan_array(string, chunk[0], chunk[1], filename, _SEAM_WINDOW)
+
+            with ThreadPoolExecutor(max_workers) as executor:
+                results = list(executor.map(scan, chunks))
+        elif self._field_name() is not None:
+            import os
+            import tempfile
+            from concurrent.futures import ProcessPoolExecutor
+
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'text')
+                # the byte offsets of the chunks
+                offsets = []
+                with open(path, 'wb') as file:
+                    for start, end in chunks:
+                        offsets.append(file.tell())
+                        file.write(string[start:end].encode('utf-8', 'surrogatepass'))
+                    offsets.append(file.tell())
+
+                tasks = [(start, offsets[idx], offsets[idx + 1])
+                         for idx, (start, _) in enumerate(chunks)]
+                with ProcessPoolExecutor(max_workers, initializer=_init_worker,
+                                         initargs=(self, path, filename, typecode)) as executor:
+                    results = [(self._array(string, *arrays), stop, seams, junk)
+                               for arrays, stop, seams, junk in executor.map(_scan_chunk, tasks)]
+        else:
+            return self.tokenize_array(string, filename, ignore_tailing)
 
-        return action_wrapper
+        tokens = TokenArray(string, self.tokens, typecode, filename)
+        pos = 0
+        for (_, end), (chunk, stop, seams, junk) in zip(chunks, results):
+            if end <= pos:
+                # covered by a token of the previous chunk
+                continue
+            first = seams.get(pos)
+            if first is None:
+                # the seam is inside a token or a start condition, or the
+                # scan of the chunk from inside of it failed before the seam
+                chunk, stop, _, junk = self._scan_array(string, pos, end, filename)
+                first = 0
+            tokens._extend(chunk, first)
+            pos = stop
+            if junk:
+                break
 
-    def __call__(self, string, filename='<memory>', ignore_tailing=False, eof_stop=False):
-        location = Location(filename=filename)
-        stack = []
-        leave = False
-
-        this = self
-
-        class Context:
-            def __init__(self, name, regexp, value, end_of_file):
-                self.name = name
-                self._regexp = regexp
-                self._value = value
-                self._end_of_file = end_of_file
-                self.text = None
-
-            def __repr__(self):
-                return self.name
-
-            def step(self, n=None):
-                nonlocal location
-                if n is None:
-                    location.step(len(self.text))
-                else:
-                    location.step(n)
-                return self
+        if pos != len(string) and not ignore_tailing:
+            raise TrailingJunk(_offset_location(string, pos, filename))
+        return tokens
+
+    def _field_name(self):
+        # the attribute of the parser class holding this tokenizer
+        if self._parser is not None:
+            for name, value in vars(self._parser).items():
+                if value is self:
+                    return name
+        return None
+
+    def __reduce__(self):
+        """Pickled by reference to the static field of its parser, e.g.
+        for the worker processes of tokenize_parallel"""
+        name = self._field_name()
+        if name is None:
+            raise TypeError('only a tokenizer of a static field can be pickled')
+        return getattr, (self._parser, name)
+
+    def _array(self, string, ids, starts, ends, values):
+        # TokenArray of the buffers of a worker process, see _scan_chunk
+        tokens = TokenArray(string, self.tokens, 'I' if len(string) < 1 << 32 else 'Q')
+        tokens.ids.frombytes(ids)
+        tokens.starts.frombytes(starts)
+        tokens.ends.frombytes(ends)
+        tokens._values = values
+        return tokens
+
+    def _scan_array(self, string, start, end, filename, window=0):
+        """Scan `string` from `start` in the default condition until the
+        first token boundary at or after `end` in the default condition
+
+        Returns the TokenArray, the offset the scan stopped at, the token
+        counts at the boundaries in the default condition of the first
+        `window` characters by offset, and whether no token matched at the
+        offset the scan stopped at.
+        """
+        scan = Scan(self, Location(filename=filename))
+        stack = scan.stack
+        stack.append(Context(scan, '__default__'))
+        last = end == len(string)
+
+        typecode = 'I' if len(string) < 1 << 32 else 'Q'
+        tokens = TokenArray(string, self.tokens, typecode, filename)
+        ids = tokens.ids
+        starts = tokens.starts
+        ends = tokens.ends
+        values = tokens._values
+
+        def append(tv, start, end):
+            values[len(ids)] = tv.value
+            ids.append(self._token_ids[tv.token])
+            starts.append(start)
+            ends.append(end)
+
+        seams = {}
+        window += start
+
+        # start offsets of the entered conditions
+        regions = [0]
+        eof_ctx = None
+
+        pos = start
+        while True:
+            ctx = stack[-1]
+            try:
+                if scan.leave:
+                    scan.leave = False
+                    start = regions.pop()
+                    if ctx._capture is not None:
+                        tv = ctx._capture(ctx)
+                        if tv is not None:
+                            append(tv, start, pos)
+                    stack.pop()
+                    ctx = stack[-1]
 
-            def lines(self, n):
-                location.lines(n)
-                return self
+                if len(stack) == 1 and (pos < window or pos >= end):
+                    if pos < window:
+                        seams[pos] = len(ids)
+                    if pos >= end and not last:
+                        break
 
-            @property
-            def value(self):
-                return self._value
+                if pos == len(string):
+                    if len(stack) == 1 or ctx is eof_ctx:
+                        break
+                    # give the condition a chance to leave
+                    eof_ctx = ctx
+                    ctx.text = '__EOF__'
+                    ctx._eof_action(ctx)
+                    continue
 
-            @property
-            def location(self):
-                return location
+                regexp, actions, modes = ctx._dispatch.get(string[pos], ctx._fallback)
+                m = regexp.match(string, pos)
+                if m is None:
+                    return tokens, pos, seams, True
+                start = pos
+                pos = m.end()
+                tid, mode = modes[m.lastindex]
+                if mode is _ARRAY_LAZY:
+                    ids.append(tid)
+                    starts.append(start)
+                    ends.append(pos)
+                elif mode is _ARRAY_ACTION:
+                    ctx.text = m.group()
+                    tv = actions[m.lastindex](ctx)
+                    if len(stack) > len(regions):
+                        regions.append(start)
+                    if tv is not None:
+                        append(tv, start, pos)
 
-            def enter(self, name, value=None):
-                nonlocal stack
-                stack.append(Context(name, this.regexps[name], value, this._eof_tokens[name]))
-                return self
+            except DiscardError:
+                continue
 
-            def leave(self):
-                nonlocal leave
-                if stack.__len__() == 1:
-                    raise Exception('leave top context are not allowed')
-                leave = True
-                return self
+        return tokens, pos, seams, False
 
-        stack.append(
-            Context('__default__', self.regexps['__default__'], None, self._eof_tokens['__default__']))
+    def __call__(self, string, filename='<memory>', ignore_tailing=False, eof_stop=False):
+        scan = Scan(self, Location(filename=filename))
+        stack = scan.stack
+        stack.append(Context(scan, '__default__'))
 
         pos = 0
         while True:
             ctx = stack[-1]
             try:
-                if leave:
-                    leave = False
-                    if ctx.name in self._capture:
-                        yield self._capture[ctx.name](ctx)
+                if scan.leave:
+                    scan.leave = False
+                    if ctx._capture is not None:
+                        tv = ctx._capture(ctx)
+                        if tv is not None:
+                            yield tv
                     stack.pop()
                     ctx = stack[-1]
 
                 # is EOF
                 if pos == len(string):
                     ctx.text = '__EOF__'
-                    yield self._actions[ctx._end_of_file.fullname](ctx)
-                    if eof_stop:
-                        break
+                    tv = ctx._eof_action(ctx)
+                    if tv is not None:
+                        yield tv
+                        if eof_stop:
+                            break
                     continue
 
-                m = ctx._regexp.match(string, pos)
+                regexp, actions, _ = ctx._dispatch.get(string[pos], ctx._fallback)
+                m = regexp.match(string, pos)
                 if m is None:
                     break
-                pos = m.end(m.lastgroup)
+                pos = m.end()
                 ctx.text = m.group()
-                yield self._actions[m.lastgroup](ctx)
+                tv = actions[m.lastindex](ctx)
+                if tv is not None:
+                    yield tv
 
             except DiscardError:
                 continue
 
         if pos != len(string) and not ignore_tailing:
-            raise TrailingJunk(location)
+            raise TrailingJunk(scan.location)
+
+
+def _nop(ctx):
+    pass
+
+
+def _offset_location(string, pos, filename):
+    line = string.count('\n', 0, pos)
+    return Location(line + 1, pos - string.rfind('\n', 0, pos), filename)
+
+
+# characters at the start of a chunk in which the scan of the previous
+# chunk may stop, see Tokenizer.tokenize_parallel
+_SEAM_WINDOW = 4096
+
+# tokenizer, mapped text, filename and offset typecode of a worker process
+# of tokenize_parallel
+_worker = None
+
+
+def _init_worker(tokenizer, path, filename, typecode):
+    import mmap  # pylint: disable=import-outside-toplevel
+    global _worker  # pylint: disable=global-statement
+    with open(path, 'rb') as file:
+        text = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    _worker = tokenizer, text, filename, typecode
+
+
+def _char_start(text, pos):
+    # the start of the UTF-8 sequence at byte `pos`
+    while 0 < pos < len(text) and text[pos] & 0xc0 == 0x80:
+        pos -= 1
+    return pos
+
+
+def _scan_chunk(task):
+    # `offset` is the character offset of the chunk, `first` and `last` its
+    # bytes. The lookbehinds see the _SEAM_WINDOW characters before the chunk,
+    # the text after it grows until the scan stops at a token _SEAM_WINDOW
+    # characters before its end, e.g. a string may be closed after it
+    tokenizer, text, filename, typecode = _worker
+    offset, first, last = task
+    head = text[_char_start(text, max(0, first - _SEAM_WINDOW * 4)):first]
+    head = head.decode('utf-8', 'surrogatepass')[-_SEAM_WINDOW:]
+    body = text[first:last].decode('utf-8', 'surrogatepass')
+    size = _SEAM_WINDOW * 4
+    while True:
+        end = _char_start(text, min(len(text), last + size))
+        string = head + body + text[last:end].decode('utf-8', 'surrogatepass')
+        tokens, stop, seams, junk = tokenizer._scan_array(
+            string, len(head), len(head) + len(body), filename, _SEAM_WINDOW)
+        if end == len(text) or not junk and stop + _SEAM_WINDOW <= len(string):
+            break
+        size *= 2
+
+    base = offset - len(head)
+    arrays = (tokens.ids.tobytes(),
+              array(typecode, [pos + base for pos in tokens.starts]).tobytes(),
+              array(typecode, [pos + base for pos in tokens.ends]).tobytes(),
+              tokens._values)
+    return arrays, stop + base, {pos + base: count for pos, count in seams.items()}, junk
+
+
+# larger character classes are treated as unknown
+_MAX_FIRST_CHARS = 256
+
+
+def _first_chars(pattern, flags=0):
+    """Characters a match of `pattern` can start with
+
+    None if they can not be determined or the pattern matches the empty
+    string.
+    """
+    try:
+        parsed = _sre_parse.parse(pattern, flags)
+    except re.error:
+        return None
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    if state.flags & re.IGNORECASE:
+        return None
+    chars, nullable = _first_of(parsed)
+    if nullable:
+        return None
+    return chars
+
+
+def _first_of(items):
+    chars = set()
+    for op, av in items:
+        first, nullable = _first_item(op, av)
+        if first is None:
+            return None, False
+        chars |= first
+        if len(chars) > _MAX_FIRST_CHARS:
+            return None, False
+        if not nullable:
+            return chars, False
+    return chars, True
+
+
+def _first_item(op, av):  # pylint: disable=too-many-return-statements
+    P = _sre_parse
+    if op is P.LITERAL:
+        return {chr(av)}, False
+    if op is P.IN:
+        chars = set()
+        for kind, value in av:
+            if kind is P.LITERAL:
+                chars.add(chr(value))
+            elif kind is P.RANGE and value[1] - value[0] < _MAX_FIRST_CHARS:
+                chars.update(map(chr, range(value[0], value[1] + 1)))
+            else:
+                # NEGATE, CATEGORY or a large range
+                return None, False
+        return chars, False
+    if op in (P.AT, P.ASSERT, P.ASSERT_NOT):
+        # zero width
+        return set(), True
+    if op is P.SUBPATTERN:
+        _, add_flags, _, items = av
+        if add_flags & re.IGNORECASE:
+            return None, False
+        return _first_of(items)
+    if op is getattr(P, 'ATOMIC_GROUP', None):
+        return _first_of(av)
+    if op is P.BRANCH:
+        chars = set()
+        nullable = False
+        for items in av[1]:
+            first, empty = _first_of(items)
+            if first is None:
+                return None, False
+            chars |= first
+            nullable = nullable or empty
+        return chars, nullable
+    if op in (P.MAX_REPEAT, P.MIN_REPEAT, getattr(P, 'POSSESSIVE_REPEAT', None)):
+        low, _, items = av
+        first, nullable = _first_of(items)
+        if first is None:
+            return None, False
+        return first, nullable or low == 0
+    return None, False
+
+
+_ARRAY_LAZY = 'lazy'
+_ARRAY_SKIP = 'skip'
+_ARRAY_ACTION = 'action'
+
+
+class TokenArray:
+    """Tokens of a text as parallel arrays
+
+    `ids[i]` indexes `tokens`, `starts[i]` and `ends[i]` are offsets in
+    `text`, `filename` is the name of `text` in locations. The arrays
+    support the buffer protocol, e.g. `numpy.frombuffer(array.ids, numpy.uint16)`.
+    """
+
+    def __init__(self, text, tokens, typecode='I', filename='<memory>'):
+        self.text = text
+        self.tokens = tokens
+        self.filename = filename
+        self.ids = array('H')
+        self.starts = array(typecode)
+        self.ends = array(typecode)
+        # values computed by custom actions, by token index
+        self._values = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _extend(self, other, first=0):
+        # append the tokens of `other` from index `first`
+        offset = len(self.ids) - first
+        for idx, value in other._values.items():
+            if idx >= first:
+                self._values[idx + offset] = value
+        self.ids.extend(other.ids[first:])
+        self.starts.extend(other.starts[first:])
+        self.ends.extend(other.ends[first:])
+
+    def token(self, idx):
+        return self.tokens[self.ids[idx]]
+
+    def text_of(self, idx):
+        return self.text[self.starts[idx]:self.ends[idx]]
+
+    def value(self, idx):
+        """Value of the idx-th token, converted on demand"""
+        if idx in self._values:
+            return self._values[idx]
+        action = self.tokens[self.ids[idx]].data.get('action')
+        text = self.text[self.starts[idx]:self.ends[idx]]
+        if action is None:
+            return text
+        return action(text)
+
+
+class Scan:
+    """Mutable state of one Tokenizer call"""
+    __slots__ = ('tokenizer', 'location', 'stack', 'leave')
+
+    def __init__(self, tokenizer, location):
+        self.tokenizer = tokenizer
+        self.location = location
+        self.stack = []
+        self.leave = False
+
+
+class Context:
+    """Start condition of a scan, passed to token actions"""
+    __slots__ = ('name', 'text', '_dispatch', '_fallback', '_eof_action', '_capture',
+                 '_value', '_scan')
+
+    def __init__(self, scan, name, value=None):
+        tokenizer = scan.tokenizer
+        self.name = name
+        self.text = None
+        self._dispatch, self._fallback = tokenizer._dispatch[name]
+        self._eof_action = tokenizer._eof_actions[name]
+        self._capture = tokenizer._capture.get(name)
+        self._value = value
+        self._scan = scan
+
+    def __repr__(self):
+        return self.name
+
+    def step(self, n=None):
+        if n is None:
+            self._scan.location.step(len(self.text))
+        else:
+            self._scan.location.step(n)
+        return self
+
+    def lines(self, n):
+        self._scan.location.lines(n)
+        return self
+
+    @property
+    def value(self):
+        return self._value
+
+    @property
+    def location(self):
+        return self._scan.location
+
+    def enter(self, name, value=None):
+        self._scan.stack.append(Context(self._scan, name, value))
+        return self
+
+    def leave(self):
+        if len(self._scan.stack) == 1:
+            raise ContextError('leave top context are not allowed')
+        self._scan.leave = True
+        return self
 
 
 class StaticTokenizer(StaticField):
@@ -0,0 +1,238 @@
+# Copyright (C) 2023 pom@vro.life
+# SPDX-License-Identifier: LGPL-3.0-only OR GPL-2.0-only OR GPL-3.0-only
+from array import array
+from playlang.classes import Symbol, TokenValue
+from playlang.errors import UnexpectedTokenError
+from playlang.parser import TokenReader, StateStack, StateTables, _parse
+from playlang.tables import _rules
+from playlang.tokenizer import _offset_location
+
+
+class Cursor:
+    """A node of a ParseTree"""
+    __slots__ = ('tree', 'node')
+
+    def __init__(self, tree, node):
+        self.tree = tree
+        self.node = node
+
+    def __eq__(self, other):
+        return isinstance(other, Cursor) and self.tree is other.tree and self.node == other.node
+
+    def __hash__(self):
+        return self.node
+
+    def __repr__(self):
+        return f'<{self.symbol} {self.start}:{self.end}>'
+
+    def _move(self, node):
+        return None if node == -1 else Cursor(self.tree, node)
+
+    @property
+    def rule(self):
+        return self.tree.rules[self.tree.kinds[self.node]]
+
+    @property
+    def symbol(self):
+        return self.rule.symbol
+
+    @property
+    def start(self):
+        """Index of the first token in the TokenArray"""
+        return self.tree.starts[self.node]
+
+    @property
+    def end(self):
+        """Index after the last token in the TokenArray"""
+        return self.tree.ends[self.node]
+
+    @property
+    def text(self):
+        tokens = self.tree.tokens
+        start = self.start
+        end = self.end
+        if start == end:
+            return ''
+        return tokens.text[tokens.starts[start]:tokens.ends[end - 1]]
+
+    def parent(self):
+        return self._move(self.tree.parents[self.node])
+
+    def first_child(self):
+        return self._move(self.tree.first_children[self.node])
+
+    def next_sibling(self):
+        return self._move(self.tree.next_siblings[self.node])
+
+    def children(self):
+        """The child nodes, the tokens of the rule are not nodes"""
+        tree = self.tree
+        node = tree.first_children[self.node]
+        while node != -1:
+            yield Cursor(tree, node)
+            node = tree.next_siblings[node]
+
+
+class ParseTree:
+    """Concrete syntax tree as parallel arrays, see Parser.parse_tree
+
+    Node `n` is a reduction of `rules[kinds[n]]` from the token
+    `starts[n]` of `tokens` to the token before `ends[n]`. The tokens are
+    not nodes, the child nodes are linked by `first_children` and
+    `next_siblings`, -1 stands for none.
+
+    A node takes 22 bytes. Token-dense input, e.g. the expressions of
+    bench_py.py tree, has about one node per token and needs about 7 bytes
+    of tree per byte of text, sparser input less.
+    """
+
+    def __init__(self, tokens, rules):
+        self.tokens = tokens
+        self.rules = rules
+        self.kinds = array('H' if len(rules) < 1 << 16 else 'I')
+        self.parents = array('i')
+        self.first_children = array('i')
+        self.next_siblings = array('i')
+        self.starts = array('i')
+        self.ends = array('i')
+        self.root = -1
+        # reductions of the unit rules that Parser.parse skips, see PassThrough
+        self.skipped = 0
+        self._index = None
+
+    def __len__(self):
+        return len(self.kinds)
+
+    @property
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (
+            self.kinds, self.parents, self.first_children, self.next_siblings, self.starts,
+            self.ends))
+
+    def cursor(self, node=None):
+        return Cursor(self, self.root if node is None else node)
+
+    def end(self, node):
+        """Index after the last token of `node`"""
+        return self.ends[node]
+
+    def nodes(self, symbol):
+        """Nodes of `symbol` in the order of their reduction"""
+        if self._index is None:
+            index = {}
+            symbols = [rule.symbol for rule in self.rules]
+            for node, kind in enumerate(self.kinds):
+                nodes = index.get(symbols[kind])
+                if nodes is None:
+                    nodes = index[symbols[kind]] = array('i')
+                nodes.append(node)
+            self._index = index
+        return self._index.get(symbol, array('i'))
+
+
+class _TokenArrayReader(TokenReader):
+    """Reads a TokenArray, the value of a token is its index"""
+
+    def __init__(self, tokens, start, eof_token):
+        super().__init__(None, start)
+        self._terminals = tokens.tokens
+        self._ids = tokens.ids
+        self._eof_token = eof_token
+        self._pos = 0
+
+    def _read(self):
+        pos = self._pos
+        if pos < len(self._ids):
+            self._pos = pos + 1
+            return TokenValue(self._terminals[self._ids[pos]], pos, None)
+        # the end of file is read again after it is shifted
+        return TokenValue(self._eof_token, pos, None)
+
+
+class _TreeTables(StateTables):
+    """The tables of the parser without the shortcuts of the pass-through
+    unit rules, the skipped reductions are nodes"""
+
+    def __init__(self, tree, shortcuts):
+        self._tree = tree
+        # state -> token -> (original target, skipped rules)
+        self._shortcuts = {}
+        for (state, token), shortcut in shortcuts.items():
+            self._shortcuts.setdefault(state, {})[token] = shortcut
+
+    def goto(self, state, token):
+        shortcuts = self._shortcuts.get(state)
+        if shortcuts is not None:
+            shortcut = shortcuts.get(token)
+            if shortcut is not None:
+                self._tree.skipped += len(shortcut[1])
+                return shortcut[0]
+        return state.get_branch(token)
+
+
+def parse_tree(parser, tokens, start=None):
+    state, wrapper = parser._entry(start)
+    eof_token = parser.__scanners__['__default__'].eof_token
+    rules = _rules(parser)
+    # rule -> index, whether the first and the last components are symbols
+    # and the positions of the symbols
+    rule_info = {}
+    for idx, rule in enumerate(rules):
+        slots = tuple(pos for pos, component in enumerate(rule) if isinstance(component, Symbol))
+        rule_info[rule] = (idx, bool(slots) and slots[0] == 0,
+                           bool(slots) and slots[-1] == len(rule) - 1, slots)
+
+    tree = ParseTree(tokens, rules)
+    kinds = tree.kinds
+    parents = tree.parents
+    first_children = tree.first_children
+    next_siblings = tree.next_siblings
+    starts = tree.starts
+    ends = tree.ends
+    token_reader = _TokenArrayReader(tokens, wrapper, eof_token)
+
+    def build(rule, values):
+        # the value of a symbol is its node, the value of a token its index
+        if rule.symbol is wrapper:
+            return values[0].value
+        kind, first_symbol, last_symbol, slots = rule_info[rule]
+        node = len(kinds)
+        if not values:
+            start = end = token_reader.peek().value
+        else:
+            start = starts[values[0].value] if first_symbol else values[0].value
+            end = ends[values[-1].value] if last_symbol else values[-1].value + 1
+        kinds.append(kind)
+        parents.append(-1)
+        next_siblings.append(-1)
+        starts.append(start)
+        ends.append(end)
+
+        previous = -1
+        for pos in slots:
+            child = values[pos].value
+            parents[child] = node
+            if previous == -1:
+                first_children.append(child)
+            else:
+                next_siblings[previous] = child
+            previous = child
+        if previous == -1:
+            first_children.append(-1)
+        return node
+
+    try:
+        _parse(token_reader, StateStack(state), None,
+               tables=_TreeTables(tree, parser.__shortcuts__), build=build)
+    except UnexpectedTokenError as e:
+        # the token values are indexes
+        pos = e.value
+        if pos < len(tokens):
+            value = tokens.value(pos)
+            location = _offset_location(tokens.text, tokens.starts[pos], tokens.filename)
+        else:
+            value = '__EOF__'
+            location = _offset_location(tokens.text, len(tokens.text), tokens.filename)
+        raise UnexpectedTokenError(TokenValue(e.token, value, location), e._state) from None
+    tree.root = token_reader.pop().value
+    return tree
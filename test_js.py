@@ -1,11 +1,13 @@
 # Copyright (C) 2023 pom@vro.life
 # SPDX-License-Identifier: MIT OR LGPL-3.0-only OR GPL-2.0-only OR GPL-3.0-only
 import os
+import json
 import tempfile
 import shutil
 import unittest
 from playlang.javascript import JavaScript
-from test_py import ParserCalc, ParserListWithTemplate
+from test_py import ParserCalc, ParserListWithTemplate, ParserDelimited, DELIMITED_SOURCE, \
+    ParserStatements, ParserCombinators, ParserUnitRules
 
 
 def test(cls, source):
@@ -77,7 +79,7 @@ function assert(code, other) {
 try {
     parsercalc_parse(parsercalc_scan('1x'), context)
 } catch(e) {
-    assert(`"${e.message}"`, '<memory>0:0 => unexpected token Name(x), expecting one of [End-Of-File PLUS MINUS TIMES DIVIDE]')
+    assert(`"${e.message}"`, '<memory>0:0 => unexpected token Name(x), expecting one of [__EOF__ Plus MINUS TIMES DIVIDE]')
 }
 
 assert(`parsercalc_parse(parsercalc_scan('y="123"'), context)`, '123')
@@ -128,5 +130,68 @@ if (lst.join('') !== '1world!2') {
     throw new Error(lst)
 }
 
+""")
+        self.assertTrue(status == 0)
+
+    def test_delimited(self):
+        status = test(ParserDelimited, """
+import { parserdelimited_scan, parserdelimited_parse } from './parser.js'
+
+const lst = parserdelimited_parse(parserdelimited_scan(%s))
+if (JSON.stringify(lst) !== JSON.stringify([1, 'a"b', 'x', '\\n'])) {
+    throw new Error(JSON.stringify(lst))
+}
+const eof = parserdelimited_parse(parserdelimited_scan('1 %%a\\n2 # c\\n3 %%b'))
+if (JSON.stringify(eof) !== JSON.stringify([1, 'a', 2, 3, 'b'])) {
+    throw new Error(JSON.stringify(eof))
+}
+""" % json.dumps(DELIMITED_SOURCE))
+        self.assertTrue(status == 0)
+
+    def test_start_symbols(self):
+        status = test(ParserStatements, """
+import { parserstatements_scan, parserstatements_parse } from './parser.js'
+
+const lst = parserstatements_parse(parserstatements_scan('1 + 2; 3'))
+if (JSON.stringify(lst) !== '[3,3]') {
+    throw new Error(JSON.stringify(lst))
+}
+const expr = parserstatements_parse(parserstatements_scan('1 + 2'), undefined, 'EXPR')
+if (expr !== 3) {
+    throw new Error(expr)
+}
+try {
+    parserstatements_parse(parserstatements_scan('1; 2'), undefined, 'EXPR')
+    throw new Error('no error')
+} catch (e) {
+    if (e.message.indexOf('unexpected token SEMI') < 0) {
+        throw e
+    }
+}
+""")
+        self.assertTrue(status == 0)
+
+    def test_combinators(self):
+        status = test(ParserCombinators, """
+import { parsercombinators_scan, parsercombinators_parse } from './parser.js'
+
+for (const [text, expected] of [['[1, -2] [] [3]', '[[1,-2],[],[3]]'], ['', '[]']]) {
+    const lists = parsercombinators_parse(parsercombinators_scan(text))
+    if (JSON.stringify(lists) !== expected) {
+        throw new Error(JSON.stringify(lists))
+    }
+}
+""")
+        self.assertTrue(status == 0)
+
+    def test_pass_through(self):
+        # the action of a PassThrough rule is replaced by the identity
+        status = test(ParserUnitRules, """
+import { parserunitrules_scan, parserunitrules_parse } from './parser.js'
+
+const value = parserunitrules_parse(parserunitrules_scan('1 + -2 + 3'))
+if (value !== 2) {
+    throw new Error(value)
+}
 """)
         self.assertTrue(status == 0)
@@ -5,12 +5,22 @@
 # pylint: disable=invalid-name
 
 import io
+import sys
+import mmap
+import pickle
+import tempfile
+import threading
 import logging
+import time
 import unittest
-from playlang import Parser, Token, Rule, Precedence, Scanner, Start,\
-    Action, ShowName, Tokenizer, StaticTokenizer, \
-    ConflictReduceReduceError, ConflictShiftReduceError
+import unittest.mock
+import concurrent.futures
+from playlang import Parser, Token, Delimited, Rule, Precedence, Scanner, Start,\
+    Action, ShowName, Emit, Memoize, Pure, PassThrough, Lazy, ParallelList, Tokenizer, StaticTokenizer, \
+    Many, Many1, SepBy, Optional, \
+    ConflictReduceReduceError, ConflictShiftReduceError, UnexpectedTokenError
 from playlang.classes import SymbolRule, Terminal
+from playlang.tokenizer import TrailingJunk, _first_chars
 from playlang.syntex import Syntax
 from playlang.javascript import JavaScript
 
@@ -191,6 +201,34 @@ class ParserCalc(metaclass=Parser):
         return ParserCalc.parse(ParserCalc.scanner(string), context=self)
 
 
+class TestPrecedence(unittest.TestCase):
+    def test_lower_precedence(self):
+        # the rule binds to the precedence of A, lower than the one of B
+        def define():
+            class ParserLower(metaclass=Parser):
+                A = Token('a')
+                _ = Precedence.Left
+                B = Token('b')
+
+                _ = Scanner(A, B)
+
+                @Rule(B, A)
+                @staticmethod
+                def PAIR(context, b, a):
+                    return b + a
+
+                _ = Start(PAIR)
+
+                scanner = StaticTokenizer()
+            return ParserLower
+
+        with self.assertLogs(level=logging.DEBUG) as logs:
+            parser = define()
+        self.assertIn('rule bind to lower precedence', logs.output[0])
+        self.assertEqual(parser.parse(parser.scanner('ba'), None), 'ba')
+        self.assertEqual(str(parser.PAIR.rules[0]).split(' <')[0], '{ PAIR -> [B, A]')
+
+
 class TestCalc(unittest.TestCase):
     def test_right_associativity(self):
         compiler = ParserCalc()
@@ -266,6 +304,213 @@ class TestCalc(unittest.TestCase):
             compiler.NAME, compiler.EQUALS, compiler.NUMBER, compiler.PLUS, compiler.NUMBER])
 
 
+class TestThreadSafety(unittest.TestCase):
+    def test_thread_pool(self):
+        inputs = [(f'x={i}+{i}*2', i * 3) for i in range(200)]
+        inputs += [(f'y="{i}\\"{i}"', f'{i}"{i}') for i in range(200)]
+
+        def parse(source):
+            return ParserCalc().parse_string(source)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(parse, [source for source, _ in inputs]))
+
+        self.assertListEqual(results, [expect for _, expect in inputs])
+
+    def test_parse_parallel(self):
+        inputs = [f'{i}*2+1' for i in range(100)]
+        results = ParserCalc.parse_parallel(inputs, ParserCalc.scanner, ParserCalc, max_workers=4)
+        self.assertListEqual(results, [i * 2 + 1 for i in range(100)])
+
+    def test_frozen_tables(self):
+        state = ParserCalc.__state_tree__
+        self.assertRaises(TypeError, lambda: state.set_branch(ParserCalc.NUMBER, state))
+        self.assertIsInstance(ParserCalc.__state_list__, tuple)
+        self.assertIsInstance(ParserCalc.__syntax__._merged_states, frozenset)
+        self.assertIsInstance(ParserCalc.EXPR.rules, tuple)
+
+        def modify():
+            ParserCalc.NUMBER.data['ignorable'] = True
+        self.assertRaises(TypeError, modify)
+
+    def test_interleaved_scans(self):
+        scans = [ParserCalc.scanner(f'"{i}{i}"+{i}', eof_stop=True) for i in range(3)]
+        tokens = [[] for _ in scans]
+        for _ in range(4):
+            for idx, scan in enumerate(scans):
+                tokens[idx].append(next(scan).value)
+        self.assertListEqual(tokens, [[f'{i}{i}', '+', i, '__EOF__'] for i in range(3)])
+
+
+class TestReport(unittest.TestCase):
+    def test_report(self):
+        buf = io.StringIO()
+        ParserCalc.__report__(buf)
+        report = buf.getvalue()
+        self.assertIn(f'states: {len(ParserCalc.__state_list__)}', report)
+        self.assertIn('merge: ', report)
+        self.assertIn('static field scanner: ', report)
+        self.assertIn('shift/reduce => reduce, left associative', report)
+
+    def test_conflicts(self):
+        resolutions = set()
+        for (kind, rule1, rule2), resolution in ParserCalc.__syntax__.conflicts.items():
+            resolutions.add((kind, tuple(rule1), tuple(rule2), resolution))
+        c = ParserCalc
+        self.assertIn(('shift/reduce', (c.EXPR, c.PLUS, c.EXPR), (c.EXPR, c.TIMES, c.EXPR),
+                       'shift, higher precedence'), resolutions)
+        self.assertIn(('shift/reduce', (c.MINUS, c.EXPR), (c.EXPR, c.TIMES, c.EXPR),
+                       'reduce, higher precedence'), resolutions)
+
+
+class TestPushParser(unittest.TestCase):
+    def test_feed(self):
+        compiler = ParserCalc()
+        parser = ParserCalc.push(compiler)
+        for tv in ParserCalc.scanner('2+3*4', eof_stop=True):
+            if tv.token.is_eof:
+                break
+            self.assertFalse(parser.feed(tv))
+        self.assertEqual(parser.finish(), 14)
+        self.assertTrue(parser.done)
+        self.assertListEqual(compiler.steps, [2, 3, 4, '3*4', '2+12'])
+
+    def test_feed_text(self):
+        parser = ParserCalc.push(ParserCalc(), ParserCalc.scanner)
+        parser.feed_text('2+')
+        parser.feed_text('(3+4)')
+        self.assertEqual(parser.finish(), 9)
+
+    def test_snapshot(self):
+        parser = ParserCalc.push(ParserCalc(), ParserCalc.scanner)
+        parser.feed_text('2*')
+        snapshot = parser.copy()
+        parser.feed_text('3')
+        snapshot.feed_text('4')
+        self.assertEqual(parser.finish(), 6)
+        self.assertEqual(snapshot.finish(), 8)
+
+    def test_error(self):
+        parser = ParserCalc.push(ParserCalc(), ParserCalc.scanner)
+        parser.feed_text('1')
+        self.assertRaises(SyntaxError, lambda: parser.feed_text('x'))
+
+    def test_repeated_eof(self):
+        parser = ParserPair.push(ParserPair())
+        for tv in ParserPair()._tokenizer('2 3 4', eof_stop=True):
+            if tv.token.is_eof:
+                break
+            parser.feed(tv)
+        self.assertListEqual(parser.finish(), [('2', '3'), ('4', None)])
+
+
+class ParserRecovery(metaclass=Parser):
+    NUMBER = Token(r'[0-9]+', action=int, show_name='Number')
+    PLUS = Token(r'\+')
+    SEMI = Token(r';')
+    WHITE = Token(r'\s+', discard=True)
+    ERROR = Token(is_error=True)
+
+    _ = Scanner(NUMBER, PLUS, SEMI, WHITE)
+
+    @Rule(NUMBER)
+    def EXPR(self, value):
+        return value
+
+    @Rule(EXPR, PLUS, NUMBER)
+    def EXPR(self, expr, _, value):
+        return expr + value
+
+    @Rule(EXPR, SEMI)
+    def STMT(self, expr, _):
+        return expr
+
+    @Rule(ERROR, SEMI)
+    def STMT(self, error, _):
+        return None
+
+    @Rule(STMT)
+    def LIST(self, stmt):
+        return [stmt]
+
+    @Rule(LIST, STMT)
+    def LIST(self, lst, stmt):
+        lst.append(stmt)
+        return lst
+
+    _ = Start(LIST)
+
+    scanner = StaticTokenizer(default_action=lambda ctx: ctx.step(len(ctx.text)))
+
+
+class TestErrorRecovery(unittest.TestCase):
+    def test_no_recovery(self):
+        self.assertRaises(SyntaxError, lambda: ParserRecovery.parse(
+            ParserRecovery.scanner('1 2;'), context=None))
+
+    def test_collect_errors(self):
+        errors = []
+        result = ParserRecovery.parse(ParserRecovery.scanner('1+2; 3 4; 5++ +6; 7;'),
+                                      context=None, errors=errors)
+        self.assertListEqual(result, [3, None, None, 7])
+        self.assertEqual(len(errors), 2)
+        self.assertIn('1:8 => unexpected token Number(4)', str(errors[0]))
+        self.assertIn('1:13 => unexpected token PLUS', str(errors[1]))
+
+    def test_unexpected_token(self):
+        with self.assertRaises(UnexpectedTokenError) as cm:
+            ParserRecovery.parse(ParserRecovery.scanner('1 2;'), context=None)
+        error = cm.exception
+        self.assertIs(error.token, ParserRecovery.NUMBER)
+        self.assertEqual(error.value, 2)
+        self.assertEqual((error.location.line, error.location.column), (1, 3))
+        self.assertListEqual(list(error.expected), [ParserRecovery.SEMI, ParserRecovery.PLUS])
+        self.assertListEqual([ParserRecovery.__token_ids__[i] for i in error.expected_ids],
+                             [ParserRecovery.PLUS, ParserRecovery.SEMI])
+        self.assertIsNone(error._msg)
+        self.assertEqual(str(error), '<memory>1:3 => unexpected token Number(2), expecting SEMI or PLUS')
+        for state in ParserRecovery.__state_list__:
+            self.assertIn(state.expected, ParserRecovery.__expected_table__)
+
+    def test_syntax_error_details(self):
+        with self.assertRaises(UnexpectedTokenError) as cm:
+            ParserRecovery.parse(ParserRecovery.scanner('1 2;'), context=None)
+        error = cm.exception
+        self.assertEqual((error.filename, error.lineno, error.offset), ('<memory>', 1, 3))
+        self.assertIsNone(error._msg)
+
+        copy = pickle.loads(pickle.dumps(error))
+        self.assertIsInstance(copy, UnexpectedTokenError)
+        self.assertEqual(str(copy), str(error))
+        self.assertEqual(copy.token.name, 'NUMBER')
+        self.assertEqual(copy.value, 2)
+        self.assertEqual((copy.location.line, copy.location.column), (1, 3))
+        self.assertEqual(copy.expected_ids, error.expected_ids)
+        self.assertEqual(copy.args, error.args)
+
+    def test_max_errors(self):
+        errors = []
+        self.assertRaises(SyntaxError, lambda: ParserRecovery.parse(
+            ParserRecovery.scanner('1 1; 2 2; 3 3; 4;'), context=None,
+            errors=errors, max_errors=2))
+        self.assertEqual(len(errors), 2)
+
+    def test_unrecoverable(self):
+        errors = []
+        self.assertRaises(SyntaxError, lambda: ParserRecovery.parse(
+            ParserRecovery.scanner('1; 2 3'), context=None, errors=errors))
+        self.assertEqual(len(errors), 1)
+
+    def test_push(self):
+        errors = []
+        parser = ParserRecovery.push(None, ParserRecovery.scanner, errors=errors)
+        parser.feed_text('1 2')
+        parser.feed_text(' 3')
+        parser.feed_text('; 4;')
+        self.assertListEqual(parser.finish(), [None, 4])
+        self.assertEqual(len(errors), 1)
+
+
 class TemplateParser(metaclass=Parser):
     EOF = Token(is_eof=True)
 
@@ -604,6 +849,55 @@ class TestList(unittest.TestCase):
         lst = compiler.parse_string('')
         self.assertListEqual(lst, [])
 
+class ParserStream(metaclass=Parser):
+    NUMBER = Token(r'[0-9]+', action=int)
+    SEMI = Token(r';')
+    WHITE = Token(r'\s+', discard=True)
+
+    _ = Scanner(NUMBER, SEMI, WHITE)
+
+    @Emit()
+    @Rule(NUMBER, SEMI)
+    def ENTRY(self, value, _):
+        return value * 2
+
+    @Rule()
+    def ENTRIES(self):
+        return 0
+
+    @Rule(ENTRIES, ENTRY)
+    def ENTRIES(self, count, entry):
+        self.append(entry)
+        return count + 1
+
+    _ = Start(ENTRIES)
+
+    scanner = StaticTokenizer(default_action=lambda ctx: ctx.step(len(ctx.text)))
+
+
+class TestIterParse(unittest.TestCase):
+    def test_emit(self):
+        entries = []
+        gen = ParserStream.iterparse(ParserStream.scanner('1; 2;\n3;'), context=entries)
+        self.assertEqual(next(gen), 2)
+        self.assertEqual(next(gen), 4)
+        self.assertEqual(next(gen), 6)
+        with self.assertRaises(StopIteration) as cm:
+            next(gen)
+        self.assertEqual(cm.exception.value, 3)
+        self.assertListEqual(entries, [None, None, None])
+
+    def test_parse(self):
+        entries = []
+        self.assertEqual(ParserStream.parse(ParserStream.scanner('1; 2;'), context=entries), 2)
+        self.assertListEqual(entries, [2, 4])
+
+    def test_error(self):
+        gen = ParserStream.iterparse(ParserStream.scanner('1; 2'), context=[])
+        self.assertEqual(next(gen), 2)
+        self.assertRaises(SyntaxError, lambda: next(gen))
+
+
 class ParserTrailingContext(metaclass=Parser):
     DIGITS = Token(r'\d')
     DIGITS2 = Token(r'3', trailing=r'4', action=lambda ctx: 'x')
@@ -811,6 +1105,356 @@ class TestScanner(unittest.TestCase):
         self.assertListEqual(self.scan('1"2\\"2"3'), ['1', '2"2', '3', '__EOF__'])
 
 
+class TestTokenizerDispatch(unittest.TestCase):
+    def setUp(self):
+        tokens = {
+            'PAIR': {'pattern': r'(\d)(\d)', 'action': int},
+            'WORD': {'pattern': r'([a-z])+', 'trailing': r'(!)'},
+            'DIGIT': {'pattern': r'\d', 'action': lambda ctx: f'<{ctx.text}>'},
+            'OTHER': {'pattern': r'[a-z!]', 'action': str},
+            'WHITE': {'pattern': r'\s+', 'discard': True},
+            'EOF': {'is_eof': True},
+        }
+        lst = []
+        for name, info in tokens.items():
+            token = Terminal(name, name, precedence=None)
+            token.data.update(info)
+            lst.append(token)
+        self.tokenizer = Tokenizer({'__default__': Scanner(*lst)}, None)
+
+    def test_groups(self):
+        tvs = list(self.tokenizer('12 ab! 3 c', eof_stop=True))
+        self.assertListEqual([(tv.token.name, tv.value) for tv in tvs], [
+            ('PAIR', 12), ('WORD', 'ab'), ('OTHER', '!'), ('DIGIT', '<3>'),
+            ('OTHER', 'c'), ('EOF', '__EOF__')])
+
+
+class TestFirstChars(unittest.TestCase):
+    def test_first_chars(self):
+        self.assertSetEqual(_first_chars(r'\+'), {'+'})
+        self.assertSetEqual(_first_chars(r'[a-c_]\w*'), {'a', 'b', 'c', '_'})
+        self.assertSetEqual(_first_chars(r'(?:0x)?[0-9]'), {'0', '1', '2', '3', '4', '5', '6', '7', '8', '9'})
+        self.assertSetEqual(_first_chars(r'\bif|else'), {'i', 'e'})
+        self.assertIsNone(_first_chars(r'\d+'))
+        self.assertIsNone(_first_chars(r'[^"]'))
+        self.assertIsNone(_first_chars(r'a*'))
+        self.assertIsNone(_first_chars(r'(?i)if'))
+
+    def test_same_order(self):
+        # without dispatch every token is tried in Scanner order
+        tokens = {
+            'IF': r'if\b',
+            'IDENT': r'[a-z]\w*',
+            'NUMBER': r'\d+',
+            'FLOAT': r'[0-9]+\.[0-9]*',
+            'OP': r'[-+*/=]=?',
+            'ANY': r'.',
+            'WHITE': r'\s+',
+        }
+        lst = []
+        for name, pattern in tokens.items():
+            token = Terminal(name, name, precedence=None)
+            token.data['pattern'] = pattern
+            lst.append(token)
+        eof = Terminal('EOF', 'EOF', precedence=None)
+        eof.data['is_eof'] = True
+        tokenizer = Tokenizer({'__default__': Scanner(*lst, eof)}, None)
+        text = 'if iff 1.5 12 x+=3 "if" (+ 0.'
+        tvs = [(tv.token.name, tv.value) for tv in tokenizer(text, eof_stop=True)]
+        regexp = tokenizer.regexps['__default__']
+        expected = [(m.lastgroup, m.group()) for m in regexp.finditer(text)] + [('EOF', '__EOF__')]
+        self.assertListEqual(tvs, expected)
+
+
+class TestTokenArray(unittest.TestCase):
+    def test_same_as_stream(self):
+        text = 'a = 12 + "x \\"y"\n  * (b - 3)'
+        tvs = [tv for tv in ParserCalc.scanner(text, eof_stop=True) if not tv.token.is_eof]
+        tokens = ParserCalc.scanner.tokenize_array(text)
+        self.assertEqual(len(tokens), len(tvs))
+        self.assertListEqual([(tokens.token(i), tokens.value(i)) for i in range(len(tokens))],
+                             [(tv.token, tv.value) for tv in tvs])
+        self.assertEqual(tokens.text_of(0), 'a')
+        self.assertEqual(tokens.value(2), 12)
+        self.assertEqual(tokens.text_of(4), '"x \\"y"')
+        self.assertEqual(tokens.ids.typecode, 'H')
+
+    def test_capture_at_eof(self):
+        tokens = ParseBareString.scanner.tokenize_array('=abc')
+        self.assertEqual(len(tokens), 1)
+        self.assertEqual(tokens.token(0).name, 'TEXT')
+        self.assertEqual(tokens.value(0), 'abc')
+
+    def assertSameTokens(self, tokens, other):
+        self.assertEqual(tokens.ids, other.ids)
+        self.assertEqual(tokens.starts, other.starts)
+        self.assertEqual(tokens.ends, other.ends)
+        self.assertEqual([tokens.value(i) for i in range(len(tokens))],
+                         [other.value(i) for i in range(len(other))])
+
+    def test_parallel(self):
+        scanner = ParserDelimited.scanner
+        text = '\n'.join([DELIMITED_SOURCE] * 50)
+        for chunk_size in (1, 7, 64, 1000):
+            self.assertSameTokens(scanner.tokenize_parallel(text, chunk_size=chunk_size),
+                                  scanner.tokenize_array(text))
+
+    def test_parallel_seam_in_condition(self):
+        # the chunks start inside strings, the seams are scanned again
+        scanner = ParserCalc.scanner
+        text = ' '.join([f'x{i} = "a b c" + {i}' for i in range(100)])
+        for chunk_size in (1, 10, 100):
+            self.assertSameTokens(scanner.tokenize_parallel(text, boundary=' ', chunk_size=chunk_size),
+                                  scanner.tokenize_array(text))
+
+    def test_parallel_decode(self):
+        # the workers decode their chunks, the string spans many chunks and
+        # more than the text after them
+        scanner = ParserDelimited.scanner
+        text = '\n'.join(['1 "\u00e4" r\'\u00fc\'', '"' + '\u00e9\n' * 20000 + '"', '2 # \ud800'] * 3)
+        for chunk_size in (64, 10000):
+            self.assertSameTokens(scanner.tokenize_parallel(text, chunk_size=chunk_size),
+                                  scanner.tokenize_array(text))
+
+    def test_pickle(self):
+        # the worker processes of tokenize_parallel get the static field
+        self.assertIs(pickle.loads(pickle.dumps(ParserCalc.scanner)), ParserCalc.scanner)
+        self.assertRaises(TypeError, lambda: pickle.dumps(Tokenizer(ParserCalc, None)))
+
+    def test_parallel_junk(self):
+        scanner = ParserDelimited.scanner
+        text = '1\n' * 50 + '"x\n' + '2\n' * 50
+        self.assertRaises(TrailingJunk, lambda: scanner.tokenize_parallel(text, chunk_size=8))
+        self.assertSameTokens(scanner.tokenize_parallel(text, ignore_tailing=True, chunk_size=8),
+                              scanner.tokenize_array(text, ignore_tailing=True))
+
+
+class ParserPureSum(metaclass=Parser):
+    NUMBER = Token(r'[0-9]+', action=int)
+    WHITE = Token(r'\s+', discard=True)
+    PLUS = Token(r'\+')
+
+    _ = Scanner(NUMBER, WHITE, PLUS)
+    _ = Memoize(maxsize=2)
+
+    @Pure()
+    @Rule(NUMBER)
+    @staticmethod
+    def SUM(context, number):
+        return [number]
+
+    @Pure()
+    @Rule(SUM, PLUS, NUMBER)
+    @staticmethod
+    def SUM(context, lst, _, number):
+        return [*lst, number]
+
+    _ = Start(SUM)
+
+    scanner = StaticTokenizer()
+
+
+class TestParseCache(unittest.TestCase):
+    def setUp(self):
+        ParserPureSum.__cache__.clear()
+
+    def test_hit(self):
+        first = ParserPureSum.parse_cached('1 + 2', ParserPureSum.scanner)
+        self.assertListEqual(first, [1, 2])
+        self.assertIs(ParserPureSum.parse_cached('1 + 2', ParserPureSum.scanner), first)
+        self.assertListEqual(ParserPureSum.parse_cached('1 +2', ParserPureSum.scanner), [1, 2])
+        info = ParserPureSum.__cache__.info()
+        self.assertEqual((info.hits, info.misses, info.size), (1, 2, 2))
+
+    def test_eviction(self):
+        for text in ['1', '2', '3', '1']:
+            ParserPureSum.parse_cached(text, ParserPureSum.scanner)
+        info = ParserPureSum.__cache__.info()
+        self.assertEqual((info.hits, info.misses, info.evictions, info.size), (0, 4, 2, 2))
+
+    def test_maxbytes(self):
+        cache = ParserPureSum.__cache__
+        cache.maxbytes = 1
+        try:
+            ParserPureSum.parse_cached('1', ParserPureSum.scanner)
+            self.assertEqual(len(cache), 0)
+        finally:
+            cache.maxbytes = None
+
+    def test_impure(self):
+        def create():
+            class ParserImpure(metaclass=Parser):  # pylint: disable=unused-variable
+                NUMBER = Token(r'[0-9]+', action=int)
+                _ = Scanner(NUMBER)
+                _ = Memoize()
+
+                @Rule(NUMBER)
+                @staticmethod
+                def VALUE(context, number):
+                    return number
+
+                _ = Start(VALUE)
+        self.assertRaises(TypeError, create)
+        self.assertRaises(TypeError, lambda: ParserCalc.parse_cached('1', ParserCalc.scanner))
+
+
+class TestFlatTables(unittest.TestCase):
+    def test_parse(self):
+        text = 'a = 2 * (3 + "4" * 2) - -1'
+        tables = ParserCalc.load_tables(ParserCalc.export_tables())
+        flat = ParserCalc()
+        result = tables.parse(ParserCalc.scanner(text), flat)
+        compiler = ParserCalc()
+        self.assertEqual(result, compiler.parse_string(text))
+        self.assertListEqual(flat.steps, compiler.steps)
+
+    def test_error(self):
+        tables = ParserCalc.load_tables(ParserCalc.export_tables())
+        with self.assertRaises(UnexpectedTokenError) as flat:
+            tables.parse(ParserCalc.scanner('1 + + 2'), ParserCalc())
+        with self.assertRaises(UnexpectedTokenError) as error:
+            ParserCalc().parse_string('1 + + 2')
+        self.assertEqual(str(flat.exception), str(error.exception))
+        self.assertEqual(flat.exception.expected_ids, error.exception.expected_ids)
+
+    def test_recovery(self):
+        tables = ParserRecovery.load_tables(ParserRecovery.export_tables())
+        text = '1+2; 3 4; 5++ +6; 7;'
+        errors = []
+        result = tables.parse(ParserRecovery.scanner(text), None, errors=errors)
+        expected_errors = []
+        expected = ParserRecovery.parse(ParserRecovery.scanner(text), None, errors=expected_errors)
+        self.assertListEqual(result, expected)
+        self.assertListEqual([str(e) for e in errors], [str(e) for e in expected_errors])
+
+    def test_iterparse(self):
+        tables = ParserStream.load_tables(ParserStream.export_tables())
+        entries = []
+        gen = tables.iterparse(ParserStream.scanner('1; 2;\n3;'), entries)
+        self.assertListEqual([next(gen) for _ in range(3)], [2, 4, 6])
+        with self.assertRaises(StopIteration) as cm:
+            next(gen)
+        self.assertEqual(cm.exception.value, 3)
+
+    @unittest.skipIf(sys.version_info < (3, 8), 'multiprocessing.shared_memory requires Python 3.8')
+    def test_shared_memory(self):
+        from multiprocessing import shared_memory  # pylint: disable=import-outside-toplevel
+        data = TemplateParser.export_tables()
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        try:
+            shm.buf[:len(data)] = data
+            tables = TemplateParser.load_tables(shm.buf)
+            result = tables.parse(TemplateParser.scan('a ${b.c} d'), None)
+            self.assertEqual(''.join(str(x(TestContext({'b': {'c': 1}}))) for x in result), 'a 1 d')
+            del tables
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def test_mmap(self):
+        data = TemplateParser.export_tables()
+        with tempfile.TemporaryFile() as file:
+            file.write(data)
+            file.flush()
+            with mmap.mmap(file.fileno(), len(data), access=mmap.ACCESS_READ) as buf:
+                tables = TemplateParser.load_tables(buf)
+                result = tables.parse(TemplateParser.scan('a ${b.c} d'), None)
+                self.assertEqual(''.join(str(x(TestContext({'b': {'c': 1}}))) for x in result), 'a 1 d')
+                del tables
+
+    def test_mismatch(self):
+        self.assertRaises(RuntimeError, lambda: TemplateParser.load_tables(ParserCalc.export_tables()))
+        self.assertRaises(RuntimeError, lambda: TemplateParser.load_tables(bytes(64)))
+
+
+class CountingTokenizer(StaticTokenizer):
+    created = 0
+
+    def create(self, parser):
+        CountingTokenizer.created += 1
+        return super().create(parser)
+
+
+class SlowTokenizer(StaticTokenizer):
+    def __init__(self, started):
+        super().__init__()
+        self.started = started
+
+    def create(self, parser):
+        self.started.set()
+        time.sleep(0.2)
+        return super().create(parser)
+
+
+def lazy_sum_parser(field=None):
+    class ParserLazySum(metaclass=Parser):
+        NUMBER = Token(r'[0-9]+', action=int)
+        PLUS = Token(r'\+')
+
+        _ = Scanner(NUMBER, PLUS)
+        _ = Lazy()
+
+        @Rule(NUMBER)
+        @staticmethod
+        def SUM(context, number):
+            return number
+
+        @Rule(SUM, PLUS, NUMBER)
+        @staticmethod
+        def SUM(context, total, _, number):
+            return total + number
+
+        _ = Start(SUM)
+
+        scanner = CountingTokenizer() if field is None else field
+
+    return ParserLazySum
+
+
+class TestLazy(unittest.TestCase):
+    def test_first_use(self):
+        created = CountingTokenizer.created
+        parser = lazy_sum_parser()
+        self.assertNotIn('__state_tree__', parser.__dict__)
+        self.assertEqual(CountingTokenizer.created, created)
+        self.assertEqual(parser.parse(parser.scanner('1+2+3'), None), 6)
+        self.assertEqual(CountingTokenizer.created, created + 1)
+        self.assertIsInstance(parser.__dict__['scanner'], Tokenizer)
+        self.assertIs(parser.warmup(), parser)
+
+    def test_fingerprint(self):
+        parser = lazy_sum_parser()
+        fingerprint = parser.__fingerprint__
+        self.assertNotIn('__state_tree__', parser.__dict__)
+        # the tables are not built behind the back of the caller
+        self.assertRaises(RuntimeError, parser.export_tables)
+        self.assertRaises(RuntimeError, lambda: parser.load_tables(bytes(64)))
+
+        other = lazy_sum_parser().warmup()
+        self.assertEqual(other.__fingerprint__, fingerprint)
+        tables = parser.warmup().load_tables(other.export_tables())
+        self.assertEqual(tables.parse(parser.scanner('1+2+3'), None), 6)
+
+    def test_warmup_threads(self):
+        created = CountingTokenizer.created
+        parser = lazy_sum_parser()
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda _: parser.warmup().__state_tree__, range(32)))
+        self.assertEqual(len(set(map(id, results))), 1)
+        self.assertEqual(CountingTokenizer.created, created + 1)
+
+    def test_slow_static_field(self):
+        # the parser is not built before its static fields exist
+        started = threading.Event()
+        parser = lazy_sum_parser(SlowTokenizer(started))
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            future = executor.submit(parser.warmup)
+            started.wait()
+            self.assertIsInstance(parser.scanner, Tokenizer)
+            self.assertIs(future.result(), parser)
+        self.assertEqual(parser.parse(parser.scanner('1+2'), None), 3)
+
+
 class ParseBareString(metaclass=Parser):
     WHITE = Token(r'[ \r\t\v]+', discard=True)
     EQ = Token(r'=', discard=True, action=lambda ctx: ctx.enter('text', io.StringIO()))
@@ -846,5 +1490,687 @@ class TestEOFAction(unittest.TestCase):
         parser.parse_string('=y')
 
 
+class ParserDelimited(metaclass=Parser):
+    STRING = Delimited('"', '"', escape='\\')
+    RAW = Delimited("r'", "'", action=str.upper)
+    COMMENT = Delimited('/*', '*/', discard=True)
+    LINE_COMMENT = Delimited('#', '\n', discard=True)
+    NOTE = Delimited('%', '\n')
+    NUMBER = Token(r'\d+', action=int, javascript='return parseInt(ctx.text)')
+    NEWLINE = Token(r'\n', discard=True, action=lambda ctx: ctx.lines(1),
+                    javascript='ctx.lines(1)')
+    WHITE = Token(r'[ \t]+', discard=True)
+
+    _ = Scanner(STRING, RAW, COMMENT, LINE_COMMENT, NOTE, NUMBER, NEWLINE, WHITE)
+
+    scanner = StaticTokenizer(default_action=lambda ctx: ctx.step(len(ctx.text)))
+
+    @JavaScript('return $1')
+    @Rule(STRING)
+    @Rule(RAW)
+    @Rule(NOTE)
+    @Rule(NUMBER)
+    @staticmethod
+    def ITEM(context, value):
+        return value
+
+    @JavaScript('return [$1]')
+    @Rule(ITEM)
+    @staticmethod
+    def ITEMS(context, item):
+        return [item]
+
+    @JavaScript('$1.push($2); return $1')
+    @Rule(ITEMS, ITEM)
+    @staticmethod
+    def ITEMS(context, items, item):
+        items.append(item)
+        return items
+
+    _ = Start(ITEMS)
+
+
+DELIMITED_SOURCE = '1 "a\\"b" /* c\n * d **/ r\'x\' # e\n"\n"'
+
+
+class TestDelimited(unittest.TestCase):
+    def test_values(self):
+        self.assertEqual(ParserDelimited.parse(ParserDelimited.scanner(DELIMITED_SOURCE), None),
+                         [1, 'a"b', 'X', '\n'])
+
+    def test_location(self):
+        tokens = list(ParserDelimited.scanner(DELIMITED_SOURCE, eof_stop=True))
+        self.assertEqual([(tv.location.line, tv.location.column) for tv in tokens],
+                         [(1, 1), (1, 3), (2, 10), (3, 1), (4, 2)])
+
+    def test_array(self):
+        tokens = ParserDelimited.scanner.tokenize_array(DELIMITED_SOURCE)
+        self.assertEqual([tokens.value(idx) for idx in range(len(tokens))],
+                         [1, 'a"b', 'X', '\n'])
+
+    def test_unterminated(self):
+        self.assertRaises(TrailingJunk,
+                          lambda: list(ParserDelimited.scanner('1 /* 2', eof_stop=True)))
+
+    def test_close_at_eof(self):
+        def parse(text):
+            return ParserDelimited.parse(ParserDelimited.scanner(text), None)
+        self.assertEqual(parse('1 # c'), [1])
+        self.assertEqual(parse('1 #'), [1])
+        self.assertEqual(parse('1 %a'), [1, 'a'])
+        self.assertEqual(parse('1 %a\n2 %'), [1, 'a', 2, ''])
+        tokens = ParserDelimited.scanner.tokenize_array('1 %a\n2 %b')
+        self.assertEqual([tokens.value(idx) for idx in range(len(tokens))], [1, 'a', 2, 'b'])
+        self.assertRaises(TrailingJunk,
+                          lambda: list(ParserDelimited.scanner('1 "2', eof_stop=True)))
+
+    def test_invalid(self):
+        self.assertRaises(TypeError, lambda: Delimited('', '"'))
+        self.assertRaises(TypeError, lambda: Delimited('"', '"', escape='"'))
+
+
+class ParserStatements(metaclass=Parser):
+    NUMBER = Token(r'\d+', action=int, javascript='return parseInt(ctx.text)')
+    PLUS = Token(r'\+')
+    SEMI = Token(r';')
+    WHITE = Token(r'\s+', discard=True)
+
+    _ = Scanner(NUMBER, PLUS, SEMI, WHITE)
+
+    scanner = StaticTokenizer(default_action=lambda ctx: ctx.step(len(ctx.text)))
+
+    @JavaScript('return $1')
+    @Rule(NUMBER)
+    @staticmethod
+    def EXPR(context, value):
+        return value
+
+    @JavaScript('return $1 + $3')
+    @Rule(EXPR, PLUS, NUMBER)
+    @staticmethod
+    def EXPR(context, expr, _, value):
+        return expr + value
+
+    @JavaScript('return [$1]')
+    @Rule(EXPR)
+    @staticmethod
+    def STATEMENTS(context, expr):
+        return [expr]
+
+    @JavaScript('$1.push($3); return $1')
+    @Rule(STATEMENTS, SEMI, EXPR)
+    @staticmethod
+    def STATEMENTS(context, statements, _, expr):
+        statements.append(expr)
+        return statements
+
+    _ = Start(STATEMENTS)
+    _ = Start(EXPR)
+    _ = ParallelList(STATEMENTS, SEMI)
+
+
+class TestStartSymbols(unittest.TestCase):
+    def test_parse(self):
+        scanner = ParserStatements.scanner
+        self.assertEqual(ParserStatements.parse(scanner('1 + 2; 3'), None), [3, 3])
+        self.assertEqual(ParserStatements.parse(scanner('1 + 2'), None,
+                                                start=ParserStatements.EXPR), 3)
+        self.assertEqual(ParserStatements.parse(scanner('1 + 2'), None,
+                                                start=ParserStatements.STATEMENTS), [3])
+        self.assertRaises(UnexpectedTokenError, lambda: ParserStatements.parse(
+            scanner('1; 2'), None, start=ParserStatements.EXPR))
+        self.assertRaises(TypeError, lambda: ParserStatements.parse(
+            scanner('1'), None, start=ParserStatements.NUMBER))
+
+    def test_iterparse(self):
+        scanner = ParserStatements.scanner
+        with self.assertRaises(StopIteration) as cm:
+            next(ParserStatements.iterparse(scanner('1 + 2'), None, start=ParserStatements.EXPR))
+        self.assertEqual(cm.exception.value, 3)
+
+    def test_push(self):
+        parser = ParserStatements.push(None, ParserStatements.scanner, start=ParserStatements.EXPR)
+        parser.feed_text('1 + 2')
+        self.assertEqual(parser.finish(), 3)
+        self.assertRaises(TypeError, lambda: ParserStatements.push(
+            None, start=ParserStatements.NUMBER))
+
+    def test_flat_tables(self):
+        scanner = ParserStatements.scanner
+        tables = ParserStatements.load_tables(ParserStatements.export_tables())
+        self.assertEqual(tables.parse(scanner('1 + 2; 3'), None), [3, 3])
+        self.assertEqual(tables.parse(scanner('1 + 2'), None, start=ParserStatements.EXPR), 3)
+        self.assertEqual(tables.parse(scanner('1 + 2'), None,
+                                      start=ParserStatements.STATEMENTS), [3])
+        with self.assertRaises(StopIteration) as cm:
+            next(tables.iterparse(scanner('1 + 2'), None, start=ParserStatements.EXPR))
+        self.assertEqual(cm.exception.value, 3)
+        self.assertRaises(UnexpectedTokenError, lambda: tables.parse(
+            scanner('1; 2'), None, start=ParserStatements.EXPR))
+        self.assertRaises(TypeError, lambda: tables.parse(
+            scanner('1'), None, start=ParserStatements.NUMBER))
+
+    def test_shared_tables(self):
+        self.assertEqual(list(ParserStatements.__entries__), [ParserStatements.EXPR])
+        state, _ = ParserStatements.__entries__[ParserStatements.EXPR]
+        self.assertIn(state, ParserStatements.__state_list__)
+
+
+class TestParallelList(unittest.TestCase):
+    def setUp(self):
+        # the thread pool is only used on free-threaded builds
+        patcher = unittest.mock.patch('playlang.parser._free_threaded', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_same_as_parse(self):
+        for text in ('1', '1 + 2; 3', ';'.join(f'{i} + {i} + 1' for i in range(1000))):
+            self.assertEqual(
+                ParserStatements.parse_list_parallel(ParserStatements.scanner(text), None,
+                                                     batch_size=7),
+                ParserStatements.parse(ParserStatements.scanner(text), None))
+
+    def test_error(self):
+        self.assertRaises(UnexpectedTokenError, lambda: ParserStatements.parse_list_parallel(
+            ParserStatements.scanner('1; 2 +; 3'), None))
+        self.assertRaises(UnexpectedTokenError, lambda: ParserStatements.parse_list_parallel(
+            ParserStatements.scanner('1;; 3'), None))
+
+    def test_gil(self):
+        text = ';'.join(f'{i} + 1' for i in range(100))
+        with unittest.mock.patch('playlang.parser._free_threaded', return_value=False), \
+                unittest.mock.patch.object(ParserStatements, 'parse',
+                                           wraps=ParserStatements.parse) as parse:
+            self.assertEqual(ParserStatements.parse_list_parallel(
+                ParserStatements.scanner(text), None), [i + 1 for i in range(100)])
+        parse.assert_called_once()
+
+    def test_declaration(self):
+        def define(separator_in_expr=False, wrapped=False):
+            class ParserBad(metaclass=Parser):
+                NUMBER = Token(r'\d+')
+                SEMI = Token(r';')
+                _ = Scanner(NUMBER, SEMI)
+
+                @Rule(NUMBER)
+                def EXPR(context, *args):
+                    return args
+
+                if separator_in_expr:
+                    @Rule(NUMBER, SEMI, NUMBER)
+                    def EXPR(context, *args):
+                        return args
+
+                @Rule(EXPR)
+                def LIST(context, *args):
+                    return args
+
+                @Rule(LIST, SEMI, EXPR)
+                def LIST(context, *args):
+                    return args
+
+                @Rule(LIST)
+                def PROGRAM(context, *args):
+                    return args
+
+                _ = Start(PROGRAM if wrapped else LIST)
+                _ = ParallelList(LIST, SEMI)
+            return ParserBad
+
+        self.assertIsNotNone(define().__parallel__)
+        self.assertRaises(TypeError, lambda: define(separator_in_expr=True))
+        self.assertRaises(TypeError, lambda: define(wrapped=True))
+
+class ParserStatementsTimes(ParserStatements):
+    TIMES = Token(r'\*')
+
+    _ = Scanner(NUMBER, PLUS, SEMI, WHITE, TIMES)
+
+    @Rule(EXPR, TIMES, NUMBER)
+    @staticmethod
+    def EXPR(context, expr, _, value):
+        return expr * value
+
+
+class ParserStatementsComments(ParserStatements):
+    COMMENT = Token(r'#[^\n]*', discard=True)
+
+    _ = Scanner(NUMBER, PLUS, SEMI, WHITE, COMMENT)
+
+
+class TestInheritance(unittest.TestCase):
+    def test_extend_symbol(self):
+        scanner = ParserStatementsTimes.scanner
+        self.assertEqual(ParserStatementsTimes.parse(scanner('1 + 2 * 3; 4'), None), [9, 4])
+        self.assertEqual(ParserStatementsTimes.parse(scanner('2 * 3'), None,
+                                                     start=ParserStatementsTimes.EXPR), 6)
+        self.assertEqual(ParserStatementsTimes.parse_list_parallel(
+            scanner('1 * 2; 3 * 4'), None), [2, 12])
+        self.assertRaises(TrailingJunk, lambda: ParserStatements.parse(
+            ParserStatements.scanner('2 * 3'), None))
+
+    def test_copy_on_write(self):
+        self.assertEqual(len(ParserStatements.EXPR.rules), 2)
+        self.assertEqual(len(ParserStatementsTimes.EXPR.rules), 3)
+        # STATEMENTS refers to EXPR, NUMBER is shared
+        self.assertIsNot(ParserStatementsTimes.STATEMENTS, ParserStatements.STATEMENTS)
+        self.assertIs(ParserStatementsTimes.NUMBER, ParserStatements.NUMBER)
+        for rule in ParserStatementsTimes.STATEMENTS.rules:
+            self.assertIs(rule.symbol, ParserStatementsTimes.STATEMENTS)
+            self.assertIs(list(rule)[-1], ParserStatementsTimes.EXPR)
+        self.assertIs(list(ParserStatements.EXPR.rules[1])[0], ParserStatements.EXPR)
+        self.assertIs(list(ParserStatementsTimes.EXPR.rules[1])[0], ParserStatementsTimes.EXPR)
+
+    def test_reuse_tables(self):
+        self.assertIs(ParserStatementsComments.__state_list__, ParserStatements.__state_list__)
+        self.assertIn('reuse', ParserStatementsComments.__syntax__.timings)
+        self.assertIsNot(ParserStatementsComments.scanner, ParserStatements.scanner)
+        self.assertEqual(ParserStatementsComments.parse(
+            ParserStatementsComments.scanner('1 # one\n; 2'), None), [1, 2])
+        # changed rules get tables of their own
+        self.assertIsNot(ParserStatementsTimes.__state_list__, ParserStatements.__state_list__)
+
+    def test_reuse_states(self):
+        class Base(metaclass=Parser):
+            NUMBER = Token(r'\d+', action=int)
+            PLUS = Token(r'\+')
+            SEMI = Token(r';')
+            WHITE = Token(r'\s+', discard=True)
+
+            _ = Scanner(NUMBER, PLUS, SEMI, WHITE)
+
+            scanner = StaticTokenizer(default_action=lambda ctx: ctx.step(len(ctx.text)))
+
+            @Rule(NUMBER)
+            @staticmethod
+            def EXPR(context, value):
+                return value
+
+            @Rule(EXPR, PLUS, NUMBER)
+            @staticmethod
+            def EXPR(context, expr, _, value):
+                return expr + value
+
+            @Rule(EXPR)
+            @staticmethod
+            def STATEMENTS(context, expr):
+                return [expr]
+
+            @Rule(STATEMENTS, SEMI, EXPR)
+            @staticmethod
+            def STATEMENTS(context, statements, _, expr):
+                return statements + [expr]
+
+            _ = Start(STATEMENTS)
+
+        expected = [state.expected for state in Base.__state_list__]
+
+        class Dialect(Base):
+            @Rule(STATEMENTS, SEMI)
+            @staticmethod
+            def STATEMENTS(context, statements, _):
+                return statements
+
+        # the states of EXPR do not refer to STATEMENTS
+        self.assertEqual(Dialect.__syntax__.statistics['reused states'], 3)
+        self.assertEqual(len(set(Dialect.__state_list__) & set(Base.__state_list__)), 3)
+        self.assertEqual(Dialect.parse(Dialect.scanner('1 + 2; 3;'), None), [3, 3])
+        self.assertEqual(Dialect.parse(Dialect.scanner('1 + 2'), None), [3])
+        with self.assertRaises(UnexpectedTokenError):
+            Base.parse(Base.scanner('1 + 2;'), None)
+        self.assertEqual([state.expected for state in Base.__state_list__], expected)
+
+    def test_capture_inherited_token(self):
+        class Dialect(ParserCalc):
+            SQUOTE = Token(r"'", discard=True,
+                           action=lambda ctx: ctx.enter('single', io.StringIO()))
+            SQUOTE_END = Token(r"'", discard=True, action=lambda ctx: ctx.leave())
+            SINGLE_CHAR = Token(r'.', discard=True, action=lambda ctx: ctx.value.write(ctx.text))
+
+            _ = Scanner(NUMBER, NAME, EQUALS, PLUS, MINUS, TIMES, DIVIDE, LPAR, RPAR,
+                        QUOTE, SQUOTE, NEWLINE, WHITE, MISMATCH)
+            _ = Scanner(SQUOTE_END, SINGLE_CHAR, name='single', capture=ParserCalc.STRING)
+
+        self.assertEqual(Dialect.parse(Dialect.scanner('x = \'2\' * "3"'), ParserCalc()),
+                         ParserCalc().parse_string('x = "2" * "3"'))
+
+        class Other(ParserCalc):
+            DIGIT = Token(r'\d')
+            _ = Scanner(DIGIT, name='other', capture=ParserCalc.NUMBER)
+
+        self.assertIs(Other.__scanners__['other'].capture, ParserCalc.NUMBER)
+        self.assertFalse(ParserCalc.NUMBER.capture)
+        self.assertEqual(ParserCalc().parse_string('1 + 2'), 3)
+
+    def test_lazy(self):
+        class Dialect(ParserStatementsTimes):
+            _ = Lazy()
+
+        # not built yet, the tables of the base parser are not visible
+        self.assertIsNot(Dialect.__dict__['__state_tree__'], ParserStatementsTimes.__state_tree__)
+        self.assertEqual(Dialect.parse(Dialect.scanner('2 * 2'), None), [4])
+        self.assertIs(Dialect.__state_list__, ParserStatementsTimes.__state_list__)
+
+    def test_redefine_token(self):
+        def define():
+            class Dialect(ParserStatements):  # pylint: disable=unused-variable
+                NUMBER = Token(r'[0-9]+')
+        self.assertRaises(TypeError, define)
+
+
+class ParserCombinators(metaclass=Parser):
+    NUMBER = Token(r'\d+', action=int, javascript='return parseInt(ctx.text)')
+    MINUS = Token(r'-')
+    COMMA = Token(r',')
+    LB = Token(r'\[')
+    RB = Token(r'\]')
+    WHITE = Token(r'\s+', discard=True)
+
+    _ = Scanner(NUMBER, MINUS, COMMA, LB, RB, WHITE)
+
+    scanner = StaticTokenizer(default_action=lambda ctx: ctx.step(len(ctx.text)))
+
+    @JavaScript('return $1 === undefined ? $2 : -$2')
+    @Rule(Optional(MINUS), NUMBER)
+    @staticmethod
+    def VALUE(context, minus, value):
+        return value if minus is None else -value
+
+    @JavaScript('return $2')
+    @Rule(LB, SepBy(VALUE, COMMA), RB)
+    @staticmethod
+    def LIST(context, _, values, __):
+        return values
+
+    @JavaScript('return $1')
+    @Rule(Many(LIST))
+    @staticmethod
+    def LISTS(context, lists):
+        return lists
+
+    _ = Start(LISTS)
+
+
+class TestCombinators(unittest.TestCase):
+    def test_parse(self):
+        scanner = ParserCombinators.scanner
+        self.assertEqual(ParserCombinators.parse(scanner('[1, -2] [] [3]'), None),
+                         [[1, -2], [], [3]])
+        self.assertEqual(ParserCombinators.parse(scanner(''), None), [])
+        self.assertRaises(UnexpectedTokenError, lambda: ParserCombinators.parse(
+            scanner('[1,]'), None))
+        self.assertRaises(UnexpectedTokenError, lambda: ParserCombinators.parse(
+            scanner('[--1]'), None))
+
+    def test_rules(self):
+        # the optional components are left out, there are no empty rules
+        # but the one of LISTS
+        self.assertEqual(len(ParserCombinators.VALUE.rules), 2)
+        self.assertEqual(len(ParserCombinators.LIST.rules), 2)
+        self.assertEqual([len(rule) for rule in ParserCombinators.LISTS.rules], [1, 0])
+        many = list(ParserCombinators.LISTS.rules[0])[0]
+        self.assertEqual(many.name, 'LIST_MANY1')
+        self.assertEqual(many.show_name, 'Many1(LIST)')
+        self.assertIs(list(many.rules[1])[0], many)
+
+    def test_stack_depth(self):
+        parser = ParserCombinators.push(None, ParserCombinators.scanner)
+        parser.feed_text('[' + '1, ' * 10000)
+        self.assertLess(len(parser._state_stack), 8)
+        parser.feed_text('1]' + ' [1]' * 10000)
+        self.assertLess(len(parser._state_stack), 8)
+        lists = parser.finish()
+        self.assertEqual(len(lists), 10001)
+        self.assertEqual(len(lists[0]), 10001)
+
+    def test_copy(self):
+        # the lists appended by Many and SepBy are not shared with the copy
+        parser = ParserCombinators.push(None, ParserCombinators.scanner)
+        parser.feed_text('[1, 2')
+        snapshot = parser.copy()
+        parser.feed_text(', 3]')
+        snapshot.feed_text(', 4]')
+        self.assertEqual(parser.finish(), [[1, 2, 3]])
+        self.assertEqual(snapshot.finish(), [[1, 2, 4]])
+
+    def test_impure(self):
+        def memoize():
+            class ParserMemoize(ParserCombinators):  # pylint: disable=unused-variable
+                _ = Memoize()
+        self.assertRaisesRegex(TypeError, 'Pure', memoize)
+
+    def test_nested(self):
+        class ParserNested(metaclass=Parser):
+            NUMBER = Token(r'\d', action=int)
+            SEMI = Token(r';')
+            _ = Scanner(NUMBER, SEMI)
+
+            @Rule(SepBy(Many1(NUMBER), SEMI))
+            @staticmethod
+            def LINES(context, lines):
+                return lines
+
+            _ = Start(LINES)
+
+        tokenizer = Tokenizer(ParserNested, None)
+        self.assertEqual(ParserNested.parse(tokenizer('1;23'), None), [[1], [2, 3]])
+        self.assertEqual(ParserNested.parse(tokenizer(''), None), [])
+
+        def optional_item():
+            class ParserOptional(metaclass=Parser):  # pylint: disable=unused-variable
+                NUMBER = Token(r'\d+')
+                _ = Scanner(NUMBER)
+
+                @Rule(Many(Optional(NUMBER)))
+                @staticmethod
+                def LIST(context, lst):
+                    return lst
+
+                _ = Start(LIST)
+        self.assertRaises(TypeError, optional_item)
+
+
+class TestParseTree(unittest.TestCase):
+    def test_calc(self):
+        tokens = ParserCalc.scanner.tokenize_array('1 + 2 * (3 - x)')
+        tree = ParserCalc.parse_tree(tokens)
+        root = tree.cursor()
+        self.assertIs(root.symbol, ParserCalc.EXPR)
+        self.assertEqual((root.start, root.end), (0, len(tokens)))
+        self.assertIsNone(root.parent())
+        self.assertEqual([c.text for c in root.children()], ['1', '2 * (3 - x)'])
+
+        product = root.first_child().next_sibling()
+        self.assertIsNone(product.next_sibling())
+        self.assertEqual(product.parent(), root)
+        self.assertEqual(list(product.rule), [ParserCalc.EXPR, ParserCalc.TIMES, ParserCalc.EXPR])
+        self.assertEqual([c.text for c in product.children()], ['2', '(3 - x)'])
+
+        # one node per reduction, the tokens are not nodes
+        self.assertEqual(len(tree), 8)
+        self.assertEqual(len(tree.nodes(ParserCalc.EXPR)), 8)
+        self.assertEqual(tree.nodes(ParserCalc.EXPR)[-1], tree.root)
+        self.assertEqual(len(tree.nodes(ParserCalc.NUMBER)), 0)
+        self.assertEqual(tree.nbytes, 8 * 22)
+
+    def test_start_symbol(self):
+        scanner = ParserStatements.scanner
+        tree = ParserStatements.parse_tree(scanner.tokenize_array('1 + 2; 3'))
+        self.assertIs(tree.cursor().symbol, ParserStatements.STATEMENTS)
+        self.assertEqual(len(tree.nodes(ParserStatements.STATEMENTS)), 2)
+
+        tree = ParserStatements.parse_tree(scanner.tokenize_array('1 + 2'),
+                                           start=ParserStatements.EXPR)
+        self.assertIs(tree.cursor().symbol, ParserStatements.EXPR)
+        self.assertRaises(UnexpectedTokenError, lambda: ParserStatements.parse_tree(
+            scanner.tokenize_array('1; 2'), start=ParserStatements.EXPR))
+
+    def test_empty_rule(self):
+        tree = ParserCombinators.parse_tree(ParserCombinators.scanner.tokenize_array(''))
+        root = tree.cursor()
+        self.assertIs(root.symbol, ParserCombinators.LISTS)
+        self.assertEqual((root.start, root.end, root.text), (0, 0, ''))
+        self.assertIsNone(root.first_child())
+
+    def test_error(self):
+        tokens = ParserCalc.scanner.tokenize_array('1 +\n+ 2', 'calc.txt')
+        with self.assertRaises(UnexpectedTokenError) as error:
+            ParserCalc.parse_tree(tokens)
+        self.assertEqual(error.exception.location.line, 2)
+        self.assertEqual(error.exception.location.filename, 'calc.txt')
+
+
+class ParserUnitRules(metaclass=Parser):
+    NUMBER = Token(r'\d+', action=int, javascript='return parseInt(ctx.text)')
+    PLUS = Token(r'\+')
+    MINUS = Token(r'-')
+    WHITE = Token(r'\s+', discard=True)
+
+    _ = Scanner(NUMBER, PLUS, MINUS, WHITE)
+
+    ATOM = PassThrough()(Rule(NUMBER))
+
+    @JavaScript('return -$2')
+    @Rule(MINUS, ATOM)
+    @staticmethod
+    def ATOM(context, _, value):
+        return -value
+
+    @JavaScript('return $1')
+    @Rule(ATOM)
+    @staticmethod
+    def TERM(context, atom):
+        context.append(atom)
+        return atom
+
+    EXPR = PassThrough()(Rule(TERM))
+
+    @JavaScript('return $1 + $3')
+    @Rule(EXPR, PLUS, TERM)
+    @staticmethod
+    def EXPR(context, expr, _, term):
+        return expr + term
+
+    _ = Start(EXPR)
+
+    scanner = StaticTokenizer()
+
+
+class TestUnitRules(unittest.TestCase):
+    def test_parse(self):
+        terms = []
+        result = ParserUnitRules.parse(ParserUnitRules.scanner('1 + -2 + 3'), terms)
+        self.assertEqual(result, 2)
+        # TERM -> ATOM has an action, it is not skipped
+        self.assertEqual(terms, [1, -2, 3])
+
+    def test_identity(self):
+        # the same value whether the reduction is skipped or not
+        text = '1 + -2 + 3'
+        tables = ParserUnitRules.load_tables(ParserUnitRules.export_tables())
+        self.assertEqual(tables.parse(ParserUnitRules.scanner(text), []), 2)
+        rule = ParserUnitRules.EXPR.rules[0]
+        self.assertEqual(rule.action(None, 1), 1)
+
+        def define():
+            class ParserBad(metaclass=Parser):
+                NUMBER = Token(r'\d+')
+                PLUS = Token(r'\+')
+                _ = Scanner(NUMBER, PLUS)
+
+                SUM = PassThrough()(Rule(NUMBER, PLUS, NUMBER))
+
+                _ = Start(SUM)
+
+        self.assertRaises(TypeError, define)
+
+    def test_action(self):
+        def define(javascript, action):
+            class ParserBad(metaclass=Parser):
+                NUMBER = Token(r'\d+')
+                _ = Scanner(NUMBER)
+
+                VALUE = PassThrough()(JavaScript(javascript)(Rule(NUMBER)(action)))
+
+                _ = Start(VALUE)
+
+        self.assertRaisesRegex(TypeError, 'no action', lambda: define('return $1', lambda ctx, value: value))
+        self.assertRaisesRegex(TypeError, 'no action', lambda: define('return $1 * 10', None))
+        define('return $1', None)
+
+    def test_shortcuts(self):
+        skipped = {rule for _, rules in ParserUnitRules.__shortcuts__.values() for rule in rules}
+        self.assertEqual(skipped, {ParserUnitRules.ATOM.rules[0], ParserUnitRules.EXPR.rules[0]})
+        self.assertIs(ParserUnitRules.__shortcuts__[
+            (ParserUnitRules.__state_tree__, ParserUnitRules.NUMBER)][1][0],
+            ParserUnitRules.ATOM.rules[0])
+
+    def test_parse_tree(self):
+        tokens = ParserUnitRules.scanner.tokenize_array('1 + -2 + 3')
+        tree = ParserUnitRules.parse_tree(tokens)
+        # the skipped reductions are nodes
+        self.assertEqual(len(tree.nodes(ParserUnitRules.ATOM)), 4)
+        self.assertEqual(len(tree.nodes(ParserUnitRules.EXPR)), 3)
+        self.assertEqual(tree.skipped, 4)
+
+
+class ParserIdenticalStates(metaclass=Parser):
+    NAME = Token(r'[a-z]+')
+    COLON = Token(':')
+    SEMI = Token(';')
+    WHITE = Token(r'\s+', discard=True)
+
+    _ = Scanner(NAME, COLON, SEMI, WHITE)
+
+    @Rule(NAME)
+    @staticmethod
+    def VALUE(context, name):
+        return name
+
+    @Rule(NAME, NAME)
+    @staticmethod
+    def TYPED(context, type_, name):
+        return (type_, name)
+
+    # VALUE and TYPED are merged into two states in a different order,
+    # the states after NAME are identical
+    @Rule(VALUE, SEMI)
+    @Rule(TYPED, SEMI)
+    @staticmethod
+    def DECL(context, value, _):
+        return value
+
+    @Rule(COLON, TYPED, SEMI)
+    @Rule(COLON, VALUE, SEMI)
+    @staticmethod
+    def DECL(context, _, value, __):
+        return value
+
+    _ = Start(DECL)
+
+    scanner = StaticTokenizer()
+
+
+class TestIdenticalStates(unittest.TestCase):
+    def test_merged(self):
+        statistics = ParserIdenticalStates.__syntax__.statistics
+        self.assertEqual(statistics['states before merging identical states'], 15)
+        self.assertEqual(len(ParserIdenticalStates.__state_list__), 14)
+
+    def test_parse(self):
+        p = ParserIdenticalStates
+        for text, result in (('a;', 'a'), ('int b;', ('int', 'b')),
+                             (': a;', 'a'), (': int b;', ('int', 'b'))):
+            self.assertEqual(p.parse(p.scanner(text), None), result)
+        with self.assertRaises(UnexpectedTokenError):
+            p.parse(p.scanner(': int b c;'), None)
+
+    def test_report(self):
+        buf = io.StringIO()
+        ParserIdenticalStates.__report__(buf)
+        self.assertIn('states: 14', buf.getvalue())
+        self.assertIn('states before merging identical states: 15', buf.getvalue())
+
+
 # UPG
 # RUN python3 -m unittest tests.py